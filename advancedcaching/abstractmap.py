@@ -27,7 +27,10 @@ import logging
 logger = logging.getLogger('abstractmap')
 import geo
 import math
-
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 
@@ -38,23 +41,32 @@ class AbstractMap(object):
     CLICK_MAX_RADIUS = 7
     CLICK_CHECK_RADIUS = 17
 
+    # Memory for decoded tiles, in bytes
+    TILE_CACHE_SIZE = 16 * 1024 * 1024
+
     @classmethod
-    def set_config(Map, map_providers, map_path, placeholder_cantload, placeholder_loading):
+    def set_config(Map, map_providers, map_path, placeholder_cantload, placeholder_loading, downloader = None, tile_cache_size = TILE_CACHE_SIZE, revalidate_after = 0, revalidate_interval = 1):
 
         Map.noimage_cantload = Map._load_tile(placeholder_cantload)
         Map.noimage_loading = Map._load_tile(placeholder_loading)
         Map.tile_loaders = []
+        Map.tile_cache = openstreetmap.TileCache(tile_cache_size, Map._get_tile_size)
+        Map.tile_scheduler = openstreetmap.TileScheduler(openstreetmap.CONCURRENT_THREADS * 2)
+        # Tiles older than revalidate_after days are checked for changes
+        Map.tile_revalidator = openstreetmap.TileRevalidator(revalidate_after * 24 * 3600, revalidate_interval) if revalidate_after > 0 else None
 
         for name, params in map_providers:
             tl = openstreetmap.get_tile_loader( ** dict([(str(a), b) for a, b in params.items()]))
             tl.noimage_loading = Map.noimage_loading
             tl.noimage_cantload = Map.noimage_cantload
             tl.base_dir = map_path
+            tl.downloader = downloader
+            tl.tile_cache = Map.tile_cache
+            tl.revalidator = Map.tile_revalidator
             #tl.gui = self
             Map.tile_loaders.append((name, tl))
 
     def __init__(self, center, zoom, tile_loader = None):
-        self.active_tile_loaders = []
         self.double_size = False
         self.layers = []
         self.osd_message = None
@@ -218,6 +230,24 @@ class AbstractMap(object):
         p_y = int(point[1] * size + self.map_height / 2) - self.map_center_y * size
         return (p_x % self.total_map_width , p_y)
 
+    def coords2points(self, coords):
+        '''
+        Return the screen points of many coordinates at once, see coord2point.
+
+        '''
+        if len(coords) == 0:
+            return []
+        xs, ys = mercator_array(coords)
+        size = self.tile_loader.TILE_SIZE
+        n = 2 ** self.zoom * size
+        if numpy != None:
+            # Integers like int() in coord2point, so that both give the same points
+            p_x = numpy.trunc(xs * n + self.map_width / 2).astype(int) - self.map_center_x * size
+            p_y = numpy.trunc(ys * n + self.map_height / 2).astype(int) - self.map_center_y * size
+            return zip((p_x % self.total_map_width).tolist(), p_y.tolist())
+        offset_x, offset_y = self.map_center_x * size, self.map_center_y * size
+        return [((int(x * n + self.map_width / 2) - offset_x) % self.total_map_width, int(y * n + self.map_height / 2) - offset_y) for x, y in zip(xs, ys)]
+
     def coord2point_float(self, coord):
         point = self.deg2num(coord)
         size = self.tile_loader.TILE_SIZE
@@ -275,11 +305,9 @@ class AbstractMap(object):
         return(xtile, ytile)
 
     def deg2num(self, coord):
-        lat_rad = math.radians(coord.lat)
+        x, y = coord.get_mercator()
         n = 2 ** self.zoom
-        xtile = (coord.lon + 180.0) / 360 * n
-        ytile = (1.0 - math.log(math.tan(lat_rad) + (1.0 / math.cos(lat_rad))) / math.pi) / 2.0 * n
-        return(xtile, ytile)
+        return (x * n, y * n)
 
     def num2deg(self, xtile, ytile):
         n = 2 ** self.zoom
@@ -298,6 +326,20 @@ class AbstractMap(object):
 
 
 
+def mercator_array(coords):
+    '''
+    Return the normalised Web Mercator positions of coords as two sequences
+    (NumPy arrays if available) of x and y values.
+
+    '''
+    positions = [c.get_mercator() for c in coords]
+    xs = [p[0] for p in positions]
+    ys = [p[1] for p in positions]
+    if numpy != None:
+        return numpy.array(xs), numpy.array(ys)
+    return xs, ys
+
+
 class AbstractMapLayer():
     def __init__(self):
         self.result = None
@@ -389,14 +431,19 @@ class AbstractGeocacheLayer(AbstractMapLayer):
     CACHES_ZOOM_LOWER_BOUND = 9
     CACHE_DRAW_SIZE = 10
 
-    MAX_NUM_RESULTS_SHOW = 100
+    MAX_NUM_RESULTS_SHOW = 5000
 
-    def __init__(self, get_geocaches_callback, show_cache_callback):
+    # Size of the grid cells (in pixels) in which geocaches are clustered
+    CLUSTER_CELL_SIZE = 64
+
+    def __init__(self, get_geocaches_callback, show_cache_callback, get_clusters_callback = None):
         AbstractMapLayer.__init__(self)
         #self.show_found = False
         self.show_name = False
         self.get_geocaches_callback = get_geocaches_callback
-        self.visualized_geocaches = []
+        # If set, clusters are shown where there are too many geocaches
+        self.get_clusters_callback = get_clusters_callback
+        self.set_visualized_geocaches([])
         self.show_cache_callback = show_cache_callback
         self.current_cache = None
         self.select_found = None
@@ -413,20 +460,35 @@ class AbstractGeocacheLayer(AbstractMapLayer):
     def set_current_cache(self, cache):
         self.current_cache = cache
 
-    def clicked_coordinate(self, center, topleft, bottomright):
-        mindistance = (center.lat - topleft.lat) ** 2 + (center.lon - topleft.lon) ** 2
-        caches = []
-        for c in self.visualized_geocaches:
-            dist = (c.lat - center.lat) ** 2 + (c.lon - center.lon) ** 2
+    def set_visualized_geocaches(self, coords):
+        self.visualized_geocaches = coords
+        self.visualized_positions = mercator_array(coords)
 
-            if dist < mindistance:
-                caches.append(c)
+    def clicked_coordinate(self, center, topleft, bottomright):
+        x, y = center.get_mercator()
+        x1, y1 = topleft.get_mercator()
+        mindistance = (x - x1) ** 2 + (y - y1) ** 2
+        xs, ys = self.visualized_positions
+        if numpy != None:
+            caches = [self.visualized_geocaches[i] for i in numpy.flatnonzero((xs - x) ** 2 + (ys - y) ** 2 < mindistance)]
+        else:
+            caches = [c for c, cx, cy in zip(self.visualized_geocaches, xs, ys) if (cx - x) ** 2 + (cy - y) ** 2 < mindistance]
 
         if len(caches) > 0:
             self.show_cache_callback(caches)
         return False
 
 
+    def get_clusters(self):
+        '''
+        Return the clusters for the visible area.
+        
+        '''
+        c1, c2 = area = self.map.get_visible_area()
+        cell_lat = (c2.lat - c1.lat) * self.CLUSTER_CELL_SIZE / max(self.map.map_height, 1)
+        cell_lon = (c2.lon - c1.lon) * self.CLUSTER_CELL_SIZE / max(self.map.map_width, 1)
+        return self.get_clusters_callback(area, cell_lat, cell_lon)
+
     @staticmethod
     def shorten_name(s, chars):
         max_pos = chars
@@ -0,0 +1,445 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#   Copyright (C) 2012 Daniel Fett
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#   Author: Daniel Fett agtl@danielfett.de
+#   Jabber: fett.daniel@jaber.ccc.de
+#   Bugtracker and GIT Repository: http://github.com/webhamster/advancedcaching
+#
+
+# Benchmarks for the performance critical parts of AGTL. For developing only.
+# None of these need a network connection or a GUI.
+
+import logging
+import random
+import shutil
+import sys
+import tempfile
+import time
+from StringIO import StringIO
+from os import close, listdir, path, remove
+
+import geo
+import geocaching
+import provider
+
+usage = r'''Here's how to run the benchmarks:
+
+%(name)s provider [num-caches]
+        Compare viewport queries using the R*Tree index with queries using the
+        B-tree index on (lat, lon) for several viewport sizes.
+
+%(name)s filter [num-caches]
+        Repeat filtered viewport queries while panning the map and compare
+        setting the filter for every query with reusing one compiled filter
+        object, with the query cache cleared before each query and with the
+        query cache in use. The hit rate of the query cache is shown for the
+        last one.
+
+%(name)s compression [num-caches]
+        Compare the database size, the time to open the database and the time
+        to read geocaches with all details for plain and compressed text
+        columns, and measure the conversion of an existing database. The
+        full-text index is checked for consistency afterwards.
+
+%(name)s parser overview|print directory
+        Compare parsing of complete pages with parsing of only the needed
+        parts for the search result pages (overview) or the print previews
+        (print) of geocaching.com. Each file in directory is one saved page,
+        e.g. from the HTTP debug output. Selectors of the parsers which do not
+        find the same elements in the pruned page are reported as lost.
+
+%(name)s record directory username password
+        Run the download workload (search for geocaches in WORKLOAD_AREA,
+        then download the details of some of them) with every backend and
+        record all responses to directory. This needs a network connection.
+
+%(name)s backends directory
+        Replay the recorded workload from directory with every backend and
+        report geocaches per second, bytes parsed and the time spent in the
+        parsing stages.
+'''
+
+# Area from which random geocaches are drawn (roughly Germany)
+AREA = (47.0, 55.0, 6.0, 15.0)
+
+# Viewport sizes (in degrees) to benchmark
+VIEWPORT_SIZES = [0.01, 0.05, 0.2, 1.0]
+
+REPETITIONS = 50
+
+# Area which is searched and number of geocaches whose details are
+# downloaded by the record and backends benchmarks
+WORKLOAD_AREA = (49.3513, 6.583, 49.352, 6.584)
+WORKLOAD_DETAILS = 5
+
+# Words for the descriptions and logs of random geocaches
+WORDS = (u'the cache is hidden near an old tree at the bridge over the river follow '
+    u'path through forest from parking to stage final coordinates look for small '
+    u'container magnetic behind stone wall thanks for nice hunt found it quickly '
+    u'after searching with many muggles around TFTC great view log was wet please '
+    u'replace pencil owner maintenance needed signed logbook dropped travel bug '
+    u'\xfcber Br\xfccke Wald danke f\xfcr den sch\xf6nen Cache').split()
+
+def make_text(rnd, num_words):
+    return ' '.join(rnd.choice(WORDS) for i in xrange(num_words))
+
+def add_details(c, rnd):
+    """
+    Give the geocache c a description, logs, waypoints and images of a
+    typical size.
+
+    """
+    c.shortdesc = make_text(rnd, 10)
+    c.desc = '<p>%s</p>' % '</p>\n<p>'.join(make_text(rnd, rnd.randint(20, 80)) for i in xrange(rnd.randint(2, 8)))
+    c.hints = make_text(rnd, 5)
+    c.set_logs([dict(type=rnd.choice(('smile', 'sad', 'note')), date='2012-%02d-%02d' % (rnd.randint(1, 12), rnd.randint(1, 28)), finder='user%d' % rnd.randint(1, 5000), text=make_text(rnd, rnd.randint(3, 60))) for i in xrange(20)])
+    c.set_waypoints([dict(id='%02d%s' % (i, c.name[2:]), name=make_text(rnd, 2), lat=c.lat + rnd.uniform(-0.01, 0.01), lon=c.lon + rnd.uniform(-0.01, 0.01), comment=make_text(rnd, 15)) for i in xrange(rnd.randint(0, 4))])
+    c.set_images(dict(('%s-%d.jpg' % (c.name, i), make_text(rnd, 3)) for i in xrange(rnd.randint(0, 3))))
+
+def make_geocaches(num, seed=42, details=False):
+    """
+    Create num random geocaches within AREA.
+
+    details -- Add descriptions and logs of a typical size instead of
+               placeholders
+
+    """
+    rnd = random.Random(seed)
+    # Separate generator, so that the positions do not depend on details
+    details_rnd = random.Random(seed + 1)
+    minlat, maxlat, minlon, maxlon = AREA
+    for i in xrange(num):
+        c = geocaching.GeocacheCoordinate(rnd.uniform(minlat, maxlat), rnd.uniform(minlon, maxlon), 'GCB%06d' % i)
+        c.title = 'Benchmark cache %d' % i
+        c.type = rnd.choice(geocaching.GeocacheCoordinate.TYPES)
+        c.found = (rnd.random() < 0.2)
+        # Derived from i to keep the positions of the existing databases
+        c.size = 1 + i % 4
+        c.difficulty = 10 + 5 * (i % 9)
+        c.terrain = 10 + 5 * (i / 9 % 9)
+        if details:
+            add_details(c, details_rnd)
+        else:
+            c.desc = 'x' * 2000
+            c.logs = '[]'
+        yield c
+
+def make_database(num, details=False, **kwargs):
+    """
+    Create a temporary database filled with num random geocaches.
+
+    Returns the PointProvider and the file name of the database.
+
+    """
+    handle, filename = tempfile.mkstemp(suffix='.db')
+    close(handle)
+    p = provider.PointProvider(filename, geocaching.GeocacheCoordinate, **kwargs)
+    p.add_points(make_geocaches(num, details=details), True)
+    p.save()
+    return p, filename
+
+def make_viewports(size, num, seed=23):
+    """
+    Create num random viewports with a width and height of size degrees.
+
+    """
+    rnd = random.Random(seed)
+    minlat, maxlat, minlon, maxlon = AREA
+    for i in xrange(num):
+        lat = rnd.uniform(minlat, maxlat - size)
+        lon = rnd.uniform(minlon, maxlon - size)
+        yield geo.Coordinate(lat, lon), geo.Coordinate(lat + size, lon + size)
+
+def make_pan(size, num, seed=23):
+    """
+    Create num viewports with a width and height of size degrees, each one
+    moved by a quarter of its size from the one before (like panning the map).
+
+    """
+    rnd = random.Random(seed)
+    minlat, maxlat, minlon, maxlon = AREA
+    lat = (minlat + maxlat - size) / 2
+    lon = (minlon + maxlon - size) / 2
+    for i in xrange(num):
+        yield geo.Coordinate(lat, lon), geo.Coordinate(lat + size, lon + size)
+        lat = min(max(minlat, lat + rnd.choice((-0.25, 0, 0.25)) * size), maxlat - size)
+        lon = min(max(minlon, lon + rnd.choice((-0.25, 0, 0.25)) * size), maxlon - size)
+
+def timed(function, *args, **kwargs):
+    """
+    Call function and return the time it took (in seconds) and its result.
+
+    """
+    start = time.time()
+    result = function(*args, **kwargs)
+    return time.time() - start, result
+
+def bench_provider(num=100000):
+    print "Creating databases with %d geocaches..." % num
+    providers = []
+    for name, use_rtree in (('B-tree', False), ('R*Tree', True)):
+        t, (p, filename) = timed(make_database, num, use_rtree=use_rtree)
+        if use_rtree and not p.use_rtree:
+            print "SQLite has no R*Tree support, skipping."
+            continue
+        print "%-8s created in %.2f s" % (name, t)
+        providers.append((name, p, filename))
+
+    print "%-8s %10s %10s %12s %12s" % ('index', 'viewport', 'results', 'get_points', 'filtered')
+    for size in VIEWPORT_SIZES:
+        viewports = list(make_viewports(size, REPETITIONS))
+        for name, p, filename in providers:
+            total = total_filter = 0.0
+            results = 0
+            for c1, c2 in viewports:
+                t, points = timed(p.get_points, c1, c2)
+                total += t
+                results += len(points)
+                t, points = timed(p.get_points_filter, (c1, c2), False)
+                total_filter += t
+            print "%-8s %9.2f° %10d %9.2f ms %9.2f ms" % (name, size, results / REPETITIONS, total * 1000 / REPETITIONS, total_filter * 1000 / REPETITIONS)
+
+    for name, p, filename in providers:
+        remove(filename)
+
+# Filter settings for the filter benchmark
+FILTERS = [
+    ('type', {'ctype': ['regular', 'multi']}),
+    ('found, size', {'found': False, 'size': [2, 3, 4]}),
+    ('terrain, diff', {'terrain': [1, 1.5, 2, 2.5], 'diff': (1, 3)}),
+    ('name', {'name_search': 'cache 1'}),
+]
+
+def bench_filter(num=100000):
+    print "Creating database with %d geocaches..." % num
+    # The query cache is only used for stubs
+    p, filename = make_database(num, stubtype=geocaching.GeocacheStub)
+    viewports = list(make_pan(VIEWPORT_SIZES[2], REPETITIONS))
+
+    def query_each(settings):
+        for c1, c2 in viewports:
+            p.query_cache.clear()
+            p.set_filter(**settings)
+            p.get_points_filter((c1, c2), None, None, True)
+
+    def query_compiled(settings, use_cache=False):
+        f = provider.Filter(**settings)
+        p.query_cache.clear()
+        for c1, c2 in viewports:
+            if not use_cache:
+                p.query_cache.clear()
+            p.use_filter(f)
+            p.get_points_filter((c1, c2), None, None, True)
+
+    print "%-15s %14s %14s %14s %9s" % ('filter', 'set_filter', 'compiled', 'cached', 'hit rate')
+    for name, settings in FILTERS:
+        t_each, result = timed(query_each, settings)
+        t_compiled, result = timed(query_compiled, settings)
+        before = p.get_query_cache_statistics()
+        t_cached, result = timed(query_compiled, settings, True)
+        after = p.get_query_cache_statistics()
+        hits, misses = after['hits'] - before['hits'], after['misses'] - before['misses']
+        print "%-15s %11.2f ms %11.2f ms %11.2f ms %8.0f%%" % (name, t_each * 1000 / REPETITIONS, t_compiled * 1000 / REPETITIONS, t_cached * 1000 / REPETITIONS, 100.0 * hits / max(1, hits + misses))
+    remove(filename)
+
+def bench_compression(num=20000):
+    names = ['GCB%06d' % i for i in random.Random(5).sample(xrange(num), min(num, 1000))]
+    def read(p):
+        for name in names:
+            c = p.get_by_name(name)
+            c.get_logs()
+            c.get_waypoints()
+            len(c.desc)
+    def open_database(filename):
+        for i in xrange(5):
+            provider.PointProvider(filename, geocaching.GeocacheCoordinate)
+
+    print "Creating databases with %d geocaches..." % num
+    print "%-12s %10s %10s %10s %12s" % ('storage', 'size', 'create', 'open', 'read 1000')
+    files = []
+    for name, compress in (('plain', False), ('compressed', True)):
+        t_create, (p, filename) = timed(make_database, num, True, compress=compress)
+        files.append(filename)
+        t_open, result = timed(open_database, filename)
+        t_read, result = timed(read, p)
+        # Raises an error if the index does not match the (compressed) text
+        p.check_fts_integrity()
+        print "%-12s %8dkB %8.2f s %7.1f ms %9.1f ms" % (name, path.getsize(filename) / 1024, t_create, t_open * 1000 / 5, t_read * 1000)
+
+    p = provider.PointProvider(files[0], geocaching.GeocacheCoordinate)
+    size = path.getsize(files[0])
+    t, converted = timed(p.set_compression, True)
+    p.check_fts_integrity()
+    print "Converted %d geocaches in %.2f s, %dkB -> %dkB" % (converted, t, size / 1024, path.getsize(files[0]) / 1024)
+    for filename in files:
+        remove(filename)
+
+def compare_pruned(doc, pruned, selectors):
+    """
+    Return the selectors which do not match the same elements (with the same
+    contents) in the complete document doc and in the pruned document. The
+    forms are compared as well, because the next search result page is
+    requested with the values of the first form.
+
+    """
+    from lxml.html import tostring
+    lost = [s for s in selectors if [tostring(x) for x in doc.cssselect(s)] != [tostring(x) for x in pruned.cssselect(s)]]
+    if [(f.action, f.form_values()) for f in doc.forms] != [(f.action, f.form_values()) for f in pruned.forms]:
+        lost.append('form')
+    return lost
+
+def bench_parser(kind, directory):
+    import cachedownloader
+    backend = cachedownloader.GeocachingComCacheDownloader
+    keep = {'overview': backend.OVERVIEW_NODES, 'print': backend.PRINT_PREVIEW_NODES}[kind]
+    selectors = {'overview': backend.OVERVIEW_SELECTORS, 'print': backend.PRINT_PREVIEW_SELECTORS}[kind]
+    chunk_size = 16 * 1024
+
+    print "%-30s %10s %12s %12s %10s %10s   %s" % ('file', 'size', 'complete', 'pruned', 'elements', 'kept', 'lost')
+    for name in sorted(listdir(directory)):
+        with open(path.join(directory, name)) as f:
+            text = f.read()
+        total = total_pruned = 0.0
+        for i in xrange(REPETITIONS):
+            t, doc = timed(cachedownloader.read_document, StringIO(text), chunk_size)
+            total += t
+            t, pruned = timed(cachedownloader.read_document, StringIO(text), chunk_size, keep)
+            total_pruned += t
+        lost = compare_pruned(doc, pruned, selectors)
+        print "%-30s %9dk %9.2f ms %9.2f ms %10d %10d   %s" % (name[:30], len(text) / 1024, total * 1000 / REPETITIONS, total_pruned * 1000 / REPETITIONS, len(list(doc.iter())), len(list(pruned.iter())), ', '.join(lost) or 'nothing')
+
+def make_backend(name, replay_path = None, record_path = None):
+    """
+    Create the backend name with its own downloader and temporary files.
+
+    Returns the backend and a list of temporary files and directories.
+
+    """
+    import cachedownloader
+    import downloader
+    handle, cookiefile = tempfile.mkstemp()
+    close(handle)
+    outdir = tempfile.mkdtemp()
+    d = downloader.FileDownloader(cookiefile)
+    if replay_path != None:
+        d.replay_from(replay_path)
+    else:
+        d.record_to(record_path)
+    backend = cachedownloader.get(name, d, outdir, False)
+    def error(caller, e):
+        print "%s: %s" % (name, e)
+    backend.connect('download-error', error)
+    backend.connect('already-downloading-error', error)
+    return backend, [cookiefile, outdir]
+
+def remove_temporary(files):
+    for f in files:
+        if path.isdir(f):
+            shutil.rmtree(f)
+        elif path.exists(f):
+            remove(f)
+
+def run_workload(backend):
+    """
+    Search for geocaches in WORKLOAD_AREA and download the details of the
+    first WORKLOAD_DETAILS of them. Returns the number of geocaches.
+
+    """
+    minlat, minlon, maxlat, maxlon = WORKLOAD_AREA
+    caches = backend.get_overview((geo.Coordinate(minlat, minlon), geo.Coordinate(maxlat, maxlon)), lambda names: {}, lambda name: None)
+    for c in caches[:WORKLOAD_DETAILS]:
+        backend.update_coordinate(c)
+    return len(caches) + min(len(caches), WORKLOAD_DETAILS)
+
+class StageTimer(object):
+    """
+    Sums up the time spent in wrapped functions, per stage.
+
+    """
+    def __init__(self):
+        self.times = {}
+
+    def wrap(self, stage, function):
+        self.times[stage] = 0.0
+        def wrapped(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.times[stage] += time.time() - start
+        return wrapped
+
+def record_workload(directory, username, password):
+    import cachedownloader
+    for name in sorted(cachedownloader.BACKENDS):
+        backend, files = make_backend(name, record_path = directory)
+        backend.update_userdata(username, password)
+        print "%s: recorded %d geocaches" % (name, run_workload(backend))
+        remove_temporary(files)
+
+def bench_backends(directory):
+    import cachedownloader
+    read_document = cachedownloader.read_document
+    print "%-20s %10s %7s %10s %12s %10s   %s" % ('backend', 'geocaches', 'errors', 'time', 'geocaches/s', 'parsed', 'stages')
+    for name in sorted(cachedownloader.BACKENDS):
+        backend, files = make_backend(name, replay_path = directory)
+        timer = StageTimer()
+        # Requests which were not recorded are only reported as download errors
+        errors = []
+        backend.connect('download-error', lambda caller, e: errors.append(e))
+        
+        # Count the bytes of all replayed responses
+        parsed = [0]
+        get_reader = backend.downloader.get_reader
+        def counting_get_reader(*args, **kwargs):
+            reader = get_reader(*args, **kwargs)
+            parsed[0] += path.getsize(reader.name)
+            return reader
+        backend.downloader.get_reader = counting_get_reader
+        
+        cachedownloader.read_document = timer.wrap('html', read_document)
+        prefix = '_%s' % backend.__class__.__name__
+        for stage, attribute in (('details', prefix + '__parse_cache_page'), ('print', prefix + '__parse_cache_page_print'), ('logs', '_parse_logs_json')):
+            if hasattr(backend, attribute):
+                setattr(backend, attribute, timer.wrap(stage, getattr(backend, attribute)))
+        try:
+            t, num = timed(run_workload, backend)
+        finally:
+            cachedownloader.read_document = read_document
+            remove_temporary(files)
+        stages = ', '.join("%s %.0f ms" % (stage, timer.times[stage] * 1000) for stage in sorted(timer.times))
+        print "%-20s %10d %7d %8.2f s %12.2f %9dk   %s" % (name, num, len(errors), t, num / t if t > 0 else 0, parsed[0] / 1024, stages)
+
+BENCHMARKS = {
+    'provider': (bench_provider, [int]),
+    'filter': (bench_filter, [int]),
+    'compression': (bench_compression, [int]),
+    'parser': (bench_parser, [str, str]),
+    'record': (record_workload, [str, str, str]),
+    'backends': (bench_backends, [str]),
+}
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING,
+                    format='%(relativeCreated)6d %(levelname)10s %(name)-20s %(message)s',
+                    )
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print usage % ({'name': path.basename(sys.argv[0])})
+        sys.exit(2)
+    function, types = BENCHMARKS[sys.argv[1]]
+    args = [t(a) for t, a in zip(types, sys.argv[2:])]
+    function(*args)
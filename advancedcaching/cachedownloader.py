@@ -20,6 +20,8 @@
 #   Bugtracker and GIT Repository: http://github.com/webhamster/advancedcaching
 #
 
+from __future__ import with_statement
+
 VERSION = 33
 VERSION_DATE = '2012-09-11'
 
@@ -33,33 +35,273 @@ except (ImportError, AttributeError):
 from geocaching import GeocacheCoordinate
 import geo
 import os
+import sys
 import threading
 import re
+import time
 import gobject
+from collections import deque
 from utils import HTMLManipulations
-from lxml.html import fromstring, tostring, submit_form
+from lxml.html import fromstring, tostring, submit_form, HTMLParser, HtmlElementClassLookup
+try:
+    from lxml.etree import HTMLPullParser
+except ImportError:
+    # lxml < 3.3, pages are always parsed completely
+    HTMLPullParser = None
 
 #ugly workaround...
 user_token = [None]
 
 
+class PagePruner(object):
+    '''
+    Drops the parts of a HTML document which are not needed later on while
+    the document is parsed.
+    
+    keep is a list of simple selectors such as 'title', '#uxLatLon', '.Meta'
+    or 'tr.BorderBottom'. Matching elements are kept together with their
+    contents. All other elements are removed as soon as they are closed,
+    unless they contain something to keep.
+    
+    '''
+    
+    def __init__(self, keep):
+        self.tags = set()
+        self.rules = []
+        for selector in keep:
+            tag, id, classes = None, None, set()
+            for prefix, name in re.findall(r'([#.]?)([\w-]+)', selector):
+                if prefix == '#':
+                    id = name
+                elif prefix == '.':
+                    classes.add(name)
+                else:
+                    tag = name
+            if id == None and len(classes) == 0:
+                self.tags.add(tag)
+            else:
+                self.rules.append((tag, id, classes))
+        self.parser = HTMLPullParser(events = ('start', 'end'), encoding = 'utf-8')
+        self.parser.set_element_class_lookup(HtmlElementClassLookup())
+        # For each open element, whether it is kept with its contents
+        self.stack = [False]
+        
+    def matches(self, element):
+        if element.tag in self.tags:
+            return True
+        element_id, element_class = element.get('id'), element.get('class')
+        if element_id == None and element_class == None:
+            return False
+        element_classes = set(element_class.split()) if element_class != None else set()
+        for tag, id, classes in self.rules:
+            if (tag == None or tag == element.tag) \
+                and (id == None or id == element_id) \
+                and classes <= element_classes:
+                return True
+        return False
+        
+    def feed(self, data):
+        self.parser.feed(data)
+        self.__prune()
+        
+    def close(self):
+        root = self.parser.close()
+        # libxml2 holds back the events of large parts of the document until the end
+        self.__prune()
+        return root
+        
+    def __prune(self):
+        stack = self.stack
+        for event, element in self.parser.read_events():
+            if event == 'start':
+                stack.append(stack[-1] or self.matches(element))
+            elif not stack.pop() and len(element) == 0:
+                parent = element.getparent()
+                if parent is not None:
+                    parent.remove(element)
+                    
+                    
+class DocumentParser(object):
+    '''
+    Builds the complete HTML document from the blocks it is fed.
+    
+    With libxml2 2.10, documents which lxml's HTMLParser builds from more
+    than one block do not find their elements by tag name (doc.forms,
+    doc.iter('input')) after the first block; documents built by an
+    HTMLPullParser which reports events do.
+    
+    '''
+    
+    def __init__(self):
+        self.parser = HTMLPullParser(events = ('end',), encoding = 'utf-8')
+        self.parser.set_element_class_lookup(HtmlElementClassLookup())
+        
+    def feed(self, data):
+        self.parser.feed(data)
+        # The events themselves are not needed
+        for event in self.parser.read_events():
+            pass
+            
+    def close(self):
+        return self.parser.close()
+        
+        
+def read_document(page, chunk_size, keep = None):
+    '''
+    Parse the file-like object page while it is read in blocks of chunk_size,
+    so that the complete text is never held in memory.
+    
+    If keep is given, only the parts of the document described by keep are
+    retained (see PagePruner).
+    
+    '''
+    if HTMLPullParser == None:
+        parser = HTMLParser(encoding = 'utf-8')
+    elif keep == None:
+        parser = DocumentParser()
+    else:
+        parser = PagePruner(keep)
+    try:
+        while True:
+            data = page.read(chunk_size)
+            if not data:
+                break
+            parser.feed(data)
+    finally:
+        page.close()
+    return parser.close()
+
+
+class DownloadTask(object):
+    '''
+    A call of function with args in a DownloadPool. When it is done, either
+    result or exc_info (see sys.exc_info) is set.
+    
+    '''
+    
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.started = False
+        self.done = False
+        self.result = None
+        self.exc_info = None
+        
+        
+class DownloadPool(object):
+    '''
+    A pool of at most size worker threads, shared by all downloads of a
+    CacheDownloader. Downloads which start further downloads (such as the log
+    pages of a geocache) use the same workers, so no more than size requests
+    run at once.
+    
+    Workers are started when tasks are submitted and stop as soon as there
+    are no more queued tasks, so no idle threads are left behind. A worker
+    which waits for the tasks it submitted runs those which were not started
+    yet, so nested downloads can not deadlock the pool.
+    
+    '''
+    
+    def __init__(self, size):
+        self.size = size
+        self.tasks = deque()
+        self.condition = threading.Condition()
+        self.workers = 0
+        self.local = threading.local()
+        
+    def submit(self, function, *args):
+        task = DownloadTask(function, args)
+        with self.condition:
+            self.tasks.append(task)
+            if self.workers < self.size:
+                self.workers += 1
+                worker = threading.Thread(target = self.__work)
+                worker.daemon = True
+                worker.start()
+            self.condition.notify_all()
+        return task
+        
+    # Yield the tasks as soon as they are done
+    def finished(self, tasks):
+        pending = list(tasks)
+        is_worker = getattr(self.local, 'worker', False)
+        while len(pending) > 0:
+            with self.condition:
+                done = [task for task in pending if task.done]
+                own = None
+                if len(done) == 0:
+                    if is_worker:
+                        own = self.__take(task for task in pending if not task.started)
+                    if own == None:
+                        # A timeout keeps the waiting thread interruptible
+                        self.condition.wait(1)
+                        continue
+            if own != None:
+                self.__run(own)
+                continue
+            for task in done:
+                pending.remove(task)
+                yield task
+                
+    def __work(self):
+        self.local.worker = True
+        while True:
+            with self.condition:
+                task = self.__take(self.__queued())
+                if task == None:
+                    self.workers -= 1
+                    return
+            self.__run(task)
+            
+    # Drop the tasks from the queue which were taken by waiting workers
+    def __queued(self):
+        while len(self.tasks) > 0:
+            task = self.tasks.popleft()
+            if not task.started:
+                yield task
+                
+    # Must be called with the condition held
+    def __take(self, tasks):
+        for task in tasks:
+            task.started = True
+            return task
+        return None
+        
+    def __run(self, task):
+        try:
+            task.result = task.function(*task.args)
+        except:
+            task.exc_info = sys.exc_info()
+        with self.condition:
+            task.done = True
+            self.condition.notify_all()
+
 
 class CacheDownloader(gobject.GObject):
     __gsignals__ = {
                     'progress' : (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE, (str, float, float, )),
                     'download-error' : (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
-                    'already-downloading-error' : (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,))
+                    'geocache-downloaded' : (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
+                    'already-downloading-error' : (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
                     'need-auth-data' : (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE, (str)),
                     }
 
     lock = threading.Lock()
 
     # Path and download_images are not needed if this instance is only used to upload data.
-    def __init__(self, downloader, path = None, download_images = True):
+    # concurrency is the maximum number of geocaches which are downloaded at the same time,
+    # politeness_delay the minimum time in seconds between two requests to the same host.
+    def __init__(self, downloader, path = None, download_images = True, concurrency = 1, politeness_delay = 0):
         gobject.GObject.__init__(self)
         self.downloader = downloader
         self.path = path
         self.download_images = download_images
+        self.concurrency = max(1, concurrency)
+        self.pool = DownloadPool(self.concurrency)
+        self.politeness_delay = politeness_delay
+        self._host_lock = threading.Lock()
+        self._host_next_request = {}
+        self._login_lock = threading.Lock()
         if path != None and not os.path.exists(path):
             try:
                 os.mkdir(path)
@@ -80,18 +322,30 @@ class CacheDownloader(gobject.GObject):
             self.password = password
         self.downloader.reset_cookies()
 
-    # Update several coordinates
+    # Update several coordinates, using up to self.concurrency parallel downloads
     def update_coordinates(self, coordinates, num_logs = 20):
-        i = 0
-        c = []
         if len(coordinates) > self.MAX_DOWNLOAD_NUM:
             self.emit("download-error", Exception("Downloading of more than %d descriptions is not supported." % self.MAX_DOWNLOAD_NUM))
             return
-        for cache in coordinates:
-            u = self.update_coordinate(cache, num_logs = num_logs, progress_min = i, progress_max = i+1, progress_all = len(coordinates))
-            c.append(u)
-            i += 1
-        return c
+        if not CacheDownloader.lock.acquire(False):
+            self.emit('already-downloading-error', Exception("There's a download in progress. Please wait."))
+            return
+        results = {}
+        done = [0]
+        def update(cache):
+            logger.info("Downloading %s..." % (cache.name))
+            # Each download reports its progress within the slot of the next geocache to finish
+            return self._update_coordinate(cache, num_logs = num_logs, progress_min = done[0], progress_max = done[0] + 1, progress_all = len(coordinates))
+        def finished(cache, result):
+            done[0] += 1
+            results[cache.name] = result if result != None else cache
+            if result != None:
+                self.emit('geocache-downloaded', result)
+        try:
+            self._fetch_parallel(update, coordinates, finished)
+        finally:
+            CacheDownloader.lock.release()
+        return [results.get(cache.name, cache) for cache in coordinates]
                 
     # Update a single coordinate
     def update_coordinate(self, coordinate, num_logs = 20, progress_min = 0.0, progress_max = 1.0, progress_all = 1.0):
@@ -109,15 +363,45 @@ class CacheDownloader(gobject.GObject):
         CacheDownloader.lock.release()
         return u
 
-    # Retrieve geocaches in the bounding box defined by location 
-    def get_overview(self, location, get_geocache_callback, skip_callback = None):
+    # Call function for each of the items in the worker threads of self.pool.
+    # callback(item, result) is called in the calling thread as soon as a result arrives.
+    # If function raised an exception, the exception is reported and result is None.
+    def _fetch_parallel(self, function, items, callback):
+        tasks = [self.pool.submit(function, x) for x in items]
+        for task in self.pool.finished(tasks):
+            if task.exc_info != None:
+                logger.error("Error while downloading %r" % (task.args[0],), exc_info = task.exc_info)
+                self.emit('download-error', task.exc_info[1])
+                callback(task.args[0], None)
+            else:
+                callback(task.args[0], task.result)
+
+    # Wait until the next request to the host of url is allowed
+    def _wait_for_host(self, url):
+        if self.politeness_delay <= 0:
+            return
+        host = url.split('/')[2] if '://' in url else ''
+        with self._host_lock:
+            now = time.time()
+            start = max(now, self._host_next_request.get(host, 0))
+            self._host_next_request[host] = start + self.politeness_delay
+        if start > now:
+            time.sleep(start - now)
+
+    # Retrieve geocaches in the bounding box defined by location.
+    # get_states_callback takes a list of IDs and returns the (found, updated)
+    # states of those in the database (see PointProvider.get_states),
+    # get_geocache_callback returns a geocache from the database by its ID.
+    # skip_callback is called with the ID, the state (or None) and the new found
+    # status; if it returns True, the details are not downloaded.
+    def get_overview(self, location, get_states_callback, get_geocache_callback, skip_callback = None):
         if not CacheDownloader.lock.acquire(False):
             self.emit('already-downloading-error', Exception("There's a download in progress. Please wait."))
             logger.warning("Download in progress")
             return
             
         try:
-            points = self._get_overview(location, get_geocache_callback, skip_callback = skip_callback)
+            points = self._get_overview(location, get_states_callback, get_geocache_callback, skip_callback = skip_callback)
         except Exception, e:
             logger.exception(e)
             self.emit('download-error', e)
@@ -182,33 +466,37 @@ class GeocachingComCacheDownloader(CacheDownloader):
     USER_TOKEN_URL = 'http://www.geocaching.com/map/default.aspx?lat=6&lng=9'
     UPLOAD_FIELDNOTES_URL = 'http://www.geocaching.com/my/uploadfieldnotes.aspx'
     
-    def __init__(self, downloader, path = None, download_images = True):
-        CacheDownloader.__init__(self, downloader, path, download_images)
+    # Parts of the pages which are needed for parsing (see PagePruner).
+    # The login check needs .SignedInText on every page.
+    LOGIN_NODES = ['.SignedInText']
+    # Result table, page counter and the form fields to request the next page
+    OVERVIEW_NODES = LOGIN_NODES + ['.PageBuilderWidget', '.SearchResultsTable', 'input', 'select', 'textarea']
+    PRINT_PREVIEW_NODES = LOGIN_NODES + ['title', 'h2', '.item-content', '.LatLong', '.Third', '#uxEncryptedHint']
+    # Everything _get_overview and __parse_cache_page_print select. The parser
+    # benchmark checks that these match the same elements in pruned pages.
+    OVERVIEW_SELECTORS = ['.SignedInText', '#ctl00_ContentBody_ResultsPanel .PageBuilderWidget b', '.SearchResultsTable tr', '.SearchResultsTable .Merge .small']
+    PRINT_PREVIEW_SELECTORS = ['.SignedInText', 'title', '#Content h2 img', '#Content .sortables .item-content', '.LatLong.Meta', '.Third .Meta img', '#uxEncryptedHint', '#Content .sortables .item-content tr.BorderBottom']
+    
+    def __init__(self, downloader, path = None, download_images = True, concurrency = 1, politeness_delay = 0):
+        CacheDownloader.__init__(self, downloader, path, download_images, concurrency, politeness_delay)
         self.downloader.allow_minified_answers = True
         
-    def __download(self, url, values = None, data = None, raw = False):
-        sucess = False
+    # If keep is given, only these parts of the page are parsed (see PagePruner).
+    def __download(self, url, values = None, data = None, raw = False, keep = None):
+        success = False
         while not success:
-            response = self.downloader.get_reader(url, data, values)
+            self._wait_for_host(url)
+            response = self.downloader.get_reader(url, values, data)
             if raw:
                 return response.read()
-            doc = self.__read_document(response)
+            doc = self.__read_document(response, keep)
             success = self.__check_and_perform_login(doc)
         return doc
 
-    def __read_document(self, page):
-        text = page.read()
-        page.close()
-        try:
-            t = unicode(text, 'utf-8')
-            doc = fromstring(t)
-        except Exception, e:
-            logger.exception(e)
-            from lxml.html.soupparser import fromstring as fromstring_soup
-            doc = fromstring_soup(text)
-        return doc
+    def __read_document(self, page, keep = None):
+        return read_document(page, self.downloader.CHUNK_SIZE, keep)
 
-    def _get_overview(self, location, get_geocache_callback, skip_callback = None):
+    def _get_overview(self, location, get_states_callback, get_geocache_callback, skip_callback = None):
         c1, c2 = location
         center = geo.Coordinate((c1.lat + c2.lat)/2, (c1.lon + c2.lon)/2)
         dist = (center.distance_to(c1)/1000)/2
@@ -219,7 +507,7 @@ class GeocachingComCacheDownloader(CacheDownloader):
         
         self.emit("progress", "Fetching list", 0, 1)
         
-        doc = self.__download(url)
+        doc = self.__download(url, keep = self.OVERVIEW_NODES)
         
         cont = True
         wpts = []
@@ -263,7 +551,7 @@ class GeocachingComCacheDownloader(CacheDownloader):
                 action = self.SEEK_URL % doc.forms[0].action
                 logger.info("Retrieving next page!")
                 self.emit("progress", "Fetching list (%d of %d)" % (page_current + 1, page_max), page_current, page_max)
-                doc = self.__download(action, data=('application/x-www-form-urlencoded', values))
+                doc = self.__download(action, data=('application/x-www-form-urlencoded', values), keep = self.OVERVIEW_NODES)
                 
                 cont = True
         
@@ -271,13 +559,15 @@ class GeocachingComCacheDownloader(CacheDownloader):
         points_that_need_downloading = [] # Geocaches that need to be downloaded
         points_finished = []              # Geocaches that only need to be updated in the database
         # and Geocaches which don't need any update (they will be removed)
+        # The states of all geocaches are looked up at once
+        states = get_states_callback([id for guid, found, id in wpts])
         for guid, found, id in wpts:
             # Check if geocache exists in DB
-            coordinate = get_geocache_callback(id)
+            state = states.get(id, None)
             
-            if coordinate == None:
+            if state == None:
                 # If the coordinate was not in the DB
-                if skip_callback != None and skip_callback(None, found):
+                if skip_callback != None and skip_callback(id, None, found):
                     # Skip it, for example when it is marked as found
                     logger.info("Skipping %s. It was not in the DB." % id)
                     continue
@@ -286,41 +576,49 @@ class GeocachingComCacheDownloader(CacheDownloader):
                 logger.info("Downloading %s. It was not in the DB." % id)
                 continue
             
-            if coordinate.found != found:
-                coordinate.found = found
-                needs_update = True
-            else:
-                needs_update = False
+            needs_update = (state[0] != found)
                 
-            if skip_callback != None and skip_callback(coordinate, found):
+            if skip_callback != None and skip_callback(id, state, found):
                 if not needs_update:
                     logger.info("Skipping %s. It was in the DB, but its found status was correct." % id)
                     continue
                 # If the coordinate is to be skipped, put it into points_finished anyway
                 # because the found status was updated
-                points_finished.append(coordinate)
+                coordinate = get_geocache_callback(id)
+                if coordinate != None:
+                    coordinate.found = found
+                    points_finished.append(coordinate)
                 logger.info("Updating %s. It was in the DB, but its found status was not correct." % id)
                 continue
             logger.info("Downloading %s. It was in the DB, but it was not to be skipped." % id)
+            # Only the geocaches which are downloaded are read completely
+            coordinate = get_geocache_callback(id)
+            if coordinate == None:
+                coordinate = GeocacheCoordinate(-1, -1, id)
             points_that_need_downloading.append((guid, found, id, coordinate))
                     
         
-        # Download the geocaches using the print preview 
+        # Download the geocaches using the print preview, up to self.concurrency at once
 
-        i = 0
-        for guid, found, id, coordinate in points_that_need_downloading:
-            i += 1
+        def download(point):
+            guid, found, id, coordinate = point
             coordinate.found = found
             logger.debug("Coordinate %s, found=%r" % (coordinate.name, found))
-            self.emit("progress", "Geocache %d of %d" % (i, len(points_that_need_downloading)), i, len(points_that_need_downloading))
             logger.info("Downloading %s..." % id)
             url = self.PRINT_PREVIEW_URL % guid
             
-            doc = self.__download(url)
-            result = self.__parse_cache_page_print(doc, coordinate, num_logs = 20)
+            doc = self.__download(url, keep = self.PRINT_PREVIEW_NODES)
+            return self.__parse_cache_page_print(doc, coordinate, num_logs = 20)
+
+        done = [0]
+        def finished(point, result):
+            done[0] += 1
+            self.emit("progress", "Geocache %d of %d" % (done[0], len(points_that_need_downloading)), done[0], len(points_that_need_downloading))
             if result != None and result.lat != -1:
                 points_finished.append(result)
-                
+                self.emit('geocache-downloaded', result)
+
+        self._fetch_parallel(download, points_that_need_downloading, finished)
         return points_finished
         
     def _update_coordinate(self, coordinate, num_logs = 20, progress_min = 0.0, progress_max = 1.0, progress_all = 1.0):
@@ -335,7 +633,7 @@ class GeocachingComCacheDownloader(CacheDownloader):
         
         doc = self.__download(url)        
             
-        return self.__parse_cache_page(response, coordinate, num_logs, progress_min = progress_min, progress_max = progress_max, progress_all = progress_all)
+        return self.__parse_cache_page(doc, coordinate, num_logs, progress_min = progress_min, progress_max = progress_max, progress_all = progress_all)
 
     
     def __check_and_perform_login(self, doc):
@@ -349,6 +647,11 @@ class GeocachingComCacheDownloader(CacheDownloader):
             logger.info("Probably still signed in.")
             return True
         
+        # Parallel downloads may all notice the missing login at once; log in one after another.
+        with self._login_lock:
+            return self.__perform_login()
+
+    def __perform_login(self):
         values = {'ctl00$ContentBody$tbUsername': self.username,
             'ctl00$ContentBody$tbPassword': self.password,
             'ctl00$ContentBody$cbRememberMe': 'on',
@@ -369,9 +672,8 @@ class GeocachingComCacheDownloader(CacheDownloader):
             return False
         raise Exception("Name/Password MAY be correct, but I encountered unexpected data while logging in.")
         
-    def __parse_cache_page(self, cache_page, coordinate, num_logs, download_images = True, progress_min = 0.0, progress_max = 1.0, progress_all = 1.0):
+    def __parse_cache_page(self, doc, coordinate, num_logs, download_images = True, progress_min = 0.0, progress_max = 1.0, progress_all = 1.0):
         logger.debug("Start parsing, pmin = %f, pmax = %f." % (progress_min, progress_max))
-        doc = self.__read_document(cache_page)
                 
         # Basename - Image name without path and extension
         def basename(url):
@@ -477,32 +779,9 @@ class GeocachingComCacheDownloader(CacheDownloader):
                 userToken = re.sub("(?s)'.*", '', userToken)
                 logger.debug("userToken: %s" % userToken)
         
-        self.emit('progress', 'Fetching logs', progress_min + 0.2 * (progress_max - progress_min), progress_all)
-        
-        #Ask first page of logs. And same time number of pages
-        doc = self.__download(self.downloader.get_reader(self.LOGBOOK_URL % (userToken, 1), raw = True)
-        new_set_of_logs, total_page = self._parse_logs_json(doc) #True=we want also number of page
-        logs.close()
-        page_of_logs=num_logs/10 #num_logs from parameter (which comes from settings 'download_num_logs')
-
-        #First page is already handled, so counter starts from 2
-        counter = 2
-        upper_limit = min(total_page, page_of_logs)
-        while (counter <= upper_limit):
-            # We want progress to be between 0.3 and 0.5 times of our own range.
-            # Our own range is progress_min -> progress_max
-            # Log range is 0.3 to 0.5
-            progress_internal = 0.3 + (float(counter-1)/float(upper_limit)) * 0.2
-            logger.debug("- Progress internal is %f" % progress_internal)
-            logger.debug("- Progress is %f of %f" % (progress_min + progress_internal * (progress_max - progress_min), progress_all))
-            self.emit('progress', "Logs (%d/%d)" % (counter, upper_limit), progress_min + progress_internal * (progress_max - progress_min), progress_all)
-            doc = self.__download(self.LOGBOOK_URL % (userToken, counter), raw = True)
-            new_set_of_logs.extend(self._parse_logs_json(doc)[0])
-            logs.close()
-
-            counter += 1
-
-        coordinate.set_logs(new_set_of_logs)
+        # Fetch the logs in the pool while the images are downloaded and
+        # the description is parsed; the logs are needed only at the very end.
+        logs_task = self.pool.submit(self.__download_logs, userToken, num_logs, progress_min, progress_max, progress_all)
 
         # Attributes
         '''if not coordinate.attributes:
@@ -590,9 +869,7 @@ class GeocachingComCacheDownloader(CacheDownloader):
                 
                 # Download file
                 try:
-                    f = open(filename, 'wb')
-                    f.write(self.downloader.get_reader(url).read())
-                    f.close()
+                    self.downloader.download_file(url, filename)
                 except Exception, e:
                     logger.exception(e)
                     logger.error("Failed to download image from URL %s" % url)
@@ -605,6 +882,13 @@ class GeocachingComCacheDownloader(CacheDownloader):
         # Long description
         coordinate.desc = self._extract_node_contents(desc)
         
+        # Logs
+        for task in self.pool.finished([logs_task]):
+            pass
+        if logs_task.exc_info != None:
+            raise logs_task.exc_info[0], logs_task.exc_info[1], logs_task.exc_info[2]
+        coordinate.set_logs(logs_task.result)
+
         # Archived status
         for log in coordinate.get_logs():
             if log['type'] == GeocacheCoordinate.LOG_TYPE_ENABLED:
@@ -624,11 +908,40 @@ class GeocachingComCacheDownloader(CacheDownloader):
         logger.debug("End parsing.")
         return coordinate
         
+    # Download the logs of a geocache. The first page tells the number of pages,
+    # the remaining pages are then requested in parallel.
+    def __download_logs(self, userToken, num_logs, progress_min, progress_max, progress_all):
+        self.emit('progress', 'Fetching logs', progress_min + 0.2 * (progress_max - progress_min), progress_all)
+        
+        #Ask first page of logs. And same time number of pages
+        logs, total_page = self._parse_logs_json(self.__download(self.LOGBOOK_URL % (userToken, 1), raw = True))
+        page_of_logs = num_logs/10 #num_logs from parameter (which comes from settings 'download_num_logs')
+
+        #First page is already handled, so pages start from 2
+        upper_limit = min(total_page, page_of_logs)
+        pages = range(2, upper_limit + 1)
+        results = {}
+        done = [1]
+        def fetch(page):
+            return self._parse_logs_json(self.__download(self.LOGBOOK_URL % (userToken, page), raw = True))[0]
+        def finished(page, result):
+            done[0] += 1
+            results[page] = result if result != None else []
+            # We want progress to be between 0.3 and 0.5 times of our own range.
+            # Our own range is progress_min -> progress_max
+            progress_internal = 0.3 + (float(done[0] - 1)/float(upper_limit)) * 0.2
+            self.emit('progress', "Logs (%d/%d)" % (done[0], upper_limit), progress_min + progress_internal * (progress_max - progress_min), progress_all)
+        self._fetch_parallel(fetch, pages, finished)
+        
+        # Keep the order of the logbook regardless of the order in which the pages arrived
+        for page in pages:
+            logs.extend(results[page])
+        return logs
+        
     # This parses the print preview of a geocache
     # It currently omits images, waypoints and logs.
-    def __parse_cache_page_print(self, cache_page, coordinate, num_logs):
+    def __parse_cache_page_print(self, doc, coordinate, num_logs):
         logger.debug("Start parsing.")
-        doc = self.__read_document(cache_page)
         
         # Basename - Image name without path and extension
         def basename(url):
@@ -774,9 +1087,7 @@ class GeocachingComCacheDownloader(CacheDownloader):
                 logger.info("Downloading %s to %s" % (url, filename))
 
                 try:
-                    f = open(filename, 'wb')
-                    f.write(self.downloader.get_reader(url).read())
-                    f.close()
+                    self.downloader.download_file(url, filename)
                 except Exception, e:
                     logger.exception(e)
                     logger.error("Failed to download image from URL %s" % url)
@@ -929,7 +1240,6 @@ class GeocachingComCacheDownloader(CacheDownloader):
 
 BACKENDS = {
     'geocaching-com-new': {'class': GeocachingComCacheDownloader, 'name': 'geocaching.com', 'description': 'Backend for geocaching.com'},
-    'opencaching-com': {'class': OpenCachingComCacheDownloader, 'name': 'opencaching.com', 'description': 'Backend for opencaching.com'},
     }
 
 def get(name, *args, **kwargs):
@@ -25,6 +25,8 @@ import sys
 import geo
 import math
 import os
+import prefetch
+import provider
 import re
 
 usage = r'''Here's how to use this app:
@@ -40,6 +42,20 @@ If you want to use the gui:
 If you don't like your mouse:
 %(name)s update
         Search and install a new listing parser.
+%(name)s prefetch [--map name] tile-area zoom-min zoom-max
+        Download the map tiles for tile-area in the zoom levels zoom-min to
+        zoom-max for offline use. Tiles which are already on disk are skipped.
+%(name)s prefetch --resume
+        Continue an interrupted prefetch.
+%(name)s migrate-tiles [--remove]
+        Copy the downloaded map tiles of all map providers with
+        'storage': 'mbtiles' into their MBTiles files. With --remove, the
+        copied tile files are deleted afterwards.
+%(name)s compress-database [--uncompress]
+        Store the descriptions, logs, waypoints and images of all geocaches
+        compressed and shrink the database file. Geocaches which are
+        downloaded later are stored compressed as well. With --uncompress,
+        the compression is turned off again.
 %(name)s set [options]
         Change the configuration.
 %(name)s import [importactions]
@@ -95,9 +111,23 @@ filter-options:
         -i|--id id-search-string
         -a|--attribute attribute-search-string
                 Search owner, name (title), id or attributes of the geocaches (see below for search string syntax).
+        -x|--text words
+                Full-text search for geocaches containing all of the words in
+                their title, owner, descriptions, hints or logs. Words also
+                match longer words starting with them. Uses the full-text index
+                of the database, so this is fast even for many geocaches.
         --new
                 Caches which were downloaded in current session. Useful to
                 get alerted when new caches arrive.
+tile-area:
+        --in coord1 coord2
+        --around coord1 radius-in-km
+                See import actions.
+        --at-route coord1 coord2 radius-in-km
+                Along the route, see import actions.
+        --caches radius-in-km
+                Around the geocaches which were imported, selected by filter
+                or sql before, or around all geocaches in the database.
 actions:
         --print
                 Default action, prints tab-separated list of geocaches
@@ -228,12 +258,20 @@ class Cli():
                 self.parse_actions()
             elif sys.argv[self.nt] == 'update':
                 self.perform_update()
+            elif sys.argv[self.nt] == 'prefetch':
+                self.perform_prefetch()
+            elif sys.argv[self.nt] == 'migrate-tiles':
+                self.perform_migrate_tiles()
+            elif sys.argv[self.nt] == 'compress-database':
+                self.perform_compress_database()
             elif sys.argv[self.nt] == '-v':
                 self.nt += 1
             else: 
                 raise ParseError("Expected 'import', 'sql', 'filter' or 'do' but found '%s'" % sys.argv[self.nt], self.nt - 1)
 
         self.core.prepare_for_disposal()
+        # Otherwise the writer thread may still wait for changes while the interpreter shuts down
+        self.pointprovider.close()
 
     def parse_set(self):
         self.nt += 1
@@ -304,13 +342,15 @@ class Cli():
             
         
     def parse_filter(self):
-        self.check_caches_retrieved()
         self.nt += 1
         if not self.has_next():
             raise ParseError("Expected filter options.")
         while self.has_next():
             token = sys.argv[self.nt]
             self.nt += 1
+            # The full-text search can select the geocaches by itself
+            if token != '-x' and token != '--text':
+                self.check_caches_retrieved()
             if token == '--in':
                 coord1 = self.parse_coord()
                 coord2 = self.parse_coord()
@@ -352,6 +392,9 @@ class Cli():
             elif token == '-a' or token == '--attribute':
                 attribute = self.parse_string()
                 self.add_filter_attribute (attribute)
+            elif token == '-x' or token == '--text':
+                text = self.parse_string()
+                self.add_filter_text(text)
             elif token == '--new':
                 self.caches = self.new_caches
             else:
@@ -410,6 +453,79 @@ class Cli():
                 print "$ No updates available."
         self.nt += 1
 
+    def perform_prefetch(self):
+        self.nt += 1
+        if not self.has_next():
+            raise ParseError("Expected tile area or --resume.")
+        def progress(finished, total, errors):
+            if finished % 100 == 0 or finished == total:
+                print "$ %d of ~%d tiles (%d errors)" % (finished, total, errors)
+        token = sys.argv[self.nt]
+        self.nt += 1
+        if token == '--resume':
+            if not self.core.has_unfinished_prefetch():
+                raise RunError("There is no unfinished prefetch.")
+            prefetcher = self.core.get_tile_prefetcher(progress_callback = progress)
+        else:
+            map_name = None
+            if token == '--map':
+                map_name = self.parse_string()
+                token = sys.argv[self.nt]
+                self.nt += 1
+            if token == '--in':
+                areas = [(self.parse_coord(), self.parse_coord())]
+            elif token == '--around':
+                coord = self.parse_coord()
+                areas = [prefetch.get_area_around(coord, self.parse_float())]
+            elif token == '--at-route':
+                coord1 = self.parse_coord()
+                coord2 = self.parse_coord()
+                radius = self.parse_float()
+                print "* Querying OpenRouteService for route from startpoint to endpoint"
+                areas = self.core.get_route(coord1, coord2, radius)
+            elif token == '--caches':
+                radius = self.parse_float()
+                self.check_caches_retrieved()
+                areas = [prefetch.get_area_around(c, radius) for c in self.caches]
+            else:
+                raise ParseError("Unknown tile area: %s" % token)
+            zooms = range(self.parse_int(), self.parse_int() + 1)
+            prefetcher = self.core.get_tile_prefetcher(areas, zooms, map_name, progress)
+        print "* Downloading ~%d map tiles of %s" % (prefetcher.total, prefetcher.name)
+        if not prefetcher.run():
+            print "* Interrupted, continue with 'prefetch --resume'."
+        print "$ Downloaded %d bytes (%d errors)." % (prefetcher.downloaded_bytes, prefetcher.errors)
+
+    def perform_migrate_tiles(self):
+        import openstreetmap
+        self.nt += 1
+        remove_files = False
+        if self.has_next() and sys.argv[self.nt] == '--remove':
+            remove_files = True
+            self.nt += 1
+        def progress(count):
+            print "$ %d tiles" % count
+        for name, details in self.core.settings['map_providers']:
+            if details.get('storage', 'files') != 'mbtiles':
+                continue
+            print "* migrating tiles of %s" % name
+            count = openstreetmap.migrate_to_mbtiles(self.core.settings['download_map_path'], details['prefix'], details.get('file_type', 'png'), remove_files, progress)
+            print "$ Migrated %d tiles of %s." % (count, name)
+
+    def perform_compress_database(self):
+        self.nt += 1
+        compress = True
+        if self.has_next() and sys.argv[self.nt] == '--uncompress':
+            compress = False
+            self.nt += 1
+        def progress(done, total):
+            if done % 10000 < self.core.pointprovider.CHUNK_SIZE or done == total:
+                print "$ %d of %d geocaches" % (done, total)
+        size = os.path.getsize(self.core.CACHES_DB)
+        print "* %s database" % ('compressing' if compress else 'uncompressing')
+        converted = self.core.set_database_compression(compress, progress)
+        print "$ Converted %d geocaches, database size %d kB -> %d kB." % (converted, size / 1024, os.path.getsize(self.core.CACHES_DB) / 1024)
+
     def has_next(self):
         # if we have 5 tokens
         # then 1..4 are valid tokens (0 is command)
@@ -523,11 +639,11 @@ class Cli():
         self.core.save_settings(new_settings, self)
         
     def import_points(self, c1, c2):
-        def skip_callback(id, found):
+        def skip_callback(id, state, found):
             if self.skip_found and found:
                 print "* Geocache %s is marked as found, skipping!" % id
                 return True
-            if self.skip_existing and self.core.get_geocache_by_name(id) != None:
+            if self.skip_existing and state != None:
                 print "* Geocache %s is already in the database, skipping!" % id
                 return True
             return False
@@ -543,6 +659,10 @@ class Cli():
             print "* Downloading Caches in %.3f km distance to %s" % (c2, c1)
             print "* Approximation: Caches between %s and %s" % (new_c1, new_c2)
             self.caches, self.new_caches = self.core.download_overview((new_c1, new_c2), sync=True, skip_callback = skip_callback)
+            # Drop the geocaches in the corners of the box, also from the new ones (see --new)
+            self.add_filter_in(c1, c2)
+            inside = set(x.name for x in self.caches)
+            self.new_caches = [x for x in self.new_caches if x.name in inside]
 
     def import_points_route(self, c1, c2, r):
         print "* Querying OpenRouteService for route from startpoint to endpoint"
@@ -558,7 +678,8 @@ class Cli():
         if isinstance(coord2, geo.Coordinate):
             self.caches = filter(lambda x: self.filter_in(coord1, coord2, x), self.caches)
         else:
-            self.caches = filter(lambda x: self.filter_in_radius(coord1, coord2, x), self.caches)
+            distances = geo.distances_from(coord1, [x.lat for x in self.caches], [x.lon for x in self.caches])
+            self.caches = [x for x, d in zip(self.caches, distances) if d <= coord2 * 1000]
         print "* filter in radius/coordinates: %d left" % len(self.caches)
         
     def filter_in(self, c1, c2, check):
@@ -568,9 +689,6 @@ class Cli():
             and check.lon < max(c1.lon, c2.lon))
             
             
-    def filter_in_radius(self, coord1, radius, check):
-        return check.distance_to(coord1) <= radius * 1000
-            
     def add_filter_found(self, found):
         self.caches = filter(lambda x: x.found == found, self.caches)
         print "* filter width found: %d left" % len(self.caches)
@@ -633,6 +751,16 @@ class Cli():
         self.caches = filter(lambda x: self.get_string_filter(attribute)(x.attributes), self.caches)
         print "* filter with attribute: %d left" % len(self.caches)
         
+    def add_filter_text(self, text):
+        self.pointprovider.use_filter(provider.Filter())
+        matches = self.pointprovider.get_points_search(text, max_results = -1)
+        if self.caches == None:
+            self.caches = matches
+        else:
+            names = set(x.name for x in matches)
+            self.caches = [x for x in self.caches if x.name in names]
+        print "* filter with text: %d left" % len(self.caches)
+
     def get_string_filter(self, searchstring):
         if searchstring.startswith('r:'):
             matcher = re.compile(searchstring[2:])
@@ -43,6 +43,7 @@ import downloader
 import geocaching
 import gpsreader
 from os import path, mkdir, extsep, remove, walk
+import prefetch
 import provider
 from threading import Thread
 import cachedownloader
@@ -119,6 +120,7 @@ class Core(gobject.GObject):
     CACHES_DB = path.join(SETTINGS_DIR, "caches.db")
     COOKIE_FILE = path.join(SETTINGS_DIR, "cookies.lwp")
     UPDATE_DIR = path.join(SETTINGS_DIR, 'updates')
+    PREFETCH_JOB_FILE = path.join(SETTINGS_DIR, 'prefetch.job')
 
     MAEMO_HOME = path.expanduser(path.join('~', 'MyDocs', '.'))
     MAPS_DIR = path.join('Maps', '')
@@ -128,7 +130,16 @@ class Core(gobject.GObject):
     UPDATE_MODULES = [cachedownloader]
     
     updating_lock = threading.Lock()
-    _geocache_by_name_event = threading.Event()
+    # Geocaches which were downloaded by the current download, but are not stored yet
+    # (see on_geocache_downloaded), and the names of those which were stored already.
+    _downloaded_geocaches = []
+    _downloaded_geocaches_lock = threading.Lock()
+    _stored_geocache_names = set()
+    # Names of geocaches which were added to the database by _store_downloaded_geocaches
+    # while the current download is still running.
+    _new_geocache_names = set()
+    # Number of downloaded geocaches which are stored at once; one page of the search results
+    DOWNLOAD_STORE_BATCH = 20
     
     DEFAULT_SETTINGS = {
         'download_visible': True,
@@ -171,6 +182,16 @@ class Core(gobject.GObject):
         'debug_log_to_http': False,
         'options_backend': 'geocaching-com-new',
         'options_redownload_after': 14,
+        'options_compress_database': False,
+        'download_concurrency': 4,
+        'download_politeness_delay': 0.5,
+        'download_pool_size': 4,
+        'download_pool_idle_timeout': 30,
+        'map_tile_cache_size': 16 * 1024 * 1024,
+        'map_revalidate_after': 30,
+        'map_revalidate_interval': 1,
+        'prefetch_concurrency': 4,
+        'prefetch_max_bandwidth': 0,
     }
             
     def __init__(self, guitype, gpstype, extensions):
@@ -205,9 +226,9 @@ class Core(gobject.GObject):
         self.create_recursive(self.settings['download_output_dir'])
         self.create_recursive(self.settings['download_map_path'])
         
-        self.downloader = downloader.FileDownloader(self.COOKIE_FILE)
+        self.downloader = downloader.FileDownloader(self.COOKIE_FILE, pool_size = self.settings['download_pool_size'], pool_idle_timeout = self.settings['download_pool_idle_timeout'])
                 
-        self.pointprovider = provider.PointProvider(self.CACHES_DB, geocaching.GeocacheCoordinate)
+        self.pointprovider = provider.ThreadedPointProvider(self.CACHES_DB, geocaching.GeocacheCoordinate, stubtype = geocaching.GeocacheStub, clustertype = geocaching.GeocacheCluster, compress = self.settings['options_compress_database'])
 
         self.gui = guitype(self)
         
@@ -375,7 +396,6 @@ class Core(gobject.GObject):
             pass
             
             
-        from urllib import urlretrieve
         from urllib2 import HTTPError
         import tempfile
         import hashlib
@@ -409,7 +429,7 @@ class Core(gobject.GObject):
             for md5sum, name, temp in files:
                 url = '%s/%s' % (baseurl, name)
                 try:
-                    urlretrieve(url, temp)
+                    self.downloader.download_file(url, temp)
                 except Exception, e:
                     logging.exception(e)
                     raise Exception("Could not download file '%s'" % name)
@@ -472,9 +492,15 @@ class Core(gobject.GObject):
         '''
         logger.debug("Settings where changed by %s." % source)
         
-        if 'options_backend' in settings or 'download_output_dir' in settings or 'download_noimages' in settings:
+        if 'options_backend' in settings or 'download_output_dir' in settings or 'download_noimages' in settings \
+            or 'download_concurrency' in settings or 'download_politeness_delay' in settings:
             self.__install_cachedownloader()
             
+        if 'download_pool_size' in settings:
+            self.downloader.pool.size = settings['download_pool_size']
+        if 'download_pool_idle_timeout' in settings:
+            self.downloader.pool.idle_timeout = settings['download_pool_idle_timeout']
+            
         if source == self:
             return
         if 'options_username' in settings:
@@ -509,6 +535,7 @@ class Core(gobject.GObject):
         logger.debug("Somebody is being killed, saving the settings.")
         self.emit('save-settings')
         self.__write_config()
+        logger.info("Query cache: %(hits)d hits, %(misses)d misses (%(hit_rate).2f), %(queries)d queries (%(mean_time).1f ms), %(tiles)d tiles, %(points)d geocaches" % self.pointprovider.get_query_cache_statistics())
 
 
     def __read_config(self):
@@ -550,11 +577,13 @@ class Core(gobject.GObject):
             for handler in self.__cachedownloader_signal_handlers:
                 self.cachedownloader.disconnect(handler)
         self.__cachedownloader_signal_handlers = []
-        self.cachedownloader = cachedownloader.get(self.settings['options_backend'], self.downloader, self.settings['download_output_dir'], not self.settings['download_noimages'])
+        self.cachedownloader = cachedownloader.get(self.settings['options_backend'], self.downloader, self.settings['download_output_dir'], not self.settings['download_noimages'], 
+            concurrency = self.settings['download_concurrency'], politeness_delay = self.settings['download_politeness_delay'])
         a = self.cachedownloader.connect("download-error", self.on_download_error)
         b = self.cachedownloader.connect("already-downloading-error", self.on_already_downloading_error)
         c = self.cachedownloader.connect('progress', self.on_download_progress)
-        self.__cachedownloader_signal_handlers = [a, b, c]
+        d = self.cachedownloader.connect('geocache-downloaded', self.on_geocache_downloaded)
+        self.__cachedownloader_signal_handlers = [a, b, c, d]
 
     ##############################################
     #
@@ -670,20 +699,53 @@ class Core(gobject.GObject):
         return out
 
 
+    ##############################################
+    #
+    # Map Tile Prefetching
+    #
+    ##############################################
+
+    def get_tile_prefetcher(self, areas = None, zooms = None, map_name = None, progress_callback = None):
+        """
+        Create a TilePrefetcher which downloads the tiles of the map provider
+        map_name (default: the first one) for a list of areas and zoom levels.
+        
+        If areas is None, the unfinished prefetch job is resumed instead.
+        """
+        if areas == None:
+            map_name = prefetch.TilePrefetcher.get_job_name(self.PREFETCH_JOB_FILE)
+        name, tile_loader = prefetch.make_tile_loader(self.settings['map_providers'], self.settings['download_map_path'], map_name, self.downloader)
+        kwargs = {
+            'concurrency': self.settings['prefetch_concurrency'],
+            'max_bandwidth': self.settings['prefetch_max_bandwidth'],
+            'progress_callback': progress_callback,
+        }
+        if areas == None:
+            return prefetch.TilePrefetcher.resume(tile_loader, self.PREFETCH_JOB_FILE, **kwargs)
+        return prefetch.TilePrefetcher(tile_loader, areas, zooms, self.PREFETCH_JOB_FILE, name = name, **kwargs)
+        
+    def has_unfinished_prefetch(self):
+        return path.exists(self.PREFETCH_JOB_FILE)
+
+
     ##############################################
     #
     # Filters, Searching & Pointprovider
     #
     ##############################################
                 
-    def set_filter(self, found=None, owner_search='', name_search='', size=None, terrain=None, diff=None, ctype=None, location=None, marked=None):
+    def set_filter(self, found=None, owner_search='', name_search='', size=None, terrain=None, diff=None, ctype=None, location=None, marked=None, filter=None):
         """
         Sets a new filter for the pointprovider. 
         
         Is mainly used to filter the map display. (Currently only in hildongui_plugins)
+        filter -- A provider.Filter to apply instead of the other criteria.
         
         """
-        self.pointprovider.set_filter(found=found, owner_search=owner_search, name_search=name_search, size=size, terrain=terrain, diff=diff, ctype=ctype, marked=marked)
+        if filter != None:
+            self.pointprovider.use_filter(filter)
+        else:
+            self.pointprovider.set_filter(found=found, owner_search=owner_search, name_search=name_search, size=size, terrain=terrain, diff=diff, ctype=ctype, marked=marked)
         self.emit('map-marks-changed')
                 
     def reset_filter(self):
@@ -696,41 +758,91 @@ class Core(gobject.GObject):
         self.pointprovider.set_filter()
         self.emit('map-marks-changed')
 
-    def get_points_filter(self, found=None, owner_search='', name_search='', size=None, terrain=None, diff=None, ctype=None, location=None, marked=None, preserve_filter = False):
+    def get_points_filter(self, found=None, owner_search='', name_search='', size=None, terrain=None, diff=None, ctype=None, location=None, marked=None, preserve_filter = False, center=None, radius=None, text_search=None, filter=None):
         """
         Performs a search according to the given criteria and returns the geocaches. Also returns information on whether the result was truncated due to the maximum number of search results configured in pointprovider.
         preserve_filter -- Apply the filter and keep it active after this method. If set to False, the filtering remains unchanged after the method call.
+        center, radius -- Search only within radius (in meters) around center, nearest geocaches first. Replaces location.
+        text_search -- Words to search for in the title, owner, descriptions, hints and logs, best matches first (see PointProvider.get_points_search).
+        filter -- A provider.Filter to apply instead of the other criteria.
         
         """
         if not preserve_filter:
             self.pointprovider.push_filter()
-        self.pointprovider.set_filter(found=found, owner_search=owner_search, name_search=name_search, size=size, terrain=terrain, diff=diff, ctype=ctype, marked=marked)
-        points = self.pointprovider.get_points_filter(location)
+        if filter != None:
+            self.pointprovider.use_filter(filter)
+        else:
+            self.pointprovider.set_filter(found=found, owner_search=owner_search, name_search=name_search, size=size, terrain=terrain, diff=diff, ctype=ctype, marked=marked)
+        if center != None:
+            points = self.pointprovider.get_points_within(center, radius)
+        elif text_search != None:
+            points = self.pointprovider.get_points_search(text_search, location)
+        else:
+            points = self.pointprovider.get_points_filter(location)
         truncated = (len(points) >= self.pointprovider.MAX_RESULTS)
         if not preserve_filter:
             self.pointprovider.pop_filter()
         return (points, truncated)
 
 
+    @staticmethod
+    def _load_stubs(caches):
+        """
+        Fully load geocache stubs (e.g., from the map) before they are handed over to another thread.
+        
+        """
+        for c in caches:
+            if isinstance(c, geocaching.GeocacheStub):
+                c.load()
+
     def get_geocache_by_name(self, name):
         """
-        Return a geocache by its ID.
+        Return a geocache by its ID. May be called from any thread.
         
         """
         return self.pointprovider.get_by_name(name)
 
+    def set_database_compression(self, compress, progress_callback = None):
+        """
+        Store the descriptions, logs, waypoints and images of the geocaches compressed (or uncompressed) and convert the existing geocaches, see PointProvider.set_compression.
+        
+        Returns the number of geocaches which were converted.
+        
+        """
+        converted = self.pointprovider.set_compression(compress, progress_callback)
+        self.save_settings({'options_compress_database': compress}, self)
+        return converted
+
+    def get_geocache_states(self, names):
+        """
+        Return the (found, updated) states of the geocaches with the given IDs which are in the database, see PointProvider.get_states. May be called from any thread.
+        
+        """
+        return self.pointprovider.get_states(names)
+
     ##############################################
     #
     # Downloading
     #
     ##############################################
     
-    def _download_upload_helper(self, action, then, *args, **kwargs):
+    def _download_upload_helper(self, action, store, then, *args, **kwargs):
+        """
+        Run action in the current (download) thread, then store the result in the database (if store is not None) in the same thread and call then with it in the main loop.
+        
+        """
         with Core.updating_lock:
             self._check_auto_update()
             # Problem: self.cachedownloader may change in between. What to do?
             # One solution: Use eval to get the function name
-            res = eval(action)(*args, **kwargs)
+            self._clear_downloaded_geocaches()
+            try:
+                res = eval(action)(*args, **kwargs)
+            finally:
+                # Don't lose the geocaches which were downloaded before a failure
+                self._store_downloaded_geocaches()
+            if store != None:
+                res = store(res)
             gobject.idle_add(then, res)
 
     def _check_auto_update(self):
@@ -747,31 +859,47 @@ class Core(gobject.GObject):
         
         location -- Geographic boundaries (see cachedownloader.get_overview for details)
         sync -- Perform actions synchronized, i.e., don't use threads.
-        skip_callback -- A callback function which gets the geocache id and its found status as input. If it returns true, the geocache's details are not downloaded.
+        skip_callback -- A callback function which gets the geocache id, its state in the database (see get_geocache_states, None if it is not in the database) and its found status as input. If it returns true, the geocache's details are not downloaded.
         """
         if not sync:                
-            t = Thread(target=self._download_upload_helper, args=['self.cachedownloader.get_overview', self._download_overview_complete, location, self.get_geocache_by_name_async, skip_callback])
+            t = Thread(target=self._download_upload_helper, args=['self.cachedownloader.get_overview', self._store_overview, self._download_overview_complete, location, self.get_geocache_states, self.get_geocache_by_name, skip_callback])
             t.daemon = True
             t.start()
             return False
         else:
-            return self._download_overview_complete(self.cachedownloader.get_overview(location, self.get_geocache_by_name, skip_callback), True)
+            self._clear_downloaded_geocaches()
+            try:
+                caches = self.cachedownloader.get_overview(location, self.get_geocache_states, self.get_geocache_by_name, skip_callback)
+            finally:
+                self._store_downloaded_geocaches()
+            return self._download_overview_complete(self._store_overview(caches), True)
+
+    def _store_overview(self, caches):
+        """
+        Store the geocaches downloaded by download_overview, returns them and the new geocaches among them.
+        
+        The downloaded geocaches were stored already, so only the remaining ones (whose found status changed) are written here.
+        
+        """
+        self._store_downloaded_geocaches()
+        remaining = [c for c in caches if c.name not in self._stored_geocache_names]
+        new_names = []
+        if len(remaining) > 0:
+            new_names, updated_names = self.pointprovider.add_points(remaining)
+            self.pointprovider.save()
+        new_names = set(new_names) | self._new_geocache_names
+        self._new_geocache_names.clear()
+        self._stored_geocache_names.clear()
+        return (caches, [c for c in caches if c.name in new_names])
 
-    def _download_overview_complete(self, caches, sync=False):
+    def _download_overview_complete(self, result, sync=False):
         """
         Called upon completion of the download of all geocaches within a boundary.
         
-        caches -- Updated geocache information.
+        result -- Updated geocache information and the new geocaches (see _store_overview).
         sync -- Perform actions synchronized, i.e., don't use threads.
         """
-        new_caches = []
-        for c in caches:
-            self.emit('cache-changed', c)
-            point_new = self.pointprovider.add_point(c)
-            if point_new:
-                new_caches.append(c)
-        self.pointprovider.save()
-        
+        caches, new_caches = result
         for c in caches:
             self.emit('cache-changed', c)
             
@@ -790,23 +918,27 @@ class Core(gobject.GObject):
         sync -- Perform actions synchronized, i.e., don't use threads.
         
         """
+        self._load_stubs([cache])
         if not sync:                
-            t = Thread(target=self._download_upload_helper, args=['self.cachedownloader.update_coordinate', self._download_cache_details_complete, cache, self.settings['download_num_logs']])
+            t = Thread(target=self._download_upload_helper, args=['self.cachedownloader.update_coordinate', self._store_cache_details, self._download_cache_details_complete, cache, self.settings['download_num_logs']])
             t.daemon = True
             t.start()
             #t.join()
             return False
         else:
             full = self.cachedownloader.update_coordinate(cache, self.settings['download_num_logs'])
-            return self._download_cache_details_complete(full, sync)
+            return self._download_cache_details_complete(self._store_cache_details(full), sync)
+
+    def _store_cache_details(self, cache):
+        self.pointprovider.add_point(cache, True)
+        self.pointprovider.save()
+        return cache
 
     def _download_cache_details_complete(self, cache, sync = False):
         """
         Called when a single geocache was successfully downloaded.
 
         """
-        self.pointprovider.add_point(cache, True)
-        self.pointprovider.save()
         self.emit('hide-progress')
         self.emit('cache-changed', cache)
         if not sync:
@@ -856,13 +988,30 @@ class Core(gobject.GObject):
         caches -- List of geocaches
         
         """
+        self._load_stubs(caches)
         if not sync:
-            t = Thread(target=self._download_upload_helper, args=['self.cachedownloader.update_coordinates', self._download_cache_details_list_complete, caches, self.settings['download_num_logs']])
+            t = Thread(target=self._download_upload_helper, args=['self.cachedownloader.update_coordinates', self._store_cache_details_list, self._download_cache_details_list_complete, caches, self.settings['download_num_logs']])
             t.daemon = True
             t.start()
             return False
         else:
-            return self._download_cache_details_list_complete(self.cachedownloader.update_coordinates(caches))
+            self._clear_downloaded_geocaches()
+            try:
+                caches = self.cachedownloader.update_coordinates(caches)
+            finally:
+                self._store_downloaded_geocaches()
+            return self._download_cache_details_list_complete(self._store_cache_details_list(caches))
+
+    def _store_cache_details_list(self, caches):
+        # The downloaded geocaches were stored already
+        self._store_downloaded_geocaches()
+        remaining = [c for c in caches if c.name not in self._stored_geocache_names]
+        if len(remaining) > 0:
+            self.pointprovider.add_points(remaining, True)
+            self.pointprovider.save()
+        self._new_geocache_names.clear()
+        self._stored_geocache_names.clear()
+        return caches
         
     def _download_cache_details_list_complete(self, caches):
         """
@@ -871,9 +1020,6 @@ class Core(gobject.GObject):
         caches -- List of geocaches
         
         """
-        for c in caches:
-            self.pointprovider.add_point(c, True)
-        self.pointprovider.save()
         self.emit('hide-progress')
         for c in caches:
             self.emit('cache-changed', c)
@@ -894,6 +1040,49 @@ class Core(gobject.GObject):
         self.emit('progress', float(i) / float(max_i), "%s..." % text)
         return False
 
+    def on_geocache_downloaded(self, something, cache):
+        """
+        Signal handler which is called by the downloading thread for each geocache as soon as it was downloaded.
+        
+        The geocache is queued and stored by the downloading thread together with the next geocaches (see _store_downloaded_geocaches), so that a cancelled or failed download does not lose the finished geocaches. User data in the database is kept.
+        
+        """
+        with self._downloaded_geocaches_lock:
+            self._downloaded_geocaches.append(cache)
+            full = len(self._downloaded_geocaches) >= self.DOWNLOAD_STORE_BATCH
+        if full:
+            self._store_downloaded_geocaches()
+        gobject.idle_add(self._emit_cache_changed, cache)
+
+    def _clear_downloaded_geocaches(self):
+        """
+        Forget the geocaches which were stored by a previous (possibly failed) download.
+        
+        """
+        with self._downloaded_geocaches_lock:
+            del self._downloaded_geocaches[:]
+            self._stored_geocache_names.clear()
+            self._new_geocache_names.clear()
+
+    def _store_downloaded_geocaches(self):
+        """
+        Store the queued geocaches from on_geocache_downloaded at once.
+        
+        """
+        with self._downloaded_geocaches_lock:
+            caches = self._downloaded_geocaches[:]
+            del self._downloaded_geocaches[:]
+            if len(caches) == 0:
+                return
+            new_names, updated_names = self.pointprovider.add_points(caches)
+            self.pointprovider.save()
+            self._new_geocache_names.update(new_names)
+            self._stored_geocache_names.update(c.name for c in caches)
+
+    def _emit_cache_changed(self, cache):
+        self.emit('cache-changed', cache)
+        return False
+
     def on_already_downloading_error(self, something, error):
         """
         Signal handler which is called when the downloading thread cannot download because someone else is still downloading.
@@ -911,44 +1100,32 @@ class Core(gobject.GObject):
         self.emit('hide-progress')
         self.emit('error', extra_message)
     
-    def default_download_skip_callback(self, geocache, found):
+    def default_download_skip_callback(self, name, state, found):
         """
         This is a default callback for skip_callback in download_overview. 
         
         This callback is called after the cachedownloader fetched a list of geocaches which are in a certain area and before it actually downloads the geocache's details. If the callback returns True, the cachedownloader will skip downloading details. It reads the settings and acts accordingly.
         
-        geocache -- is None or the geocache which was fetched from the database before its details were updated
+        name -- the ID of the geocache
+        state -- is None or the (found, updated) state of the geocache in the database before its details were updated (see get_geocache_states)
         found -- the (new) found status, as read from the web page
         
         """
         if self.settings['download_notfound'] and found:
             logger.debug("Geocache is marked as found, skipping!")
             return True
-        if geocache == None or geocache.get_updated() == None: 
-            logger.debug("Geocache %r was not in the database or had no update timestamp." % geocache)
+        if state == None or state[1] == 0: 
+            logger.debug("Geocache %s was not in the database or had no update timestamp." % name)
             return False # When the geocache is not in the database or when it was downloaded before we introduced timestamps, don't skip!
         if self.settings['options_redownload_after'] > 0:
-            diff = datetime.now() - geocache.get_updated() 
+            diff = datetime.now() - datetime.fromtimestamp(state[1])
             if diff.days >= self.settings['options_redownload_after']:
-                logger.debug("Geocache %s was not updated for %d days. It's time!" % (geocache.name, diff.days))
+                logger.debug("Geocache %s was not updated for %d days. It's time!" % (name, diff.days))
                 return False
-            logger.debug("Geocache %s was not updated for %d days. That's fine." % (geocache.name, diff.days))
+            logger.debug("Geocache %s was not updated for %d days. That's fine." % (name, diff.days))
             return True
         return False
         
-    def get_geocache_by_name_async(self, id):
-        self._geocache_by_name_event.clear()
-        gobject.idle_add(self._get_geocache_by_name_async_idle, id, priority=gobject.PRIORITY_HIGH)
-        res = self._geocache_by_name_event.wait(1)
-        if res == False:
-            logger.error("Screw it!")
-            return None
-        return self._geocache_by_name_result
-        
-    def _get_geocache_by_name_async_idle(self, id):
-        self._geocache_by_name_result = self.get_geocache_by_name(id)
-        self._geocache_by_name_event.set()
-
     ##############################################
     #
     # Exporting
@@ -1002,7 +1179,7 @@ class Core(gobject.GObject):
         """
         caches = self.pointprovider.get_new_fieldnotes()
         
-        t = Thread(target=self._download_upload_helper, args=['self.cachedownloader.upload_fieldnotes', self._upload_fieldnotes_complete, caches])
+        t = Thread(target=self._download_upload_helper, args=['self.cachedownloader.upload_fieldnotes', None, self._upload_fieldnotes_complete, caches])
         t.daemon = True
         t.start()
         
@@ -25,10 +25,17 @@ from __future__ import with_statement
 import logging
 logger = logging.getLogger('downloader')
 import connection
+import socket
+import zlib
 from sys import argv
-from urllib2 import build_opener, install_opener, HTTPCookieProcessor, HTTPHandler
-from urllib2 import Request, urlopen
-from urllib import urlencode
+from threading import Lock
+from os import path as os_path
+from hashlib import sha1
+from time import time
+from httplib import HTTPConnection, HTTPSConnection, HTTPException, HTTPMessage
+from urllib2 import build_opener, install_opener, HTTPCookieProcessor, HTTPHandler, HTTPSHandler, AbstractHTTPHandler
+from urllib2 import Request, URLError
+from urllib import urlencode, addinfourl
 from cookielib import LWPCookieJar
 
 
@@ -42,11 +49,250 @@ def enable_http_debugging():
     logger.info("Writing debug HTTP logs.")
     
 
+class ConnectionPool():
+    '''
+    Keeps idle HTTP and HTTPS connections open, so that subsequent requests
+    to the same host do not need a new TCP (and TLS) handshake.
+    
+    '''
+    
+    def __init__(self, size = 4, idle_timeout = 30):
+        '''
+        size -- Maximum number of idle connections which are kept per host.
+        idle_timeout -- Time in seconds after which idle connections are discarded.
+        
+        '''
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.lock = Lock()
+        self.idle = {}
+        # Counters for the number of new and reused connections
+        self.created = 0
+        self.reused = 0
+        
+    def get(self, key, timeout, reuse = True):
+        '''
+        Return a tuple (connection, reused) for key, a (scheme, host, tunnel_host) tuple.
+        
+        reuse -- If False, a new connection is opened even if there is an idle one.
+        
+        '''
+        expired = []
+        try:
+            with self.lock:
+                connections = self.idle.get(key, []) if reuse else []
+                while len(connections) > 0:
+                    conn, since = connections.pop()
+                    if time() - since < self.idle_timeout:
+                        self.reused += 1
+                        return conn, True
+                    expired.append(conn)
+                self.created += 1
+        finally:
+            for conn in expired:
+                conn.close()
+        scheme, host, tunnel_host = key
+        if scheme == 'https':
+            conn = HTTPSConnection(host, timeout = timeout)
+        else:
+            conn = HTTPConnection(host, timeout = timeout)
+        if tunnel_host != None:
+            conn.set_tunnel(tunnel_host)
+        return conn, False
+        
+    def put(self, key, conn):
+        '''
+        Hand back a connection whose last response was read completely.
+        
+        '''
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.size:
+                connections.append((conn, time()))
+                return
+        conn.close()
+        
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for conn, since in connections:
+                conn.close()
+                
+    def get_statistics(self):
+        '''
+        Return a dictionary with the number of created, reused and currently idle connections.
+        
+        '''
+        with self.lock:
+            return {
+                'created': self.created,
+                'reused': self.reused,
+                'idle': sum(len(x) for x in self.idle.values()),
+            }
+            
+        
+class PooledResponse():
+    '''
+    Socket-like wrapper for a httplib.HTTPResponse.
+    
+    The connection is handed back to the pool as soon as the response has been read completely.
+    
+    '''
+    def __init__(self, pool, key, connection, response):
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        
+    def recv(self, amt):
+        data = self.response.read(amt)
+        if self.response.isclosed():
+            self.close()
+        return data
+        
+    def close(self):
+        if self.connection == None:
+            return
+        # Responses without body (e.g. 304 Not Modified) need not be read
+        if self.response.length == 0:
+            self.response.close()
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.put(self.key, self.connection)
+        else:
+            # Unread data is left on the connection, so it can't be reused
+            self.response.close()
+            self.connection.close()
+        self.connection = None
+        
+        
+class KeepAliveHandler(HTTPHandler, HTTPSHandler):
+    '''
+    urllib2 handler for HTTP and HTTPS which takes its connections from a ConnectionPool.
+    
+    '''
+    def __init__(self, pool, debuglevel = 0):
+        AbstractHTTPHandler.__init__(self, debuglevel)
+        self.pool = pool
+        
+    def http_open(self, req):
+        return self.do_pooled_open('http', req)
+        
+    def https_open(self, req):
+        return self.do_pooled_open('https', req)
+        
+    def do_pooled_open(self, scheme, req):
+        host = req.get_host()
+        if not host:
+            raise URLError('no host given')
+        key = (scheme, host, getattr(req, '_tunnel_host', None))
+        
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items() if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+        headers['Connection'] = 'keep-alive'
+        # The proxy authorization is sent by set_tunnel, not to the target host
+        headers.pop('Proxy-Authorization', None)
+        
+        # A reused connection may have been closed by the server in the meantime. Then the
+        # request is sent again, but only if that can not do anything twice (e.g. upload
+        # a field note). Other requests get a new connection instead, so they do not fail.
+        idempotent = req.get_method() in ('GET', 'HEAD')
+        while True:
+            conn, reused = self.pool.get(key, req.timeout, reuse = idempotent)
+            conn.set_debuglevel(self._debuglevel)
+            try:
+                conn.request(req.get_method(), req.get_selector(), req.get_data(), headers)
+                try:
+                    r = conn.getresponse(buffering = True)
+                except TypeError:
+                    # Python < 2.7
+                    r = conn.getresponse()
+                break
+            except (socket.error, HTTPException), e:
+                conn.close()
+                if not reused:
+                    raise URLError(e)
+                logger.debug("Reused connection to %s failed, retrying with a new one." % host)
+                
+        fp = socket._fileobject(PooledResponse(self.pool, key, conn, r), close = True)
+        resp = addinfourl(fp, r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+    
+    
+class GzipStreamReader():
+    '''
+    File-like object which decompresses a gzip encoded response while it is read.
+    
+    At most chunk_size bytes of compressed and of decompressed data are held in
+    memory at any time, unless more than that is requested by a single read().
+    
+    '''
+    def __init__(self, fileobj, chunk_size):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        # 16 + MAX_WBITS makes zlib expect a gzip header and trailer
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = ''
+        self.eof = False
+        
+    # Decompress the next block if the buffer is empty. Returns False at the end of the stream.
+    def __fill(self):
+        while self.buffer == '' and not self.eof:
+            data = self.decompressor.unconsumed_tail
+            if data == '':
+                data = self.fileobj.read(self.chunk_size)
+                if data == '':
+                    self.buffer = self.decompressor.flush()
+                    self.eof = True
+                    break
+            self.buffer = self.decompressor.decompress(data, self.chunk_size)
+        return self.buffer != ''
+        
+    def read(self, size = -1):
+        parts = []
+        while (size < 0 or size > 0) and self.__fill():
+            if size < 0:
+                part, self.buffer = self.buffer, ''
+            else:
+                part, self.buffer = self.buffer[:size], self.buffer[size:]
+                size -= len(part)
+            parts.append(part)
+        return ''.join(parts)
+        
+    def readline(self):
+        parts = []
+        while self.__fill():
+            pos = self.buffer.find('\n')
+            if pos >= 0:
+                parts.append(self.buffer[:pos + 1])
+                self.buffer = self.buffer[pos + 1:]
+                break
+            parts.append(self.buffer)
+            self.buffer = ''
+        return ''.join(parts)
+        
+    def __iter__(self):
+        return iter(self.readline, '')
+        
+    def close(self):
+        self.fileobj.close()
+        
+        
 class FileDownloader():
     USER_AGENT = 'User-Agent: Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/535.19 (KHTML, like Gecko) Ubuntu/12.04 Chromium/18.0.1025.168 Chrome/18.0.1025.168 Safari/535.19'
     opener_installed = False
+    
+    # Number of idle connections kept open per host, and the time in seconds after which they are closed
+    POOL_SIZE = 4
+    POOL_IDLE_TIMEOUT = 30
+    
+    # Size of the blocks in which responses are decompressed, parsed and written to disk
+    CHUNK_SIZE = 16 * 1024
 
-    def __init__(self, cookiefile, core = None):
+    def __init__(self, cookiefile, core = None, pool_size = POOL_SIZE, pool_idle_timeout = POOL_IDLE_TIMEOUT):
         self.cookiefile = cookiefile
         self.logged_in = False
         from socket import setdefaulttimeout
@@ -57,15 +303,18 @@ class FileDownloader():
         # as provided by some mobile operators.
         self.allow_minified_answers = True
         
+        # Directories to record responses to or to replay them from, see record_to and replay_from
+        self.record_path = None
+        self.replay_path = None
+        
         
         self.cj = LWPCookieJar(self.cookiefile)
 
         
-        if DEBUG_HTTP:
-            opener = build_opener(HTTPHandler(debuglevel=1), HTTPCookieProcessor(self.cj))
-        else:
-            opener = build_opener(HTTPCookieProcessor(self.cj))
-        install_opener(opener)
+        # All requests (geocaching websites, images, map tiles, geonames) share this pool
+        self.pool = ConnectionPool(pool_size, pool_idle_timeout)
+        self.opener = build_opener(KeepAliveHandler(self.pool, debuglevel = 1 if DEBUG_HTTP else 0), HTTPCookieProcessor(self.cj))
+        install_opener(self.opener)
 
         try:
             self.cj.load()
@@ -95,18 +344,93 @@ class FileDownloader():
                 logger.error("Could not remove cookie file?!")
                 pass
 
-    def get_reader(self, url, values=None, data=None):
+    # login is accepted for compatibility with callers which don't need to be logged in;
+    # this class never logs in by itself.
+    def get_reader(self, url, values=None, data=None, login=True):
+        return self.__fetch(url, values, data)[1]
+        
+    def download_file(self, url, filename):
+        '''
+        Download url to the file filename and return the response headers.
+        
+        '''
+        headers, reader = self.__fetch(url)
+        try:
+            with open(filename, 'wb') as f:
+                while True:
+                    data = reader.read(self.CHUNK_SIZE)
+                    if not data:
+                        break
+                    f.write(data)
+        except Exception:
+            from os import remove
+            try:
+                remove(filename)
+            except OSError:
+                pass
+            raise
+        finally:
+            reader.close()
+        return headers
+        
+    def fetch(self, url, values=None, data=None, headers=None):
+        '''
+        Return the response headers and a reader for the decoded response body.
+        
+        headers is a dict of additional request headers. Responses with an
+        error status (including 304 Not Modified) raise an urllib2.HTTPError.
+        
+        '''
+        return self.__fetch(url, values, data, headers)
+        
+    def get_connection_statistics(self):
+        return self.pool.get_statistics()
+        
+    def record_to(self, path):
+        '''
+        Save all responses to the directory path, so that they can be replayed
+        later on (see replay_from). Responses are stored decoded.
+        
+        '''
+        self.record_path = path
+        self.replay_path = None
+        
+    def replay_from(self, path):
+        '''
+        Answer all requests from the responses recorded to the directory path,
+        without connecting to the network. Requests which were not recorded
+        raise an exception.
+        
+        '''
+        self.replay_path = path
+        self.record_path = None
+        
+    # Return the response headers and a reader for the decoded response body
+    def __fetch(self, url, values=None, data=None, headers=None):
+        req = self.__make_request(url, values, data)
+        if headers != None:
+            for name, value in headers.items():
+                req.add_header(name, value)
+        if self.replay_path != None:
+            return self.__replay(req)
+            
         if connection.offline:
             raise Exception("Can't connect in offline mode.")
 
         logger.info("Sending request to %s" % url)
+        self.debug_request(req)
+        resp = self.opener.open(req)
+        headers = resp.info()
+        reader = self.__decode(resp)
+        if self.record_path != None:
+            reader = self.__record(req, headers, reader)
+        return headers, reader
         
+    def __make_request(self, url, values=None, data=None):
         # No additional parameters or data
         if values == None and data == None:
             req = Request(url)
             self.add_headers(req)
-            self.debug_request(req)
-            resp = urlopen(req)
 
         # There are only URL parameters, expected in values
         elif data == None:
@@ -114,8 +438,6 @@ class FileDownloader():
                 values = urlencode( values)
             req = Request(url, values)
             self.add_headers(req)
-            self.debug_request(req)
-            resp = urlopen(req)
             
         # There are no URL parameters, but a content_type, body tuple in data
         elif values == None:
@@ -125,18 +447,39 @@ class FileDownloader():
             req.add_header('Content-Length', len(str(body)))
             self.add_headers(req)
             req.add_data(body)
-            self.debug_request(req)
-            resp = urlopen(req)
+        return req
+        
+    def __decode(self, resp):
         if resp.info().get('Content-Encoding') == 'gzip':
-            from StringIO import StringIO
-            import gzip
-            buf = StringIO(resp.read())
             logger.debug("Got gzip encoded answer")
-            resp = gzip.GzipFile(fileobj=buf)
+            resp = GzipStreamReader(resp, self.CHUNK_SIZE)
         else:
             logger.debug("Got unencoded answer")
         resp = self.debug_response(resp)
         return resp
+        
+    # Recorded requests are identified by method, URL and data. If the same
+    # request was sent more than once, the last response is replayed.
+    @staticmethod
+    def __recording_name(req):
+        return sha1("%s %s\n%s" % (req.get_method(), req.get_full_url(), req.get_data() or '')).hexdigest()
+        
+    def __record(self, req, headers, reader):
+        name = os_path.join(self.record_path, self.__recording_name(req))
+        logger.debug("Recording %s to %s" % (req.get_full_url(), name))
+        self.write_request(req, '%s-REQUEST.txt' % name)
+        with open('%s-HEADERS.txt' % name, 'w') as f:
+            f.write(str(headers))
+        return self.write_response(reader, '%s-RESPONSE.txt' % name)
+        
+    def __replay(self, req):
+        name = os_path.join(self.replay_path, self.__recording_name(req))
+        if not os_path.exists('%s-RESPONSE.txt' % name):
+            raise Exception("No recorded response for %s %s" % (req.get_method(), req.get_full_url()))
+        logger.info("Replaying %s from %s" % (req.get_full_url(), name))
+        with open('%s-HEADERS.txt' % name) as f:
+            headers = HTTPMessage(f)
+        return headers, open('%s-RESPONSE.txt' % name, 'rb')
             
     def debug_request(self, req):
         global DEBUG_HTTP
@@ -147,10 +490,7 @@ class FileDownloader():
         path = join(DEBUG_PATH, '%d-REQUEST.txt' % DEBUG_COUNTER)
         logger.debug("Writing debug HTTP request to %s" % path)
         DEBUG_COUNTER += 1
-        with open(path, 'w') as f:
-            f.write("%s %s\n" % (req.get_method(), req.get_full_url()))
-            f.write("%s\n" % repr(req.header_items()))
-            f.write("\n\n%s" % repr(req.get_data()))
+        self.write_request(req, path)
                 
     def debug_response(self, resp):
         global DEBUG_HTTP
@@ -161,9 +501,25 @@ class FileDownloader():
         path = join(DEBUG_PATH, '%d-RESPONSE.txt' % DEBUG_COUNTER)
         logger.debug("Writing debug HTTP response to %s" % path)
         DEBUG_COUNTER += 1
+        return self.write_response(resp, path)
+        
+    @staticmethod
+    def write_request(req, path):
         with open(path, 'w') as f:
-            f.write(resp.read())    
-        return open(path, 'r')
+            f.write("%s %s\n" % (req.get_method(), req.get_full_url()))
+            f.write("%s\n" % repr(req.header_items()))
+            f.write("\n\n%s" % repr(req.get_data()))
+            
+    # Copy resp to the file path, and return the file opened for reading
+    def write_response(self, resp, path):
+        with open(path, 'wb') as f:
+            while True:
+                data = resp.read(self.CHUNK_SIZE)
+                if not data:
+                    break
+                f.write(data)
+        resp.close()
+        return open(path, 'rb')
             
     def encode_multipart_formdata(self, fields, files):
         """
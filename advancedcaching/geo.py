@@ -22,6 +22,10 @@
 
 import math
 import re
+try:
+    import numpy
+except ImportError:
+    numpy = None
 try:
     from location import distance_between
     def distance_to_liblocation(src, target):
@@ -36,8 +40,73 @@ except Exception:
         return Coordinate.RADIUS_EARTH * c;
     distance_to = distance_to_manual
 
+def distances_from(center, lats, lons):
+    '''
+    Return the distances (in meters) from center to the positions given by
+    the sequences lats and lons, as a list.
+
+    Uses NumPy if it is available, so that many positions can be handled at once.
+
+    '''
+    lat1 = math.radians(center.lat)
+    if numpy != None:
+        lat2 = numpy.radians(numpy.asarray(lats, dtype=float))
+        dlat = numpy.sin((lat2 - lat1) / 2) ** 2
+        dlon = numpy.sin(numpy.radians(numpy.asarray(lons, dtype=float) - center.lon) / 2) ** 2
+        a = dlat + math.cos(lat1) * numpy.cos(lat2) * dlon
+        return (2 * Coordinate.RADIUS_EARTH * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1 - a))).tolist()
+    cos_lat1 = math.cos(lat1)
+    result = []
+    for lat, lon in zip(lats, lons):
+        lat2 = math.radians(lat)
+        a = math.sin((lat2 - lat1) / 2) ** 2 + cos_lat1 * math.cos(lat2) * math.sin(math.radians(lon - center.lon) / 2) ** 2
+        result.append(2 * Coordinate.RADIUS_EARTH * math.atan2(math.sqrt(a), math.sqrt(1 - a)))
+    return result
+
+def bearings_from(center, lats, lons):
+    '''
+    Return the bearings (in degrees) from center to the positions given by
+    the sequences lats and lons, as a list. See distances_from.
+
+    '''
+    lat1 = math.radians(center.lat)
+    if numpy != None:
+        lat2 = numpy.radians(numpy.asarray(lats, dtype=float))
+        dlon = numpy.radians(numpy.asarray(lons, dtype=float) - center.lon)
+        y = numpy.sin(dlon) * numpy.cos(lat2)
+        x = math.cos(lat1) * numpy.sin(lat2) - math.sin(lat1) * numpy.cos(lat2) * numpy.cos(dlon)
+        return ((360 + numpy.degrees(numpy.arctan2(y, x))) % 360).tolist()
+    sin_lat1, cos_lat1 = math.sin(lat1), math.cos(lat1)
+    result = []
+    for lat, lon in zip(lats, lons):
+        lat2 = math.radians(lat)
+        dlon = math.radians(lon - center.lon)
+        y = math.sin(dlon) * math.cos(lat2)
+        x = cos_lat1 * math.sin(lat2) - sin_lat1 * math.cos(lat2) * math.cos(dlon)
+        result.append((360 + math.degrees(math.atan2(y, x))) % 360)
+    return result
+
 DEGREES = "°"
 
+# The Web Mercator projection is cut off at this latitude
+MERCATOR_MAX_LAT = 85.0511287798
+
+def mercator(lat, lon):
+    '''
+    Return the normalised Web Mercator position (x, y) of lat/lon, where
+    (0, 0) is the north west and (1, 1) the south east corner of the map.
+
+    '''
+    lat_rad = math.radians(max(-MERCATOR_MAX_LAT, min(MERCATOR_MAX_LAT, lat)))
+    return ((lon + 180.0) / 360.0, (1.0 - math.log(math.tan(lat_rad) + (1.0 / math.cos(lat_rad))) / math.pi) / 2.0)
+
+def mercator_inverse(x, y):
+    '''
+    Return lat/lon of the normalised Web Mercator position (x, y), see mercator.
+
+    '''
+    return (math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y)))), x * 360.0 - 180.0)
+
 def try_parse_coordinate(text):
     
     text = text.strip()
@@ -244,6 +313,13 @@ class Coordinate(object):
         elif format == self.FORMAT_DM:
             return "%s %d%s %06.3f'" % (c, math.floor(l), DEGREES, (l - math.floor(l)) * 60)
 
+    def get_mercator(self):
+        # The projection is kept until the position changes
+        m = getattr(self, '_mercator', None)
+        if m == None or m[0] != self.lat or m[1] != self.lon:
+            m = self._mercator = (self.lat, self.lon) + mercator(self.lat, self.lon)
+        return m[2], m[3]
+
     def get_latlon(self, format = 1): # that is FORMAT_DM
         return "%s %s" % (self.get_lat(format), self.get_lon(format))
 
@@ -28,6 +28,7 @@ except (ImportError, AttributeError):
 from datetime import datetime
 import logging
 import time
+import zlib
 
 import geo
 logger = logging.getLogger('geocaching')
@@ -102,7 +103,17 @@ class GeocacheCoordinate(geo.Coordinate):
     # in them.
     NON_USER_ATTRS = ('lat', 'lon', 'title', 'shortdesc', 'desc', 'hints', 'type', \
              'size', 'difficulty', 'terrain', 'owner', 'found', 'waypoints', \
-             'images', 'logs', 'status', 'attributes', 'updated', 'websitelink')
+             'images', 'logs', 'status', 'attributes', 'updated', 'websitelink', \
+             'merc_x', 'merc_y')
+
+    # The normalised Web Mercator position (see geo.mercator) is stored
+    # along with lat/lon, so that the map doesn't need to project each
+    # geocache again.
+    MERCATOR_ATTRS = ('merc_x', 'merc_y')
+
+    # Large attributes which can be stored compressed (see compress_text).
+    # They are decompressed on first access.
+    COMPRESSED_ATTRS = ('desc', 'logs', 'waypoints', 'images')
 
     SQLROW = {
         'lat': 'REAL',
@@ -135,6 +146,8 @@ class GeocacheCoordinate(geo.Coordinate):
         'attributes' : 'TEXT',
         'last_viewed' : 'INTEGER', # SQLite doesn't have real DATETIME data type
         'websitelink' : 'TEXT',
+        'merc_x' : 'REAL',
+        'merc_y' : 'REAL',
         }
     def __init__(self, lat, lon=None, name='', data=None):
         geo.Coordinate.__init__(self, lat, lon, name)
@@ -199,13 +212,24 @@ class GeocacheCoordinate(geo.Coordinate):
     def get_status(self):
         return self.STATUS_TEXT[self.status] if self.status != None else ''
 
-    def serialize(self):
+    def serialize(self, compressed = ()):
+        """
+        compressed -- Attributes (out of COMPRESSED_ATTRS) which are compressed
+        
+        """
         ret = {}
         for key in self.ATTRS:
-            ret[key] = self.serialize_one(key) 
+            ret[key] = self.serialize_one(key, key in compressed)
+        ret['merc_x'], ret['merc_y'] = self.get_mercator()
         return ret
 
-    def serialize_one(self, attribute):
+    def serialize_one(self, attribute, compress = False):
+        if compress:
+            # Values which were neither accessed nor replaced (see set_waypoints) are still compressed
+            stored = self.__dict__.get('_compressed', {})
+            if attribute in stored and attribute not in self.__dict__ and 'saved_%s' % attribute not in self.__dict__:
+                return stored[attribute]
+            return self.compress_text(self.serialize_one(attribute))
         if attribute == 'found':
             return 1 if self.found else 0
         elif attribute == 'marked':
@@ -226,10 +250,62 @@ class GeocacheCoordinate(geo.Coordinate):
             return getattr(self, attribute)
                 
     def unserialize(self, data):
-        ret = {}
+        self.__dict__ = {}
         for key in self.ATTRS:
-            ret[key] = data[key]
-        self.__dict__ = ret
+            self._set_stored(key, data[key])
+        self._load_mercator(data)
+
+    def _set_stored(self, key, value):
+        """
+        Set an attribute to the value read from the database. Compressed values are decompressed on first access.
+        
+        """
+        if isinstance(value, buffer):
+            self.__dict__.setdefault('_compressed', {})[key] = value
+        else:
+            self.__dict__[key] = value
+
+    def __getattr__(self, name):
+        # Only called if the attribute was not found in the usual places
+        stored = self.__dict__.get('_compressed', None)
+        if stored != None and name in stored:
+            value = self.__dict__[name] = self.decompress_text(stored.pop(name))
+            return value
+        raise AttributeError(name)
+
+    @staticmethod
+    def compress_text(value):
+        """
+        Return the (unicode or UTF-8) text value compressed for storing it in the database.
+        
+        Empty values and values which do not get smaller are returned unchanged, so they can still be compared in SQL (e.g. logs != '').
+        
+        """
+        if value == None or value == '':
+            return value
+        data = value.encode('utf-8') if isinstance(value, unicode) else value
+        compressed = zlib.compress(data)
+        if len(compressed) >= len(data):
+            return value
+        return buffer(compressed)
+
+    @staticmethod
+    def decompress_text(value):
+        """
+        Return the text of a value stored by compress_text; other values are returned unchanged.
+        
+        """
+        if isinstance(value, buffer):
+            return zlib.decompress(value).decode('utf-8')
+        return value
+
+    def _load_mercator(self, data):
+        try:
+            x, y = data['merc_x'], data['merc_y']
+        except (KeyError, IndexError):
+            return
+        if x != None and y != None:
+            self._mercator = (self.lat, self.lon, x, y)
         
     def get_waypoints(self):
         try:
@@ -472,3 +548,83 @@ class GeocacheCoordinate(geo.Coordinate):
         return clist
     
        
+
+
+class GeocacheStub(GeocacheCoordinate):
+    """
+    A geocache of which only the attributes needed for map and list views were read from the database.
+    
+    The remaining (potentially large) attributes, such as the description and the logs, are fetched from the database on first access. Therefore, unless the database can be read from every thread (see provider.ThreadedPointProvider), stubs should only be used from the thread that owns the database connection; call load() before handing a stub to another thread.
+    
+    """
+
+    # Attributes which are not read from the database until they are accessed
+    LAZY_ATTRS = ('shortdesc', 'desc', 'hints', 'waypoints', 'images', 'notes', \
+             'fieldnotes', 'logs', 'vars', 'user_coordinates', 'attributes')
+
+    # Attributes which are read from the database right away
+    STUB_ATTRS = ('lat', 'lon', 'title', 'name', 'type', 'size', 'difficulty', \
+             'terrain', 'owner', 'found', 'logas', 'logdate', 'marked', 'status', \
+             'alter_lat', 'alter_lon', 'updated', 'last_viewed', 'websitelink')
+
+    def __init__(self, data, loader):
+        """
+        data -- Database row containing at least the fields in STUB_ATTRS and 'stub_downloaded' (and optionally those in MERCATOR_ATTRS)
+        loader -- Callable which takes the geocache name and returns a database row containing the fields in LAZY_ATTRS
+        
+        """
+        ret = {}
+        for key in self.STUB_ATTRS:
+            ret[key] = data[key]
+        ret['stub_downloaded'] = data['stub_downloaded']
+        ret['stub_loader'] = loader
+        ret['calc'] = None
+        self.__dict__ = ret
+        self._load_mercator(data)
+
+    def __getattr__(self, name):
+        # Only called if the attribute was not found in the usual places
+        if name in self.LAZY_ATTRS and self.__dict__['stub_loader'] != None:
+            self.load()
+            return getattr(self, name)
+        return GeocacheCoordinate.__getattr__(self, name)
+
+    def load(self):
+        """
+        Read the remaining attributes from the database.
+        
+        """
+        loader = self.__dict__['stub_loader']
+        if loader == None:
+            return
+        data = loader(self.name)
+        stored = self.__dict__.get('_compressed', {})
+        for key in self.LAZY_ATTRS:
+            if key not in self.__dict__ and key not in stored:
+                self._set_stored(key, data[key] if data != None else '')
+        self.stub_loader = None
+
+    def was_downloaded(self):
+        if 'logs' in self.__dict__:
+            return GeocacheCoordinate.was_downloaded(self)
+        return bool(self.stub_downloaded)
+
+
+class GeocacheCluster(geo.Coordinate):
+    """
+    A group of geocaches which are close to each other, as shown on the map at low zoom levels.
+    
+    The coordinate is the mean position of the geocaches.
+    
+    """
+    def __init__(self, lat, lon, count, type, found_ratio):
+        """
+        count -- Number of geocaches in the cluster
+        type -- The most common geocache type in the cluster
+        found_ratio -- Share of the geocaches which have been found (0.0 to 1.0)
+        
+        """
+        geo.Coordinate.__init__(self, lat, lon)
+        self.count = count
+        self.type = type
+        self.found_ratio = found_ratio
@@ -21,6 +21,7 @@
 #
 
 from urllib import quote
+import math
 
 import geo
 try:
@@ -106,24 +107,47 @@ class Geonames():
         # min_distance is in km, we need m
         mdist = (min_distance * 1000.0) / self.DIST_FACTOR
 
+        # The accepted points by their cell in a grid of cubes with an edge of mdist,
+        # see grid_cell. Points closer than mdist are in neighbouring cells.
+        grid = {}
+        cell_size = max(mdist, 1.0)
+
         for s in segments:
             for p in s.childNodes:
                 if p.nodeType != Node.ELEMENT_NODE:
                     continue
                 lon, tmp, lat = p.childNodes[0].data.partition(' ')
                 c = geo.Coordinate(float(lat), float(lon))
-                stop = False
-                for o in route_points:
-                    if c.distance_to(o) < mdist:
-                        stop = True
-                        break
-                if not stop:
+                x, y, z = self.grid_cell(c, cell_size)
+                near = []
+                for dx in (-1, 0, 1):
+                    for dy in (-1, 0, 1):
+                        for dz in (-1, 0, 1):
+                            near.extend(grid.get((x + dx, y + dy, z + dz), ()))
+                if len(near) == 0 or min(geo.distances_from(c, [o.lat for o in near], [o.lon for o in near])) >= mdist:
                     route_points.append(c)
+                    grid.setdefault((x, y, z), []).append(c)
 
                 if len(route_points) > self.MAX_NODES:
                     raise Exception("Too many waypoints! Try a bigger radius.")
         logger.info("Using the following Waypoints:")
         return route_points
 
+    @staticmethod
+    def grid_cell(c, size):
+        '''
+        Return the cell of c in a grid of cubes with an edge of size (in meters)
+        which covers the earth.
+        
+        The grid uses cartesian coordinates, in which the straight distance between
+        two positions is never longer than their distance on the surface.
+        
+        '''
+        lat, lon = math.radians(c.lat), math.radians(c.lon)
+        r = geo.Coordinate.RADIUS_EARTH / size
+        return (int(math.floor(r * math.cos(lat) * math.cos(lon))),
+            int(math.floor(r * math.cos(lat) * math.sin(lon))),
+            int(math.floor(r * math.sin(lat))))
+
 
 
@@ -34,7 +34,6 @@ import gobject
 import gtk
 import openstreetmap
 import pango
-import threadpool
 logger = logging.getLogger('gtkmap')
 from os.path import getsize
 from hashlib import md5
@@ -73,8 +72,6 @@ class Map(gtk.DrawingArea, AbstractMap):
         self.surface_buffer = {}
         self.delay_expose = False
 
-        self.tile_loader_threadpool = threadpool.ThreadPool(openstreetmap.CONCURRENT_THREADS * 2)
-
         #self.ts = openstreetmap.TileServer(self.tile_loader)
 
         self.drawing_area_configured = self.drawing_area_arrow_configured = False
@@ -83,8 +80,11 @@ class Map(gtk.DrawingArea, AbstractMap):
         self.modify_bg(gtk.STATE_NORMAL, gtk.gdk.color_parse("white"))
 
     def shutdown(self):
-        self.tile_loader_threadpool.dismissWorkers(openstreetmap.CONCURRENT_THREADS * 2)
-        self.tile_loader_threadpool.joinAllDismissedWorkers()
+        self.tile_scheduler.stop()
+        openstreetmap.flush_stores()
+        logger.info("Tile cache: %(hits)d hits, %(misses)d misses, %(tiles)d tiles, %(bytes)d bytes" % self.tile_cache.get_statistics())
+        if self.tile_revalidator != None:
+            logger.info("Tile revalidation: %(checked)d checked, %(changed)d changed, %(queued)d queued" % self.tile_revalidator.get_statistics())
 
         ##############################################
         #
@@ -177,12 +177,7 @@ class Map(gtk.DrawingArea, AbstractMap):
             self.relative_zoom(+ 1)
 
     def __drag_start(self, widget, event):
-        try:
-            while True:
-                x = self.active_tile_loaders.pop()
-                x.halt()
-        except IndexError:
-            pass
+        self.tile_scheduler.cancel(self)
 
         cr = self.cr_drawing_area
         cr.set_source_surface(self.cr_drawing_area_map)
@@ -268,15 +263,6 @@ class Map(gtk.DrawingArea, AbstractMap):
             logger.info("Map has no size; skipping map drawing.")
             return
 
-        # Now try to halt all tile loaders.
-        try:
-            while True:
-                x = self.active_tile_loaders.pop()
-                # set the stop bit for the tile loader 
-                x.halt()
-        except IndexError:
-            pass
-            
         # Empty the surface buffer which contains tiles which need to be drawn
         self.surface_buffer = {}
 
@@ -293,10 +279,7 @@ class Map(gtk.DrawingArea, AbstractMap):
         undersample = self.double_size
         # Request stores tiles which need to be downloaded
         requests = []
-        # New surface buffer TODO
         new_surface_buffer = {}
-        # Old surface buffer TODO
-        old_surface_buffer = self.surface_buffer
         # Tiles 
         tiles = []
 
@@ -313,47 +296,51 @@ class Map(gtk.DrawingArea, AbstractMap):
                 # Store known tiles in tiles, because sometimes tiles occur twice
                 # TODO: Fix root cause
                 tiles += tile
-                # Re-Use the old surface buffer if possible.
-                # TODO: Check performance improvement
-                if id_string in old_surface_buffer and old_surface_buffer[id_string][0] != self.tile_loader.noimage_cantload and old_surface_buffer[id_string][0] != self.tile_loader.noimage_loading:
-                    new_surface_buffer[id_string] = old_surface_buffer[id_string]
-                    new_surface_buffer[id_string][1:3] = dx, dy
-                else:
-                    # This tile needs to be downloaded
-                    requests.append(((id_string, tile, zoom, undersample, dx, dy, self._add_to_buffer), {}))
+                d = self.tile_loader(id_string=id_string, tile=tile, zoom=zoom, undersample=undersample, x=dx, y=dy, callback_draw=self._add_to_buffer, callback_load=self._load_tile)
+                # Tiles from the tile cache are drawn right away
+                pbuf = d.get_cached()
+                if pbuf != None:
+                    new_surface_buffer[id_string] = [pbuf[0], dx, dy, pbuf[1]]
+                    continue
+                # Otherwise, show a scaled up tile from a lower zoom level while loading
+                pbuf = d.get_cached_placeholder()
+                if pbuf != None:
+                    new_surface_buffer[id_string] = [pbuf[0], dx, dy, pbuf[1]]
+                # This tile needs to be loaded, those near the center first
+                priority = (dx + size / 2 - self.map_width / 2) ** 2 + (dy + size / 2 - self.map_height / 2) ** 2
+                requests.append((priority, d))
         self.surface_buffer = new_surface_buffer
 
-        # Worker threads now pick up the requests and run the tile loader
-        # TODO: Threadpool may not be the right choice here
         cr = gtk.gdk.CairoContext(cairo.Context(self.cr_drawing_area_map))
         cr.set_source_rgba(0, 0, 0, 1)
         self.delay_expose = True
         cr.paint()
-        reqs = threadpool.makeRequests(self.__run_tile_loader, requests)
-        for r in reqs:
-            self.tile_loader_threadpool.putRequest(r)
+        # Worker threads now pick up the requests and run the tile loaders.
+        # This replaces the requests from the last time the map was drawn.
+        self.tile_scheduler.schedule(self, requests)
         self.__draw_layers()
         self.__draw_tiles()
 
     def __get_id_string(self, tile, display_zoom, undersample):
         return (self.tile_loader.PREFIX, tile[0], tile[1], display_zoom, 1 if undersample else 0)
 
+    # source is a file name or a StringIO with the image data
     @staticmethod
-    def _load_tile(filename):
-        surface = cairo.ImageSurface.create_from_png(filename)
+    def _load_tile(source):
+        surface = cairo.ImageSurface.create_from_png(source)
         if surface.get_width() != surface.get_height():
             raise Exception("Image too small, probably corrupted file")
             
         # Filter out OpenStreetMap illegal URL tile
         if surface.get_format() == cairo.FORMAT_ARGB32: # Check format first, because it's very fast.
-            if getsize(filename) == 3713 and md5(surface.get_data()).hexdigest() == '6d9afab2f24e9660b7689b11bf11c880':
+            size = getsize(source) if isinstance(source, basestring) else len(source.getvalue())
+            if size == 3713 and md5(surface.get_data()).hexdigest() == '6d9afab2f24e9660b7689b11bf11c880':
                 raise Exception("Illegal OSM tile.")
         return surface
 
-    def __run_tile_loader(self, id_string, tile, zoom, undersample, x, y, callback_draw):
-        d = self.tile_loader(id_string=id_string, tile=tile, zoom=zoom, undersample=undersample, x=x, y=y, callback_draw=callback_draw, callback_load=self._load_tile)
-        self.active_tile_loaders.append(d)
-        d.run()
+    @staticmethod
+    def _get_tile_size(surface):
+        return surface.get_stride() * surface.get_height()
 
     def _add_to_buffer(self, id_string, surface, x, y, scale_source=None):
         self.surface_buffer[id_string] = [surface, x, y, scale_source]
@@ -374,12 +361,12 @@ class Map(gtk.DrawingArea, AbstractMap):
             if scale_source == None:
                 cr.set_source_surface(surface, x + off_x, y + off_y)
             else:
-                xs, ys = scale_source
+                xs, ys, factor = scale_source
                 imgpat = cairo.SurfacePattern(surface)
                 imgpat.set_filter(cairo.FILTER_BEST)
                 scale = cairo.Matrix()
                 scale.translate(xs, ys)
-                scale.scale(0.5, 0.5)
+                scale.scale(factor, factor)
                 scale.translate(-x + off_x, -y + off_y)
                 imgpat.set_matrix(scale)
                 cr.set_source(imgpat)
@@ -519,76 +506,60 @@ class GeocacheLayer(AbstractGeocacheLayer):
     COLOR_ARCHIVED = gtk.gdk.color_parse('blue')
     COLOR_WAYPOINTS = gtk.gdk.color_parse('deeppink')
 
-    def draw(self):
-        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.map.map_width, self.map.map_height)
+    # Maximum number of rendered names which are kept
+    MAX_LABELS = 1000
+
+    def __init__(self, get_geocaches_callback, show_cache_callback, get_clusters_callback = None):
+        AbstractGeocacheLayer.__init__(self, get_geocaches_callback, show_cache_callback, get_clusters_callback)
+        self.surface = None
+        # Pre-rendered markers, see __get_sprite
+        self.sprites = {}
+        # Pre-rendered names, by title
+        self.labels = {}
+
+    def __get_color(self, c):
+        if c.found:
+            return self.COLOR_FOUND
+        elif c.type == geocaching.GeocacheCoordinate.TYPE_REGULAR:
+            return self.COLOR_REGULAR
+        elif c.type == geocaching.GeocacheCoordinate.TYPE_MULTI:
+            return self.COLOR_MULTI
+        else:
+            return self.COLOR_DEFAULT
+
+    def __get_sprite(self, color, marked, downloaded, status, draw_short):
+        '''
+        Return the marker for a geocache with these properties and the 
+        offset of the geocache position on it. Markers are rendered once
+        and then reused.
+
+        '''
+        key = ((color.red, color.green, color.blue), marked, downloaded, status, draw_short)
+        if key in self.sprites:
+            return self.sprites[key]
+
+        radius = self.CACHE_DRAW_SIZE
+        if draw_short:
+            radius = radius / 2.0
+        # Room for the outline and the "downloaded" lines on the right
+        offset = int(math.ceil(radius)) + 12
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, offset * 2, offset * 2)
         cr = gtk.gdk.CairoContext(cairo.Context(surface))
+        p = (offset, offset)
 
-        coords = self.get_geocaches_callback(self.map.get_visible_area(), self.MAX_NUM_RESULTS_SHOW)
-
-        if self.map.get_zoom() < self.CACHES_ZOOM_LOWER_BOUND:
-            self.map.set_osd_message('Zoom in to see geocaches.')
-            self.visualized_geocaches = []
-            self.result = surface
-            return
-        elif len(coords) >= self.MAX_NUM_RESULTS_SHOW:
-            self.map.set_osd_message('Too many geocaches to display.')
-            self.visualized_geocaches = []
-            self.result = surface
-            return
-        self.map.set_osd_message(None)
-        self.visualized_geocaches = coords
-        draw_short = (len(coords) > self.TOO_MANY_POINTS)
-
-        default_radius = self.CACHE_DRAW_SIZE
-        found, regular, multi, default = self.COLOR_FOUND, self.COLOR_REGULAR, self.COLOR_MULTI, self.COLOR_DEFAULT
-
-
-
-        for c in coords: # for each geocache
-            radius = default_radius
-            if c.found:
-                color = found
-            elif c.type == geocaching.GeocacheCoordinate.TYPE_REGULAR:
-                color = regular
-            elif c.type == geocaching.GeocacheCoordinate.TYPE_MULTI:
-                color = multi
-            else:
-                color = default
-            cr.set_source_color(color)
-
-
-            p = self.map.coord2point(c)
-
-            if c.alter_lat != None and (c.alter_lat != 0 and c.alter_lon != 0):
-                x = self.map.coord2point(geo.Coordinate(c.alter_lat, c.alter_lon))
-                if x != p:
-                    cr.move_to(p[0], p[1])
-                    cr.line_to(x[0], x[1])
-                    cr.set_line_width(2)
-                    cr.stroke()
-
-            if draw_short:
-                radius = radius / 2.0
-
-            if c.marked:
-                cr.set_source_rgba(1, 1, 0, 0.5)
-                cr.rectangle(p[0] - radius, p[1] - radius, radius * 2, radius * 2)
-                cr.fill()
-
-
-            cr.set_source_color(color)
-            cr.set_line_width(4)
+        if marked:
+            cr.set_source_rgba(1, 1, 0, 0.5)
             cr.rectangle(p[0] - radius, p[1] - radius, radius * 2, radius * 2)
-            cr.stroke()
-
-            if draw_short:
-                continue
-
-
+            cr.fill()
 
+        cr.set_source_color(color)
+        cr.set_line_width(4)
+        cr.rectangle(p[0] - radius, p[1] - radius, radius * 2, radius * 2)
+        cr.stroke()
 
+        if not draw_short:
             # if we have a description for this cache...
-            if c.was_downloaded():
+            if downloaded:
                 # draw something like:
                 # ----
                 # ----
@@ -599,52 +570,24 @@ class GeocacheLayer(AbstractGeocacheLayer):
                 count = 3
                 pos_x = p[0] + radius + 3 + 1
                 pos_y = p[1] + radius - (dist * count) + dist
-                cr.set_line_width(1)
+                cr.set_line_width(2)
                 for i in xrange(count):
                     cr.move_to(pos_x, pos_y + dist * i)
                     cr.line_to(pos_x + width, pos_y + dist * i)
-                    cr.set_line_width(2)
-                cr.stroke()
-
-            # if this cache is the active cache
-            if self.current_cache != None and c.name == self.current_cache.name:
-                cr.set_line_width(1)
-                cr.set_source_color(self.COLOR_CURRENT_CACHE)
-                #radius = 7
-                radius_outline = radius + 3
-                cr.rectangle(p[0] - radius_outline, p[1] - radius_outline, radius_outline * 2, radius_outline * 2)
                 cr.stroke()
 
-            # if this cache is disabled
-            if c.status == geocaching.GeocacheCoordinate.STATUS_DISABLED:
+            # if this cache is disabled or archived
+            if status in (geocaching.GeocacheCoordinate.STATUS_DISABLED, geocaching.GeocacheCoordinate.STATUS_ARCHIVED):
                 cr.set_line_width(3)
-                cr.set_source_color(self.COLOR_DISABLED)
-                radius_disabled = 7
-                cr.move_to(p[0]-radius_disabled, p[1]-radius_disabled)
-                cr.line_to(p[0] + radius_disabled, p[1] + radius_disabled)
-                cr.stroke()
-
-            # if this cache is archived
-            if c.status == geocaching.GeocacheCoordinate.STATUS_ARCHIVED:
-                cr.set_line_width(3)
-                cr.set_source_color(self.COLOR_ARCHIVED)
+                if status == geocaching.GeocacheCoordinate.STATUS_DISABLED:
+                    cr.set_source_color(self.COLOR_DISABLED)
+                else:
+                    cr.set_source_color(self.COLOR_ARCHIVED)
                 radius_disabled = 7
                 cr.move_to(p[0]-radius_disabled, p[1]-radius_disabled)
                 cr.line_to(p[0] + radius_disabled, p[1] + radius_disabled)
                 cr.stroke()
 
-
-            # print the name?
-            if self.show_name:
-                layout = self.map.create_pango_layout(AbstractGeocacheLayer.shorten_name(c.title, 20))
-                layout.set_font_description(self.CACHE_DRAW_FONT)
-                width, height = layout.get_pixel_size()
-
-                cr.move_to(p[0] + 4 + radius, p[1] - height + 2)
-                #cr.set_line_width(1)
-                cr.set_source_color(self.CACHE_DRAW_FONT_COLOR)
-                cr.show_layout(layout)
-
             cr.set_source_color(self.COLOR_CACHE_CENTER)
             cr.set_line_width(1)
             cr.move_to(p[0], p[1] - 3)
@@ -653,6 +596,127 @@ class GeocacheLayer(AbstractGeocacheLayer):
             cr.line_to(p[0] + 3, p[1]) # ---
             cr.stroke()
 
+        self.sprites[key] = (surface, offset)
+        return self.sprites[key]
+
+    def __get_label(self, title):
+        '''
+        Return the rendered name of a geocache, rendered once per title.
+
+        '''
+        if title in self.labels:
+            return self.labels[title]
+        if len(self.labels) >= self.MAX_LABELS:
+            self.labels = {}
+        layout = self.map.create_pango_layout(AbstractGeocacheLayer.shorten_name(title, 20))
+        layout.set_font_description(self.CACHE_DRAW_FONT)
+        width, height = layout.get_pixel_size()
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, max(width, 1), max(height, 1))
+        cr = gtk.gdk.CairoContext(cairo.Context(surface))
+        cr.set_source_color(self.CACHE_DRAW_FONT_COLOR)
+        cr.show_layout(layout)
+        self.labels[title] = (surface, height)
+        return self.labels[title]
+
+    def __draw_clusters(self, cr):
+        for cluster in self.get_clusters():
+            p = self.map.coord2point(cluster)
+            # The area grows with the number of geocaches
+            radius = min(self.CLUSTER_CELL_SIZE / 2 - 4, 6 + 3 * math.log(cluster.count))
+            if cluster.type == geocaching.GeocacheCoordinate.TYPE_REGULAR:
+                cr.set_source_color(self.COLOR_REGULAR)
+            elif cluster.type == geocaching.GeocacheCoordinate.TYPE_MULTI:
+                cr.set_source_color(self.COLOR_MULTI)
+            else:
+                cr.set_source_color(self.COLOR_DEFAULT)
+            cr.arc(p[0], p[1], radius, 0, math.pi * 2)
+            cr.fill()
+
+            # The share of found geocaches is shown as a grey sector
+            if cluster.found_ratio > 0:
+                cr.set_source_color(self.COLOR_FOUND)
+                cr.move_to(p[0], p[1])
+                cr.arc(p[0], p[1], radius, -math.pi / 2, -math.pi / 2 + math.pi * 2 * cluster.found_ratio)
+                cr.close_path()
+                cr.fill()
+
+            label, height = self.__get_label(str(cluster.count))
+            cr.set_source_surface(label, int(p[0] - label.get_width() / 2), int(p[1] - height / 2))
+            cr.paint()
+
+    def __get_surface(self):
+        # The surface is reused as long as the map size doesn't change
+        if self.surface == None or self.surface.get_width() != self.map.map_width or self.surface.get_height() != self.map.map_height:
+            self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.map.map_width, self.map.map_height)
+        else:
+            cr = cairo.Context(self.surface)
+            cr.set_operator(cairo.OPERATOR_CLEAR)
+            cr.paint()
+        return self.surface
+
+    def draw(self):
+        surface = self.__get_surface()
+        cr = gtk.gdk.CairoContext(cairo.Context(surface))
+
+        if self.map.get_zoom() < self.CACHES_ZOOM_LOWER_BOUND:
+            coords = None
+        else:
+            coords = self.get_geocaches_callback(self.map.get_visible_area(), self.MAX_NUM_RESULTS_SHOW)
+
+        if coords == None or len(coords) >= self.MAX_NUM_RESULTS_SHOW:
+            self.set_visualized_geocaches([])
+            if self.get_clusters_callback != None:
+                self.map.set_osd_message(None)
+                self.__draw_clusters(cr)
+            elif coords == None:
+                self.map.set_osd_message('Zoom in to see geocaches.')
+            else:
+                self.map.set_osd_message('Too many geocaches to display.')
+            self.result = surface
+            return
+        self.map.set_osd_message(None)
+        self.set_visualized_geocaches(coords)
+        draw_short = (len(coords) > self.TOO_MANY_POINTS)
+
+        radius = self.CACHE_DRAW_SIZE
+        if draw_short:
+            radius = radius / 2.0
+
+        points = zip(coords, self.map.coords2points(coords))
+
+        # Lines to the alternative coordinates go below the markers
+        cr.set_line_width(2)
+        for c, p in points:
+            if c.alter_lat != None and (c.alter_lat != 0 and c.alter_lon != 0):
+                x = self.map.coord2point(geo.Coordinate(c.alter_lat, c.alter_lon))
+                if x != p:
+                    cr.set_source_color(self.__get_color(c))
+                    cr.move_to(p[0], p[1])
+                    cr.line_to(x[0], x[1])
+                    cr.stroke()
+
+        for c, p in points: # for each geocache
+            sprite, offset = self.__get_sprite(self.__get_color(c), bool(c.marked), (not draw_short) and c.was_downloaded(), c.status, draw_short)
+            cr.set_source_surface(sprite, int(p[0]) - offset, int(p[1]) - offset)
+            cr.paint()
+
+            # print the name?
+            if self.show_name and not draw_short:
+                label, height = self.__get_label(c.title)
+                cr.set_source_surface(label, int(p[0] + 4 + radius), int(p[1] - height + 2))
+                cr.paint()
+
+        # if the active cache is visible, mark it
+        if self.current_cache != None:
+            for c, p in points:
+                if c.name == self.current_cache.name:
+                    cr.set_line_width(1)
+                    cr.set_source_color(self.COLOR_CURRENT_CACHE)
+                    radius_outline = radius + 3
+                    cr.rectangle(p[0] - radius_outline, p[1] - radius_outline, radius_outline * 2, radius_outline * 2)
+                    cr.stroke()
+                    break
+
         # draw additional waypoints
         # --> print description!
         if self.current_cache != None:
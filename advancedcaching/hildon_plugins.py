@@ -21,12 +21,14 @@
 #
 
 import geocaching
+import gobject
 import gtk
 import hildon
 import pango
-import threadpool
 import logging
 import geo
+import provider
+from threading import Thread
 from utils import HTMLManipulations
 logger = logging.getLogger('plugins')
 
@@ -413,16 +415,13 @@ class HildonSearchGeocaches(object):
             elif dist_type == 2:
                 center = self.map.get_center()
             if center != None:
-                radius = list_dist_radius[sel_dist_radius.get_selected_rows(0)[0][0]]
-                sqrt_2 = 1.41421356
-                c1 = center.transform(-45, radius * 1000 * sqrt_2)
-                c2 = center.transform(-45 + 180, radius * 1000 * sqrt_2)
-                location = (c1, c2)
+                radius = list_dist_radius[sel_dist_radius.get_selected_rows(0)[0][0]] * 1000
             else:
-                location = None
+                radius = None
 
+            search_filter = provider.Filter(found=found, name_search=name_search, size=sizes, terrain=terrains, diff=difficulties, ctype=types, marked=marked)
             if response == RESPONSE_SHOW_LIST:
-                points, truncated = self.core.get_points_filter(found=found, name_search=name_search, size=sizes, terrain=terrains, diff=difficulties, ctype=types, marked=marked, location=location)
+                points, truncated = self.core.get_points_filter(filter=search_filter, center=center, radius=radius)
                 if len(points) > 0:
                     self._display_results(points, truncated)
                     break
@@ -430,7 +429,7 @@ class HildonSearchGeocaches(object):
                     self.show_error("Search returned no geocaches. Please remember that search works only within the downloaded geocaches.")
 
             elif response == gtk.RESPONSE_ACCEPT:
-                self.core.set_filter(found=found, name_search=name_search, size=sizes, terrain=terrains, diff=difficulties, ctype=types, marked=marked)
+                self.core.set_filter(filter=search_filter)
                 self.show_success("Filter for map activated, ignoring distance restrictions.")
                 self.map_filter_active = True
                 break
@@ -448,8 +447,9 @@ class HildonSearchGeocaches(object):
         ]
 
         if self.gps_data != None and self.gps_data.position != None:
-            for c in caches:
-                c.prox = c.distance_to(self.gps_data.position)
+            distances = geo.distances_from(self.gps_data.position, [c.lat for c in caches], [c.lon for c in caches])
+            for c, d in zip(caches, distances):
+                c.prox = d
         else:
             for c in caches:
                 c.prox = None
@@ -694,6 +694,18 @@ class HildonDownloadMap(object):
         return steps
 
     def _on_show_download_map(self, widget, data):
+        if self.core.has_unfinished_prefetch():
+            dialog = gtk.Dialog("Resume Map Download?", self.window, gtk.DIALOG_DESTROY_WITH_PARENT, ("Resume", gtk.RESPONSE_YES, "New Download", gtk.RESPONSE_NO))
+            dialog.vbox.pack_start(gtk.Label("The last map download was not finished."))
+            dialog.show_all()
+            res = dialog.run()
+            dialog.hide()
+            if res == gtk.RESPONSE_YES:
+                self._run_prefetcher(self.core.get_tile_prefetcher)
+                return
+            elif res != gtk.RESPONSE_NO:
+                return
+
         current_visible_tiles = self.map.surface_buffer.keys()
         if len(current_visible_tiles) == 0:
             return
@@ -715,90 +727,48 @@ class HildonDownloadMap(object):
         if len(active_zoom_steps) == 0:
             return
 
-        zoom_step_keys = [x[0] for x in active_zoom_steps]
-        max_zoom_step = max(zoom_step_keys)
-
-        todo = sum(x[2] for x in active_zoom_steps)
-        status = {'finished': 0, 'aborted': 0}
-        tile_loader_threadpool = threadpool.ThreadPool(6)
-        requests = []
+        map_name = [name for name, loader in self.map.tile_loaders if loader == self.map.tile_loader][0]
+        areas = [self.map.get_visible_area()]
+        zooms = [x[0] for x in active_zoom_steps]
+        self._run_prefetcher(lambda progress_callback: self.core.get_tile_prefetcher(areas, zooms, map_name, progress_callback))
 
-        dialog = gtk.Dialog("Downloading Map Tiles...", self.window, gtk.DIALOG_DESTROY_WITH_PARENT, (gtk.STOCK_OK, gtk.RESPONSE_CANCEL))
+    def _run_prefetcher(self, get_prefetcher):
+        dialog = gtk.Dialog("Downloading Map Tiles...", self.window, gtk.DIALOG_DESTROY_WITH_PARENT, (gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL))
         hildon.hildon_gtk_window_set_progress_indicator(dialog, 1)
         pbar = gtk.ProgressBar()
         dialog.vbox.pack_start(pbar)
         dialog.show_all()
 
-        stopped = [False]
-        def cancel(widget, data):
-            stopped[0] = True
-
-        dialog.connect('response', cancel)
-        pbar.set_text("Preparing download of %d map tiles..." % todo)
-        while gtk.events_pending():
-            gtk.main_iteration()
-        if stopped[0]:
-                return
-
-        def add_tiles(source, zoom):
-            if zoom in zoom_step_keys:
-                requests.append(((source, zoom), {}))
-
-            if zoom + 1 <= max_zoom_step:
-                for add_x in (0, 1):
-                    for add_y in (0, 1):
-                        tile = (source[0] * 2 + add_x, source[1] * 2 + add_y)
-                        add_tiles(tile, zoom + 1)
-
-        for prefix, tile_x, tile_y, zoom, undersample in current_visible_tiles:
-            add_tiles((tile_x, tile_y), current_zoom)
+        def show_progress(finished, total, errors):
+            pbar.set_fraction(min(1.0, finished / float(max(total, 1))))
+            pbar.set_text("%d of ~%d downloaded (%d errors)" % (finished, total, errors))
+            return False
 
-        if len(requests) != todo:
-            raise Exception("Something went wrong while calculating the amount of tiles. (%d vs. %d)" % (len(requests), todo))
-
-        def download_tile(tile, zoom):
-            tl = self.map.tile_loader(None, tile = tile, zoom = zoom)
-            res = tl.download_tile_only()
-            if res:
-                status['finished'] += 1
-            else:
-                status['aborted'] += 1
+        prefetcher = get_prefetcher(progress_callback = lambda *args: gobject.idle_add(show_progress, *args))
+        pbar.set_text("Preparing download of ~%d map tiles..." % prefetcher.total)
 
+        def cancel(widget, data):
+            logger.info("Stopping map download, it can be resumed later")
+            prefetcher.stop()
+            pbar.set_text("Stopping...")
+        dialog.connect('response', cancel)
 
-        reqs = threadpool.makeRequests(download_tile, requests)
-        i = 0
-        count = len(reqs)
-        for r in reqs:
-            i += 1
-            tile_loader_threadpool.putRequest(r)
-            if i % 100 == 0:
-                pbar.set_text("Starting download...")
-                pbar.set_fraction(i/count)
-                while gtk.events_pending():
-                    gtk.main_iteration()
-                if stopped[0]:
-                    return
-        
-        import time
-        try:
-            while True:
-                time.sleep(0.5)
-                while gtk.events_pending():
-                    gtk.main_iteration()
-                tile_loader_threadpool.poll()
-                pbar.set_fraction(sum(status.values())/float(todo))
-                pbar.set_text("%d of %d downloaded (%d errors)" % (sum(status.values()), todo, status['aborted']))
-                if stopped[0]:
-                    tile_loader_threadpool.dismissWorkers
-                    break
-        except threadpool.NoResultsPending:
+        def finished():
             logger.info("Downloading finished")
-        except Exception,e:
-            print e
-            self.show_error(e)
-        finally:
-            logger.info("Closing")
+            hildon.hildon_gtk_window_set_progress_indicator(dialog, 0)
             dialog.hide()
+            return False
+
+        def run():
+            try:
+                prefetcher.run()
+            except Exception, e:
+                logger.exception(e)
+                gobject.idle_add(self.show_error, e)
+            gobject.idle_add(finished)
+        t = Thread(target=run)
+        t.daemon = True
+        t.start()
             
 
 class HildonToolsDialog(object):
@@ -75,7 +75,6 @@ class HildonGui(HildonToolsDialog, HildonSearchPlace, HildonFieldnotes, HildonSe
     CLICK_RADIUS = 25
 
     TOO_MANY_POINTS = 80
-    MAX_NUM_RESULTS_SHOW = 80
     CACHES_ZOOM_LOWER_BOUND = 8
 
     ICONS = {
@@ -119,7 +118,7 @@ class HildonGui(HildonToolsDialog, HildonSearchPlace, HildonFieldnotes, HildonSe
 
         self.format = geo.Coordinate.FORMAT_DM
 
-        Map.set_config(self.core.settings['map_providers'], self.core.settings['download_map_path'], self.noimage_cantload, self.noimage_loading)
+        Map.set_config(self.core.settings['map_providers'], self.core.settings['download_map_path'], self.noimage_cantload, self.noimage_loading, self.core.downloader, self.core.settings['map_tile_cache_size'], self.core.settings['map_revalidate_after'], self.core.settings['map_revalidate_interval'])
         OsdLayer.set_layout(pango.FontDescription("Nokia Sans Maps 13"), gtk.gdk.color_parse('black'))
         
 
@@ -25,34 +25,496 @@ from __future__ import with_statement
 import logging
 logger = logging.getLogger('openstreetmap')
 
-from os import path, mkdir, extsep, remove
-from threading import Semaphore
+from email.utils import formatdate
+from os import path, mkdir, extsep, remove, listdir, rmdir, rename
+from Queue import Queue
+from heapq import heappop, heappush
+from threading import Condition, Semaphore, Lock, Thread
+from time import sleep, time
 from urllib import urlretrieve
+import urllib2
 from socket import setdefaulttimeout
+from StringIO import StringIO
+import sqlite3
 import connection
 setdefaulttimeout(30)
    
     
 CONCURRENT_THREADS = 20
 
+# Number of zoom levels to go up when looking for a cached tile which can
+# be shown scaled up while the exact tile is loaded
+MAX_PLACEHOLDER_LEVELS = 2
 
 
+class TileCache():
+    '''
+    Memory bounded LRU cache for decoded tiles, shared by all map widgets
+    and tile providers.
+    
+    Keys are (prefix, zoom, x, y) tuples. get_size returns the number of
+    bytes a decoded tile occupies.
+    
+    '''
+    def __init__(self, max_bytes, get_size):
+        self.max_bytes = max_bytes
+        self.get_size = get_size
+        self.lock = Lock()
+        # key -> [tile, size, last use]
+        self.entries = {}
+        self.bytes = 0
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+        
+    def get(self, key, count = True):
+        '''
+        Return the tile for key or None. If count is False, the lookup is not
+        counted as hit or miss.
+        
+        '''
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry == None:
+                if count:
+                    self.misses += 1
+                return None
+            if count:
+                self.hits += 1
+            self.clock += 1
+            entry[2] = self.clock
+            return entry[0]
+            
+    def put(self, key, tile):
+        size = self.get_size(tile)
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries[key][1]
+            self.clock += 1
+            self.entries[key] = [tile, size, self.clock]
+            self.bytes += size
+            if self.bytes > self.max_bytes:
+                self.__evict()
+                
+    # Remove the least recently used tiles until the cache fits into its budget
+    def __evict(self):
+        for key, entry in sorted(self.entries.items(), key = lambda x: x[1][2]):
+            if self.bytes <= self.max_bytes:
+                break
+            del self.entries[key]
+            self.bytes -= entry[1]
+            
+    def remove(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry != None:
+                self.bytes -= entry[1]
+            
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            self.bytes = 0
+            
+    def get_statistics(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'tiles': len(self.entries), 'bytes': self.bytes}
+            
+
+class TileScheduler():
+    '''
+    Loads tiles in worker threads, the requests with the lowest priority
+    value first.
+    
+    Requests for the same tile are merged, also if they come from different
+    maps: The tile is downloaded and decoded once, and then shown by every
+    loader which is waiting for it. Each map (the owner) replaces all of its
+    requests when it is redrawn, so tiles which have left its viewport are 
+    not loaded anymore.
+    
+    '''
+    def __init__(self, num_threads):
+        self.condition = Condition()
+        # Heap of (priority, sequence number, cache key)
+        self.queue = []
+        # List of (priority, owner, loader) for each queued or running tile
+        self.jobs = {}
+        self.running = set()
+        self.sequence = 0
+        self.stopped = False
+        self.threads = []
+        for i in xrange(num_threads):
+            t = Thread(target=self.__work)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+            
+    def schedule(self, owner, requests):
+        '''
+        Replace all requests of owner by requests, which is a list of 
+        (priority, loader).
+        
+        '''
+        with self.condition:
+            self.__cancel(owner)
+            for priority, loader in requests:
+                key = loader.cache_key
+                if key in self.jobs:
+                    self.jobs[key].append((priority, owner, loader))
+                    if key in self.running:
+                        continue
+                else:
+                    self.jobs[key] = [(priority, owner, loader)]
+                self.sequence += 1
+                heappush(self.queue, (priority, self.sequence, key))
+            self.condition.notifyAll()
+            
+    def cancel(self, owner):
+        '''
+        Drop all requests of owner.
+        
+        '''
+        with self.condition:
+            self.__cancel(owner)
+            
+    def __cancel(self, owner):
+        # Stale entries in the queue are skipped by the workers
+        for key, waiting in self.jobs.items():
+            remaining = []
+            for entry in waiting:
+                if entry[1] is owner:
+                    entry[2].halt()
+                else:
+                    remaining.append(entry)
+            if len(remaining) > 0 or key in self.running:
+                self.jobs[key] = remaining
+            else:
+                del self.jobs[key]
+                
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notifyAll()
+        for t in self.threads:
+            t.join()
+            
+    def __waiting(self, key):
+        with self.condition:
+            return list(self.jobs.get(key, []))
+            
+    def __work(self):
+        while True:
+            with self.condition:
+                key = None
+                while key == None:
+                    if self.stopped:
+                        return
+                    if len(self.queue) == 0:
+                        self.condition.wait()
+                        continue
+                    priority, sequence, k = heappop(self.queue)
+                    # Only the entry with the current priority of the tile is valid
+                    if k in self.jobs and k not in self.running and priority == min(p for p, o, l in self.jobs[k]):
+                        key = k
+                self.running.add(key)
+                loader = self.jobs[key][0][2]
+            
+            def show_loading():
+                for priority, owner, l in self.__waiting(key):
+                    l.show_loading()
+            try:
+                surface = loader.fetch(show_loading)
+            except Exception, e:
+                logger.exception("Exception while loading map tile: %s" % e)
+                surface = None
+                
+            with self.condition:
+                self.running.discard(key)
+                waiting = self.jobs.pop(key, [])
+            for priority, owner, l in waiting:
+                l.show(surface)
+                
+                
+class MBTilesStore():
+    '''
+    Stores the tiles of one map provider in a single SQLite file in the
+    MBTiles layout instead of one file per tile.
+    
+    Tiles are addressed with the usual x/y tile numbers; as defined by
+    MBTiles, the rows are counted from the south in the file. Writes are
+    committed in batches.
+    
+    '''
+    # A commit is done after this many tiles or after this many seconds
+    BATCH_SIZE = 50
+    BATCH_INTERVAL = 5
+    
+    # Bytes of the file which SQLite may map into memory for reading. 
+    # Older SQLite versions ignore this.
+    MMAP_SIZE = 64 * 1024 * 1024
+    
+    def __init__(self, filename, name = '', file_type = 'png'):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename, check_same_thread = False)
+        self.conn.text_factory = str
+        self.lock = Lock()
+        self.pending = 0
+        self.last_commit = time()
+        c = self.conn.cursor()
+        c.execute('PRAGMA mmap_size = %d' % self.MMAP_SIZE)
+        c.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)')
+        c.execute('CREATE UNIQUE INDEX IF NOT EXISTS metadata_name ON metadata (name)')
+        c.execute('CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
+        c.execute('CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)')
+        c.executemany('INSERT OR IGNORE INTO metadata (name, value) VALUES (?, ?)', (('name', name), ('type', 'baselayer'), ('version', '1'), ('description', name), ('format', file_type)))
+        self.conn.commit()
+        c.close()
+        
+    @staticmethod
+    def __row(zoom, y):
+        return (1 << zoom) - 1 - y
+        
+    def has(self, zoom, x, y):
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?', (zoom, x, self.__row(zoom, y))).fetchone() != None
+            
+    def get(self, zoom, x, y):
+        with self.lock:
+            row = self.conn.execute('SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?', (zoom, x, self.__row(zoom, y))).fetchone()
+        if row == None:
+            return None
+        return str(row[0])
+        
+    def get_column(self, zoom, x):
+        '''
+        Return the set of y tile numbers of all stored tiles in column x.
+        
+        '''
+        with self.lock:
+            rows = self.conn.execute('SELECT tile_row FROM tiles WHERE zoom_level = ? AND tile_column = ?', (zoom, x)).fetchall()
+        return set(self.__row(zoom, row) for row, in rows)
+            
+    def put(self, zoom, x, y, data):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)', (zoom, x, self.__row(zoom, y), sqlite3.Binary(data)))
+            self.pending += 1
+            if self.pending >= self.BATCH_SIZE or time() - self.last_commit > self.BATCH_INTERVAL:
+                self.__commit()
+                
+    def remove(self, zoom, x, y):
+        with self.lock:
+            self.conn.execute('DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?', (zoom, x, self.__row(zoom, y)))
+            self.pending += 1
+            
+    def flush(self):
+        with self.lock:
+            self.__commit()
+            
+    def __commit(self):
+        if self.pending > 0:
+            self.conn.commit()
+            self.pending = 0
+        self.last_commit = time()
+        
+        
+class TileValidators():
+    '''
+    Stores the HTTP validators (ETag and Last-Modified) of the tiles of one
+    map provider and when each tile was last checked, in a SQLite file.
+    
+    '''
+    BATCH_SIZE = MBTilesStore.BATCH_SIZE
+    BATCH_INTERVAL = MBTilesStore.BATCH_INTERVAL
+    
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename, check_same_thread = False)
+        self.conn.text_factory = str
+        self.lock = Lock()
+        self.pending = 0
+        self.last_commit = time()
+        self.conn.execute('CREATE TABLE IF NOT EXISTS validators (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, etag TEXT, last_modified TEXT, checked INTEGER)')
+        self.conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS validators_index ON validators (zoom_level, tile_column, tile_row)')
+        self.conn.commit()
+        
+    def get(self, zoom, x, y):
+        '''
+        Return (etag, last_modified, checked) for the tile, or None.
+        
+        '''
+        with self.lock:
+            return self.conn.execute('SELECT etag, last_modified, checked FROM validators WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?', (zoom, x, y)).fetchone()
+            
+    def put(self, zoom, x, y, etag, last_modified, checked):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO validators (zoom_level, tile_column, tile_row, etag, last_modified, checked) VALUES (?, ?, ?, ?, ?, ?)', (zoom, x, y, etag, last_modified, int(checked)))
+            self.pending += 1
+            if self.pending >= self.BATCH_SIZE or time() - self.last_commit > self.BATCH_INTERVAL:
+                self.__commit()
+                
+    def flush(self):
+        with self.lock:
+            self.__commit()
+            
+    def __commit(self):
+        if self.pending > 0:
+            self.conn.commit()
+            self.pending = 0
+        self.last_commit = time()
+        
+        
+class TileRevalidator():
+    '''
+    Checks in the background whether shown tiles which were downloaded
+    (or last checked) more than max_age seconds ago have changed on the
+    server, using conditional requests. Unchanged tiles are not transferred
+    again. At most one request is sent every interval seconds.
+    
+    '''
+    def __init__(self, max_age, interval = 1):
+        self.max_age = max_age
+        self.interval = interval
+        self.queue = Queue()
+        self.queued = set()
+        self.lock = Lock()
+        self.checked = 0
+        self.changed = 0
+        t = Thread(target=self.__work)
+        t.daemon = True
+        t.start()
+        
+    def check(self, loader):
+        '''
+        Queue loader for revalidation if its tile is too old.
+        
+        '''
+        checked = loader.get_checked()
+        if checked == None or time() - checked < self.max_age:
+            return
+        with self.lock:
+            if loader.cache_key in self.queued:
+                return
+            self.queued.add(loader.cache_key)
+        self.queue.put(loader)
+        
+    def get_statistics(self):
+        with self.lock:
+            return {'checked': self.checked, 'changed': self.changed, 'queued': len(self.queued)}
+            
+    def __work(self):
+        while True:
+            loader = self.queue.get()
+            try:
+                changed = loader.revalidate()
+            except Exception, e:
+                logger.error("Revalidation of %s failed: %s" % (loader.remote_filename, e))
+                changed = False
+            with self.lock:
+                self.queued.discard(loader.cache_key)
+                self.checked += 1
+                if changed:
+                    self.changed += 1
+            # The tile is decoded again the next time it's shown
+            if changed and loader.tile_cache != None:
+                loader.tile_cache.remove(loader.cache_key)
+            sleep(self.interval)
+            
+            
+# Open MBTilesStores and TileValidators by file name, shared by all tile loaders
+stores = {}
+stores_lock = Lock()
 
+def get_store(filename, name = '', file_type = 'png'):
+    with stores_lock:
+        if filename not in stores:
+            stores[filename] = MBTilesStore(filename, name, file_type)
+        return stores[filename]
+        
+def get_validators(filename):
+    with stores_lock:
+        if filename not in stores:
+            stores[filename] = TileValidators(filename)
+        return stores[filename]
+        
+def flush_stores():
+    with stores_lock:
+        for store in stores.values():
+            store.flush()
+            
+def migrate_to_mbtiles(base_dir, prefix, file_type = 'png', remove_files = False, progress_callback = None):
+    '''
+    Copy the tiles of a map provider from the directory layout 
+    (base_dir/prefix/zoom/x/y.file_type) to its MBTiles file 
+    (base_dir/prefix.mbtiles).
+    
+    If remove_files is True, the files and the emptied directories are
+    removed. progress_callback is called with the number of migrated tiles
+    after each zoom level. Returns the number of migrated tiles.
+    
+    '''
+    store = get_store(path.join(base_dir, '%s%smbtiles' % (prefix, extsep)), prefix, file_type)
+    tile_dir = path.join(base_dir, prefix)
+    suffix = '%s%s' % (extsep, file_type)
+    count = 0
+    if not path.isdir(tile_dir):
+        return count
+    for zoom in sorted(listdir(tile_dir)):
+        zoom_dir = path.join(tile_dir, zoom)
+        if not zoom.isdigit() or not path.isdir(zoom_dir):
+            continue
+        for x in listdir(zoom_dir):
+            x_dir = path.join(zoom_dir, x)
+            if not x.isdigit() or not path.isdir(x_dir):
+                continue
+            for name in listdir(x_dir):
+                if not name.endswith(suffix) or not name[:-len(suffix)].isdigit():
+                    continue
+                filename = path.join(x_dir, name)
+                f = open(filename, 'rb')
+                try:
+                    store.put(int(zoom), int(x), int(name[:-len(suffix)]), f.read())
+                finally:
+                    f.close()
+                count += 1
+        store.flush()
+        if remove_files:
+            for x in listdir(zoom_dir):
+                x_dir = path.join(zoom_dir, x)
+                for name in listdir(x_dir):
+                    if name.endswith(suffix):
+                        remove(path.join(x_dir, name))
+                if len(listdir(x_dir)) == 0:
+                    rmdir(x_dir)
+            if len(listdir(zoom_dir)) == 0:
+                rmdir(zoom_dir)
+        if progress_callback != None:
+            progress_callback(count)
+    if remove_files and len(listdir(tile_dir)) == 0:
+        rmdir(tile_dir)
+    return count
     
 
-def get_tile_loader(prefix, remote_url, max_zoom = 18, reverse_zoom = False, file_type = 'png', size = 256):
+
+# storage is either 'files' (one file per tile) or 'mbtiles' (one MBTiles file for all tiles)
+def get_tile_loader(prefix, remote_url, max_zoom = 18, reverse_zoom = False, file_type = 'png', size = 256, storage = 'files'):
     class TileLoader():
         downloading = {}
         semaphore = Semaphore(CONCURRENT_THREADS)
         noimage_cantload = None
         noimage_loading = None
         base_dir = ''
+        # FileDownloader whose connection pool is used; urlretrieve is used if not set
+        downloader = None
+        # TileCache for decoded tiles; if not set, tiles are loaded from disk every time
+        tile_cache = None
+        # TileRevalidator which keeps shown tiles up to date; if not set, tiles are never downloaded again
+        revalidator = None
         
         PREFIX = prefix
         MAX_ZOOM = max_zoom
         FILE_TYPE = file_type
         REMOTE_URL = remote_url
         TILE_SIZE = size
+        STORAGE = storage
 
         TPL_LOCAL_PATH = path.join("%s", PREFIX, "%d", "%d")
         TPL_LOCAL_FILENAME = path.join("%s", "%%d%s%s" % (extsep, FILE_TYPE))
@@ -71,6 +533,8 @@ def get_tile_loader(prefix, remote_url, max_zoom = 18, reverse_zoom = False, fil
                 self.display_zoom = zoom
                 self.download_tile = (int(self.download_tile[0]/2), int(self.download_tile[1]/2))
             self.pbuf = None
+            # Size of the last download
+            self.downloaded_bytes = 0
             self.callback_draw = callback_draw
             self.callback_load = callback_load
 
@@ -83,6 +547,48 @@ def get_tile_loader(prefix, remote_url, max_zoom = 18, reverse_zoom = False, fil
             self.local_path = self.TPL_LOCAL_PATH % (self.base_dir, self.download_zoom, self.download_tile[0])
             self.local_filename = self.TPL_LOCAL_FILENAME % (self.local_path, self.download_tile[1])
             self.remote_filename = self.REMOTE_URL % {'zoom': self.download_zoom, 'x' : self.download_tile[0], 'y' : self.download_tile[1]}
+            self.cache_key = (self.PREFIX, self.download_zoom, self.download_tile[0], self.download_tile[1])
+            self.store = self.get_store()
+            self.validators = self.get_validators()
+            
+        @classmethod
+        def get_store(cls):
+            '''
+            Return the MBTilesStore for this map provider, or None if tiles are stored in files.
+            
+            '''
+            if cls.STORAGE != 'mbtiles':
+                return None
+            return get_store(path.join(cls.base_dir, '%s%smbtiles' % (cls.PREFIX, extsep)), cls.PREFIX, cls.FILE_TYPE)
+            
+        @classmethod
+        def get_validators(cls):
+            '''
+            Return the TileValidators for this map provider.
+            
+            '''
+            return get_validators(path.join(cls.base_dir, '%s%svalidators' % (cls.PREFIX, extsep)))
+            
+        @classmethod
+        def get_column(cls, zoom, x):
+            '''
+            Return the set of y tile numbers of all tiles in column x which 
+            are already downloaded.
+            
+            '''
+            store = cls.get_store()
+            if store != None:
+                return store.get_column(zoom, x)
+            local_path = cls.TPL_LOCAL_PATH % (cls.base_dir, zoom, x)
+            if not path.isdir(local_path):
+                return set()
+            suffix = '%s%s' % (extsep, cls.FILE_TYPE)
+            return set(int(name[:-len(suffix)]) for name in listdir(local_path) if name.endswith(suffix) and name[:-len(suffix)].isdigit())
+            
+        def __exists(self):
+            if self.store != None:
+                return self.store.has(self.download_zoom, self.download_tile[0], self.download_tile[1])
+            return path.isfile(self.local_filename)
             
 
         def halt(self):
@@ -102,21 +608,112 @@ def get_tile_loader(prefix, remote_url, max_zoom = 18, reverse_zoom = False, fil
 
 
         def run(self):
-            needs_download = True
-            if not path.isfile(self.local_filename):
-                self.create_recursive(self.local_path)
-                self.draw(self.get_no_image(self.noimage_loading))
-                needs_download = self.__download(self.remote_filename, self.local_filename)
-
-            # now the file hopefully exists
-            if needs_download == True:
-                self.load()
-                self.draw(self.pbuf)
-            elif needs_download == False:
-                self.draw(self.get_no_image(self.noimage_cantload))
+            self.show(self.fetch(self.show_loading))
+
+        def fetch(self, callback_download = None):
+            '''
+            Download the tile if necessary and decode it, without drawing 
+            anything. Returns the surface, or None if the tile could not be
+            loaded. callback_download is called before a download starts.
+            
+            '''
+            if self.tile_cache != None:
+                surface = self.tile_cache.get(self.cache_key, False)
+                if surface != None:
+                    return surface
+            if not self.__exists():
+                if self.store == None:
+                    self.create_recursive(self.local_path)
+                if callback_download != None:
+                    callback_download()
+                if not self.__download(self.remote_filename, self.local_filename):
+                    return None
+            elif self.revalidator != None:
+                self.revalidator.check(self)
+            return self.__decode()
+
+        def get_checked(self):
+            '''
+            Return when the tile was downloaded or last revalidated (in 
+            seconds since the epoch), or None if it doesn't exist.
+            
+            '''
+            v = self.validators.get(self.download_zoom, self.download_tile[0], self.download_tile[1])
+            if v != None:
+                return v[2]
+            if self.store == None:
+                try:
+                    return path.getmtime(self.local_filename)
+                except OSError:
+                    return None
+            # Tiles stored before the validators were recorded count as new
+            if self.__exists():
+                self.validators.put(self.download_zoom, self.download_tile[0], self.download_tile[1], None, None, time())
+            return None
+
+        def revalidate(self):
+            '''
+            Ask the server whether the tile has changed and download it again
+            if so. Returns True if the tile was changed.
+            
+            '''
+            v = self.validators.get(self.download_zoom, self.download_tile[0], self.download_tile[1])
+            etag = last_modified = None
+            if v != None:
+                etag, last_modified = v[0], v[1]
+            elif self.store == None:
+                last_modified = formatdate(path.getmtime(self.local_filename), usegmt = True)
+            headers = {}
+            if etag != None:
+                headers['If-None-Match'] = etag
+            if last_modified != None:
+                headers['If-Modified-Since'] = last_modified
+            if connection.offline:
+                return False
+            try:
+                if self.downloader != None:
+                    response_headers, reader = self.downloader.fetch(self.remote_filename, headers = headers)
+                else:
+                    reader = urllib2.urlopen(urllib2.Request(self.remote_filename, headers = headers))
+                    response_headers = reader.info()
+            except urllib2.HTTPError, e:
+                e.close()
+                if e.code != 304:
+                    raise
+                # A 304 response may carry updated validators
+                self.__save_validators(e.info(), etag, last_modified)
+                return False
+            try:
+                data = reader.read()
+            finally:
+                reader.close()
+            if "text/html" in response_headers.get('Content-Type', ''):
+                return False
+            if self.store != None:
+                self.store.put(self.download_zoom, self.download_tile[0], self.download_tile[1], data)
             else:
-                # Do nothing here, as the thread was told to stop
-                pass
+                # Replace the file at once, so the old tile is kept on errors
+                f = open(self.local_filename + extsep + 'tmp', 'wb')
+                try:
+                    f.write(data)
+                finally:
+                    f.close()
+                rename(self.local_filename + extsep + 'tmp', self.local_filename)
+            self.__save_validators(response_headers)
+            return True
+
+        def __save_validators(self, headers, etag = None, last_modified = None):
+            self.validators.put(self.download_zoom, self.download_tile[0], self.download_tile[1], headers.get('ETag', etag), headers.get('Last-Modified', last_modified), time())
+
+        def show(self, surface):
+            if surface == None:
+                self.pbuf = self.get_no_image(self.noimage_cantload)
+            else:
+                self.pbuf = self.__make_pbuf(surface, self.display_zoom - self.download_zoom)
+            self.draw(self.pbuf)
+
+        def show_loading(self):
+            self.draw(self.get_cached_placeholder() or self.get_no_image(self.noimage_loading))
 
         def run_again(self):
             self.load()
@@ -126,40 +723,88 @@ def get_tile_loader(prefix, remote_url, max_zoom = 18, reverse_zoom = False, fil
         def get_no_image(self, default):
             return (default, None)
             
-        def load(self, tryno=0):                
+        # Return the pbuf for a surface which is levels zoom levels above the displayed tile.
+        # Then, only a part of the surface is shown, scaled up.
+        def __make_pbuf(self, surface, levels):
+            if levels == 0:
+                return (surface, None)
+            size, tile = self.TILE_SIZE, self.tile
+            factor = 2 ** levels
+            off_x = (tile[0]/float(factor) - int(tile[0]/factor)) * size
+            off_y = (tile[1]/float(factor) - int(tile[1]/factor)) * size
+            return (surface, (off_x, off_y, 1.0/factor))
+            
+        def get_cached(self):
+            '''
+            Return the pbuf for this tile if it is in the tile cache, None otherwise.
+            
+            '''
+            if self.tile_cache == None:
+                return None
+            surface = self.tile_cache.get(self.cache_key)
+            if surface == None:
+                return None
+            return self.__make_pbuf(surface, self.display_zoom - self.download_zoom)
+            
+        def get_cached_placeholder(self):
+            '''
+            Return the pbuf for a cached tile of a lower zoom level covering this
+            tile, which can be shown until this tile is loaded, or None.
+            
+            '''
+            if self.tile_cache == None:
+                return None
+            for level in xrange(1, MAX_PLACEHOLDER_LEVELS + 1):
+                zoom = self.download_zoom - level
+                if zoom < 0:
+                    break
+                factor = 2 ** level
+                surface = self.tile_cache.get((self.PREFIX, zoom, self.download_tile[0]/factor, self.download_tile[1]/factor), False)
+                if surface != None:
+                    return self.__make_pbuf(surface, self.display_zoom - zoom)
+            return None
+            
+        def load(self):
             # load the pixbuf to memory
             if self.stop:
                 return True
+            surface = self.__decode()
+            if surface == None:
+                self.pbuf = (self.noimage_cantload, None)
+            else:
+                self.pbuf = self.__make_pbuf(surface, self.display_zoom - self.download_zoom)
+            return True
+            
+        def __decode(self, tryno = 0):
             try:
-                size, tile = self.TILE_SIZE, self.tile
-                if self.undersample:
-                    # don't load the tile directly, but load the supertile instead
-                    supertile_x = int(tile[0]/2)
-                    supertile_y = int(tile[1]/2)
-                    off_x = (tile[0]/2.0 - supertile_x) * size
-                    off_y = (tile[1]/2.0 - supertile_y) * size
-                    surface = self.callback_load(self.local_filename)
-                    
-                    self.pbuf = (surface, (off_x, off_y))
+                # If undersampling, this is the supertile
+                if self.store != None:
+                    data = self.store.get(self.download_zoom, self.download_tile[0], self.download_tile[1])
+                    if data == None:
+                        raise Exception("Tile not found in %s" % self.store.filename)
+                    surface = self.callback_load(StringIO(data))
                 else:
                     surface = self.callback_load(self.local_filename)
-                    self.pbuf = (surface, None)
-                return True
+                if self.tile_cache != None:
+                    self.tile_cache.put(self.cache_key, surface)
+                return surface
             except Exception, e:
                 if tryno == 0:
-                    return self.recover()
+                    self.recover()
+                    return self.__decode(1)
                 else:
                     logger.exception("Exception while loading map tile: %s" % e)
-                    self.pbuf = (self.noimage_cantload, None)
-                    return True
+                    return None
 
         def recover(self):
             try:
-                remove(self.local_filename)
+                if self.store != None:
+                    self.store.remove(self.download_zoom, self.download_tile[0], self.download_tile[1])
+                else:
+                    remove(self.local_filename)
             except Exception, e:
                 logger.critical("Exception occured while removing file: %s" % e)
             self.__download(self.remote_filename, self.local_filename)
-            return self.load(1)
 
         def draw(self, pbuf):
             if not self.stop:
@@ -168,26 +813,49 @@ def get_tile_loader(prefix, remote_url, max_zoom = 18, reverse_zoom = False, fil
 
 
         def __download(self, remote, local):
-            if path.exists(local):
+            if self.__exists():
                 return True
             if connection.offline:
                 return False
             with TileLoader.semaphore:
                 try:
-                    if self.stop:
-                        return None
-                    info = urlretrieve(remote, local)
+                    if self.store != None:
+                        return self.__download_to_store(remote)
+                    if self.downloader != None:
+                        headers = self.downloader.download_file(remote, local)
+                    else:
+                        headers = urlretrieve(remote, local)[1]
 
-                    if "text/html" in info[1]['Content-Type']:
+                    if "text/html" in headers.get('Content-Type', ''):
                         return False
+                    self.downloaded_bytes = path.getsize(local)
+                    self.__save_validators(headers)
                     return True
                 except Exception, e:
                     logger.error("Download error")
                     logger.exception(e)
                     return False
 
+        def __download_to_store(self, remote):
+            if self.downloader != None:
+                headers, reader = self.downloader.fetch(remote)
+            else:
+                # Unlike urllib.urlopen, this raises an HTTPError for error pages
+                reader = urllib2.urlopen(remote)
+                headers = reader.info()
+            try:
+                data = reader.read()
+            finally:
+                reader.close()
+            if "text/html" in headers.get('Content-Type', ''):
+                return False
+            self.store.put(self.download_zoom, self.download_tile[0], self.download_tile[1], data)
+            self.downloaded_bytes = len(data)
+            self.__save_validators(headers)
+            return True
+
         def download_tile_only(self):
-            if not path.isfile(self.local_filename):
+            if self.store == None and not path.isfile(self.local_filename):
                 self.create_recursive(self.local_path)
             return self.__download(self.remote_filename, self.local_filename)
 
@@ -0,0 +1,292 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#   Copyright (C) 2012 Daniel Fett
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#   Author: Daniel Fett agtl@danielfett.de
+#   Jabber: fett.daniel@jaber.ccc.de
+#   Bugtracker and GIT Repository: http://github.com/webhamster/advancedcaching
+#
+
+# Downloads map tiles for offline use, without a GUI.
+
+from __future__ import with_statement
+
+import logging
+logger = logging.getLogger('prefetch')
+
+import math
+from os import path, remove, rename
+from threading import Lock, Thread
+from time import sleep, time
+try:
+    from json import loads, dumps
+except (ImportError, AttributeError):
+    from simplejson import loads, dumps
+
+import geo
+import openstreetmap
+
+def deg2tilenum(lat_deg, lon_deg, zoom):
+    lat_rad = math.radians(lat_deg)
+    n = 2 ** zoom
+    xtile = int((lon_deg + 180) / 360 * n)
+    ytile = int((1.0 - math.log(math.tan(lat_rad) + (1.0 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
+    return (min(max(xtile, 0), n - 1), min(max(ytile, 0), n - 1))
+
+def get_tile_range(area, zoom):
+    '''
+    Return the tile numbers (min_x, min_y, max_x, max_y) covering area,
+    which is a pair of coordinates.
+
+    '''
+    c1, c2 = area
+    x1, y1 = deg2tilenum(max(c1.lat, c2.lat), min(c1.lon, c2.lon), zoom)
+    x2, y2 = deg2tilenum(min(c1.lat, c2.lat), max(c1.lon, c2.lon), zoom)
+    return (x1, y1, x2, y2)
+
+def get_area_around(coord, radius):
+    '''
+    Return the area which contains the circle with radius (in km) around coord.
+
+    '''
+    return (coord.transform(-45, radius * 1000 * math.sqrt(2)), coord.transform(-45 + 180, radius * 1000 * math.sqrt(2)))
+
+def make_tile_loader(map_providers, map_path, name = None, downloader = None):
+    '''
+    Create the tile loader for the map provider name (default: the first
+    one) without the need for a map widget.
+
+    '''
+    for provider_name, params in map_providers:
+        if name == None or provider_name == name:
+            tl = openstreetmap.get_tile_loader( ** dict([(str(a), b) for a, b in params.items()]))
+            tl.base_dir = map_path
+            tl.downloader = downloader
+            return provider_name, tl
+    raise Exception("Unknown map provider: %s" % name)
+
+
+class TilePrefetcher():
+    '''
+    Downloads all map tiles for a list of areas in some zoom levels.
+
+    The tiles are generated on the fly, tiles which were already downloaded
+    are skipped. The progress is regularly written to the job file, so an
+    interrupted job can be continued using resume().
+
+    '''
+    # Save the progress after this many tiles
+    SAVE_INTERVAL = 100
+
+    def __init__(self, tile_loader, areas, zooms, job_file = None, concurrency = 4, max_bandwidth = 0, progress_callback = None, name = None):
+        '''
+        areas is a list of pairs of coordinates, zooms a list of zoom levels.
+        max_bandwidth is given in bytes per second, 0 means no limit.
+        progress_callback is called with the number of finished tiles, the
+        (estimated) total number of tiles and the number of errors.
+
+        '''
+        self.tile_loader = tile_loader
+        self.name = name
+        self.areas = areas
+        self.zooms = sorted(set(zooms))
+        self.job_file = job_file
+        self.concurrency = concurrency
+        self.max_bandwidth = max_bandwidth
+        self.progress_callback = progress_callback
+
+        self.lock = Lock()
+        self.stopped = False
+        # All tiles up to this position in the stream are finished
+        self.position = 0
+        # Position of the last tile taken from the stream
+        self.last_position = 0
+        self.running = set()
+        self.finished = 0
+        self.errors = 0
+        self.downloaded_bytes = 0
+        self.start_time = None
+
+        self.total = 0
+        for zoom in self.zooms:
+            for x1, y1, x2, y2 in (get_tile_range(area, zoom) for area in areas):
+                self.total += (x2 - x1 + 1) * (y2 - y1 + 1)
+
+    @staticmethod
+    def resume(tile_loader, job_file, **kwargs):
+        '''
+        Create a prefetcher which continues the job from job_file.
+
+        '''
+        f = open(job_file)
+        try:
+            job = loads(f.read())
+        finally:
+            f.close()
+        areas = [(geo.Coordinate(*a), geo.Coordinate(*b)) for a, b in job['areas']]
+        p = TilePrefetcher(tile_loader, areas, job['zooms'], job_file, name = job.get('name', None), **kwargs)
+        p.position = p.last_position = p.finished = job['position']
+        p.errors = job['errors']
+        return p
+
+    @staticmethod
+    def get_job_name(job_file):
+        '''
+        Return the name of the map provider of the job in job_file, or None if there is no job.
+
+        '''
+        if not path.exists(job_file):
+            return None
+        f = open(job_file)
+        try:
+            return loads(f.read()).get('name', None)
+        finally:
+            f.close()
+
+    def __save(self):
+        if self.job_file == None:
+            return
+        job = {
+            'name': self.name,
+            'areas': [((a.lat, a.lon), (b.lat, b.lon)) for a, b in self.areas],
+            'zooms': self.zooms,
+            'position': self.position,
+            'errors': self.errors,
+        }
+        f = open(self.job_file + '.tmp', 'w')
+        try:
+            f.write(dumps(job))
+        finally:
+            f.close()
+        rename(self.job_file + '.tmp', self.job_file)
+
+    def get_tiles(self):
+        '''
+        Generate (position, zoom, x, y) for every tile of the job which has
+        not been downloaded yet.
+
+        '''
+        position = 0
+        for zoom in self.zooms:
+            ranges = [get_tile_range(area, zoom) for area in self.areas]
+            for i, (x1, y1, x2, y2) in enumerate(ranges):
+                # Tiles of overlapping areas are only generated once
+                before = [r for r in ranges[:i] if r[0] <= x2 and r[2] >= x1 and r[1] <= y2 and r[3] >= y1]
+                for x in xrange(x1, x2 + 1):
+                    if position + (y2 - y1 + 1) <= self.position:
+                        position += y2 - y1 + 1
+                        continue
+                    existing = None
+                    for y in xrange(y1, y2 + 1):
+                        position += 1
+                        if position <= self.position:
+                            continue
+                        if any(r[0] <= x <= r[2] and r[1] <= y <= r[3] for r in before):
+                            yield position, None, None, None
+                            continue
+                        # The tiles of a column are looked up at once
+                        if existing == None:
+                            existing = self.tile_loader.get_column(zoom, x)
+                        if y in existing:
+                            yield position, None, None, None
+                        else:
+                            yield position, zoom, x, y
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self):
+        '''
+        Download the tiles; blocks until the job is finished or stopped
+        (also by pressing Ctrl+C). Returns True if the job is finished.
+
+        '''
+        self.start_time = time()
+        self.tiles = self.get_tiles()
+        threads = []
+        for i in xrange(max(1, self.concurrency)):
+            t = Thread(target=self.__work)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        try:
+            # Joining with a timeout keeps the thread interruptible
+            for t in threads:
+                while t.isAlive():
+                    t.join(1)
+        except KeyboardInterrupt:
+            self.stop()
+            for t in threads:
+                t.join()
+
+        done = not self.stopped
+        if done and self.job_file != None and path.exists(self.job_file):
+            remove(self.job_file)
+        elif not done:
+            self.__save()
+        logger.info("Prefetched %d tiles (%d errors, %d bytes)" % (self.finished, self.errors, self.downloaded_bytes))
+        return done
+
+    def __next(self):
+        with self.lock:
+            for position, zoom, x, y in self.tiles:
+                self.last_position = position
+                if zoom != None:
+                    self.running.add(position)
+                    return position, zoom, x, y
+                self.__finish(position)
+            return None
+
+    def __finish(self, position, error = False):
+        # called with self.lock held
+        self.running.discard(position)
+        self.finished += 1
+        if error:
+            self.errors += 1
+        if len(self.running) > 0:
+            self.position = min(self.running) - 1
+        else:
+            self.position = self.last_position
+        if self.finished % self.SAVE_INTERVAL == 0:
+            self.__save()
+
+    def __work(self):
+        while not self.stopped:
+            tile = self.__next()
+            if tile == None:
+                return
+            position, zoom, x, y = tile
+            tl = self.tile_loader(None, tile = (x, y), zoom = zoom)
+            try:
+                result = tl.download_tile_only()
+            except Exception, e:
+                logger.exception(e)
+                result = False
+            with self.lock:
+                self.__finish(position, not result)
+                self.downloaded_bytes += tl.downloaded_bytes
+                finished, errors = self.finished, self.errors
+            if self.progress_callback != None:
+                self.progress_callback(finished, self.total, errors)
+            self.__throttle()
+
+    def __throttle(self):
+        if self.max_bandwidth <= 0:
+            return
+        wait = float(self.downloaded_bytes) / self.max_bandwidth - (time() - self.start_time)
+        if wait > 0:
+            sleep(wait)
+
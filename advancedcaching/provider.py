@@ -20,14 +20,250 @@
 #   Bugtracker and GIT Repository: http://github.com/webhamster/advancedcaching
 #
 
-from math import sqrt
-from sqlite3 import connect, Row
+from __future__ import with_statement
+
+from math import cos, degrees, floor, log, radians
+from Queue import Queue
+from sqlite3 import connect, Row, OperationalError
+from threading import current_thread, local, Event, Lock, Thread
+from time import time
 
 from copy import copy
+import sys
+import geo
 import logging
+import re
 logger = logging.getLogger(__name__)
 
 
+class Filter(object):
+    """
+    An immutable set of conditions on geocaches, see PointProvider.set_filter for the settings.
+    
+    The conditions are compiled once to an SQL expression (condition) with parameters (args). Filters with the same settings are equal and have the same hash, so they can be used as dictionary keys. Filters which use the same settings in the same way share the SQL expression, so the statements built from it are reused (see PointProvider._get_statement).
+    
+    """
+    __slots__ = ('settings', 'conditions', 'condition', 'args', '_hash', '_adapted')
+
+    def __init__(self, found=None, has_details=None, owner_search='', name_search='', size=None, terrain=None, diff=None, ctype=None, marked=None, base=None):
+        """
+        base -- Filter whose conditions are kept, the new conditions are added
+        
+        """
+        settings = [('found', found), ('has_details', has_details), ('owner_search', owner_search), ('name_search', name_search), ('size', size), ('terrain', terrain), ('diff', diff), ('ctype', ctype), ('marked', marked)]
+        # Lists and tuples mean different things for terrain and difficulty
+        settings = tuple((name, (type(value).__name__, tuple(value)) if isinstance(value, (list, tuple)) else value) for name, value in settings if value not in (None, ''))
+        filterstring = []
+        filterargs = []
+
+        if found == True:
+            filterstring.append('(found = 1)')
+        elif found == False:
+            filterstring.append('(found = 0)')
+
+        if marked == True:
+            filterstring.append('(marked = 1)')
+        elif marked == False:
+            filterstring.append('(marked = 0)')
+                
+        if has_details == True:
+            filterstring.append("(desc != '' or shortdesc != '')")
+        elif has_details == False:
+            filterstring.append("NOT (desc != '' or shortdesc != '')")
+                        
+        if owner_search != None and len(owner_search) > 2:
+            filterstring.append("(owner LIKE ?)")
+            filterargs.append('%%%s%%' % owner_search)
+                        
+        if name_search != None and len(name_search) > 2:
+            filterstring.append("((name LIKE ?) OR (title LIKE ?))")
+            filterargs.extend(['%%%s%%' % name_search] * 2)
+                        
+        if size != None:
+            filterstring.append('(size IN (%s))' % (", ".join('?' for b in size)))
+            filterargs.extend(size)
+
+        if terrain != None:
+            if type(terrain) == tuple:
+                filterstring.append('(terrain >= ?) AND (terrain <= ?)')
+                filterargs.append(terrain[0] * 10)
+                filterargs.append(terrain[1] * 10)
+            elif type(terrain) == list:
+                filterstring.append('(terrain IN (%s))' % (", ".join('?' for b in terrain)))
+                for b in terrain:
+                    filterargs.append(b * 10)
+
+                        
+        if diff != None:
+            if type(diff) == tuple:
+                filterstring.append('(difficulty >= ?) AND (difficulty <= ?)')
+                filterargs.append(diff[0] * 10)
+                filterargs.append(diff[1] * 10)
+            elif type(diff) == list:
+                filterstring.append('(difficulty IN (%s))' % (", ".join('?' for b in diff)))
+                for b in diff:
+                    filterargs.append(b * 10)
+                        
+        if ctype != None:
+            if len(ctype) > 0:
+                filterstring.append('(type IN (%s))' % (", ".join('?' for b in ctype)))
+                for b in ctype:
+                    filterargs.append(b)
+
+        if base != None:
+            settings = base.settings + settings
+            filterstring = list(base.conditions) + filterstring
+            filterargs = list(base.args) + filterargs
+
+        self.settings = settings
+        self.conditions = tuple(filterstring)
+        self.condition = " AND ".join(filterstring) if len(filterstring) > 0 else '1'
+        self.args = tuple(filterargs)
+        self._hash = hash(settings)
+        self._adapted = {}
+
+    def adapt(self, **kwargs):
+        """
+        Return a filter with the conditions of this filter and those given by kwargs.
+        
+        """
+        key = tuple(sorted(kwargs.items()))
+        if key not in self._adapted:
+            self._adapted[key] = Filter(base=self, **kwargs)
+        return self._adapted[key]
+
+    def __eq__(self, other):
+        return isinstance(other, Filter) and self.settings == other.settings
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return self._hash
+
+
+class QueryCache():
+    """
+    Caches the results of map viewport queries, split into map tiles.
+    
+    Keys are (zoom, x, y) tuples of Web Mercator tiles. A tile holds one list of geocaches per Filter. If the cache holds more than max_points geocaches, the least recently used tiles are removed.
+    
+    The cache may be used from several threads. Results which were read while the database was changed by another thread (see begin_write) are not stored, as they may be outdated.
+    
+    """
+    def __init__(self, max_points):
+        self.max_points = max_points
+        self.lock = Lock()
+        # Incremented after each change of the database
+        self.generation = 0
+        self.writing = 0
+        # key -> [{fingerprint: points}, last use]
+        self.tiles = {}
+        self.points = 0
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+        self.queries = 0
+        self.query_time = 0.0
+
+    def is_empty(self):
+        return len(self.tiles) == 0
+
+    def get(self, key, fingerprint):
+        """
+        Return the list of geocaches in the tile key or None.
+        
+        """
+        with self.lock:
+            tile = self.tiles.get(key, None)
+            if tile == None or fingerprint not in tile[0]:
+                return None
+            self.clock += 1
+            tile[1] = self.clock
+            return tile[0][fingerprint]
+
+    def put(self, key, fingerprint, points, generation):
+        """
+        Store the list of geocaches in the tile key.
+        
+        generation -- Value of self.generation before the geocaches were read
+        
+        """
+        with self.lock:
+            if self.writing > 0 or generation != self.generation:
+                return
+            tile = self.tiles.setdefault(key, [{}, 0])
+            if fingerprint in tile[0]:
+                self.points -= len(tile[0][fingerprint])
+            tile[0][fingerprint] = points
+            self.clock += 1
+            tile[1] = self.clock
+            self.points += len(points)
+            if self.points > self.max_points:
+                self.__evict()
+
+    def begin_write(self):
+        with self.lock:
+            self.writing += 1
+
+    def end_write(self):
+        with self.lock:
+            self.writing -= 1
+            self.generation += 1
+
+    # Remove the least recently used tiles until only 3/4 of the budget is used
+    def __evict(self):
+        for key, tile in sorted(self.tiles.items(), key = lambda x: x[1][1]):
+            if self.points <= self.max_points * 3 / 4:
+                break
+            self.__remove(key)
+
+    def __remove(self, key):
+        tile = self.tiles.pop(key, None)
+        if tile != None:
+            self.points -= sum(len(x) for x in tile[0].values())
+
+    def invalidate(self, positions):
+        """
+        Remove the tiles (in all zoom levels) which contain the normalised Web Mercator positions.
+        
+        """
+        with self.lock:
+            zooms = set(key[0] for key in self.tiles)
+            for x, y in positions:
+                for zoom in zooms:
+                    n = 2 ** zoom
+                    self.__remove((zoom, int(x * n), int(y * n)))
+
+    def clear(self):
+        with self.lock:
+            self.tiles = {}
+            self.points = 0
+
+    def record(self, hits, misses, elapsed):
+        """
+        Count a viewport query which found hits tiles in the cache, read misses tiles from the database and took elapsed seconds.
+        
+        """
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+            self.queries += 1
+            self.query_time += elapsed
+
+    def get_statistics(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / max(1, self.hits + self.misses),
+                'queries': self.queries,
+                'mean_time': self.query_time * 1000 / max(1, self.queries),
+                'tiles': len(self.tiles),
+                'points': self.points,
+            }
+
+
 class PointProvider():
     """
     Stores information about geocaches.
@@ -37,22 +273,47 @@ class PointProvider():
     """
     MAX_RESULTS = 1000
 
-    def __init__(self, filename, ctype):
+    # Number of geocaches which are read by one query when selecting by name;
+    # SQLite allows 999 variables per statement by default
+    CHUNK_SIZE = 900
+
+    # Maximum number of geocaches in the query cache (see _get_points_cached)
+    QUERY_CACHE_SIZE = 50000
+
+    # Viewports for which more geocaches than this have to be read are not cached
+    QUERY_CACHE_MAX_FILL = 10000
+
+    # The tiles of the query cache are between 1/4 and 1/2 of the viewport wide
+    QUERY_CACHE_ZOOM_OFFSET = 2
+
+    # Columns of the full-text index (see get_points_search)
+    FTS_COLUMNS = ('title', 'owner', 'shortdesc', 'desc', 'hints', 'logs')
+
+    def __init__(self, filename, ctype, use_rtree=True, stubtype=None, clustertype=None, use_fts=True, compress=False):
         """
         Initialize this data provider. 
         
         filename -- Filename to save the data to, depends on the OS
         ctype -- Python type which represents a geocache
+        stubtype -- Python type which represents a geocache of which only some fields are loaded (see _pack_result)
+        clustertype -- Python type which represents a group of geocaches (see get_clusters)
+        use_rtree -- Use an R*Tree index for bounding box queries if the SQLite library supports it
+        use_fts -- Use a full-text index for get_points_search if the SQLite library supports it
+        compress -- Store the large text columns compressed (see set_compression)
         
         """
         self.filterstack = []
-        self.conn = connect(filename)
-        self.conn.row_factory = Row
-        self.conn.text_factory = unicode
         self.ctype = ctype
+        self.conn = self._connect(filename)
+        self.stubtype = stubtype
+        self.clustertype = clustertype
         self.cache_table = 'geocaches'
-        self.filterstring = []
-        self.filterargs = []
+        self.rtree_table = '%s_rtree' % self.cache_table
+        self.import_table = '%s_import' % self.cache_table
+        self.fts_table = '%s_fts' % self.cache_table
+        self.current_filter = Filter()
+        # SQL statements built for filters, see _get_statement
+        self.statements = {}
 
         # yes, the synchronous=off setting is a bit dangerous for the database,
         # but the advantages outbalance unlikely database corruption
@@ -61,16 +322,42 @@ class PointProvider():
             'PRAGMA synchronous=OFF;' \
             'PRAGMA cache_size = -2048;' \
             'PRAGMA count_changes = OFF;' \
+            'PRAGMA recursive_triggers = ON;' \
             'CREATE TABLE IF NOT EXISTS %s (%s);' % (self.cache_table, ', '.join('%s %s' % m for m in self.ctype.SQLROW.items())))
         self.check_table()
+        self.check_mercator()
         self.conn.executescript(
             'CREATE INDEX IF NOT EXISTS %(table)s_latlon ON %(table)s (lat ASC, lon ASC);' \
             'DROP INDEX IF EXISTS %(table)s_name;'
             'CREATE UNIQUE INDEX IF NOT EXISTS %(table)s_name_unique ON %(table)s (name ASC);' \
             'CREATE INDEX IF NOT EXISTS %(table)s_fieldnote ON %(table)s (logas);' % {'table' : self.cache_table}
             )
+        self.use_rtree = use_rtree and self.check_rtree()
+        self.fts = self.check_fts() if use_fts else None
+        self.compressed = self._get_compressed_columns(compress)
+        self.query_cache = QueryCache(self.QUERY_CACHE_SIZE)
 
         self.to_replace_string = ', '.join("%s=:%s" % (x, x) for x in self.ctype.NON_USER_ATTRS)
+        self.insert_string = "INSERT INTO %s (`%s`) VALUES (%s)" % (self.cache_table, '`, `'.join(self.ctype.SQLROW.keys()), ', '.join(':%s' % k for k in self.ctype.SQLROW.keys()))
+
+        # Staging table for add_points
+        self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS %s (%s)' % (self.import_table, ', '.join('%s %s' % m for m in self.ctype.SQLROW.items())))
+        if self.stubtype != None:
+            self.stub_columns = ', '.join(['%s.`%s`' % (self.cache_table, x) for x in self.stubtype.STUB_ATTRS + getattr(self.stubtype, 'MERCATOR_ATTRS', ())] + ["(%s.logs IS NOT NULL AND %s.logs != '') AS stub_downloaded" % (self.cache_table, self.cache_table)])
+            self.stub_details_query = 'SELECT `%s` FROM %s WHERE name = ? LIMIT 1' % ('`, `'.join(self.stubtype.LAZY_ATTRS), self.cache_table)
+
+    def _connect(self, filename):
+        """
+        Open a connection to the database.
+        
+        Compressed text (see set_compression) can be read in SQL using the function uncompress_text.
+        
+        """
+        conn = connect(filename)
+        conn.row_factory = Row
+        conn.text_factory = unicode
+        conn.create_function('uncompress_text', 1, getattr(self.ctype, 'decompress_text', lambda x: x))
+        return conn
 
     def check_table(self):
         """
@@ -93,7 +380,156 @@ class PointProvider():
             print "Updating your Database, adding Column %s to Table %s:\n%s" % (name, self.cache_table, cmd)
             c.execute(cmd)
         self.save()
+
+    def check_mercator(self):
+        """
+        Calculate the Web Mercator position of the geocaches where it is missing.
+        
+        If self.ctype stores the projected position (see MERCATOR_ATTRS), it is written along with every geocache. Only geocaches which were stored before the columns existed need to be updated here.
+        
+        """
+        if 'merc_x' not in self.ctype.SQLROW:
+            return
+        c = self.conn.execute('SELECT rowid, lat, lon FROM %s WHERE merc_x IS NULL AND lat IS NOT NULL AND lon IS NOT NULL' % self.cache_table)
+        rows = [geo.mercator(lat, lon) + (rowid,) for rowid, lat, lon in c]
+        c.close()
+        if len(rows) == 0:
+            return
+        logger.info("Calculating map positions for %d geocaches" % len(rows))
+        self.conn.executemany('UPDATE %s SET merc_x = ?, merc_y = ? WHERE rowid = ?' % self.cache_table, rows)
+        self.save()
+
+    def check_rtree(self):
+        """
+        Set up the R*Tree index for bounding box queries.
+        
+        The R*Tree virtual table holds one (degenerated) box per geocache, using the geocache's rowid as id. It is kept in sync with the geocache table by triggers, so no other method needs to care about it. If the table is created for the first time, it is filled from the existing geocaches.
+        Returns False if the SQLite library was compiled without R*Tree support.
+        
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (self.rtree_table,))
+        existing = (c.fetchone() != None)
+        c.close()
+        try:
+            self.conn.executescript(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS %(rtree)s USING rtree(id, minlat, maxlat, minlon, maxlon);' \
+                'CREATE TRIGGER IF NOT EXISTS %(rtree)s_insert AFTER INSERT ON %(table)s BEGIN ' \
+                    'INSERT OR REPLACE INTO %(rtree)s VALUES (new.rowid, new.lat, new.lat, new.lon, new.lon); END;' \
+                'CREATE TRIGGER IF NOT EXISTS %(rtree)s_update AFTER UPDATE OF lat, lon ON %(table)s BEGIN ' \
+                    'UPDATE %(rtree)s SET minlat = new.lat, maxlat = new.lat, minlon = new.lon, maxlon = new.lon WHERE id = new.rowid; END;' \
+                'CREATE TRIGGER IF NOT EXISTS %(rtree)s_delete AFTER DELETE ON %(table)s BEGIN ' \
+                    'DELETE FROM %(rtree)s WHERE id = old.rowid; END;' % {'table': self.cache_table, 'rtree': self.rtree_table}
+                )
+        except OperationalError, e:
+            logger.info("No R*Tree support in SQLite, using the B-tree index instead: %s" % e)
+            return False
+        if not existing:
+            logger.info("Building R*Tree index for table %s" % self.cache_table)
+            self.conn.execute('INSERT INTO %s SELECT rowid, lat, lat, lon, lon FROM %s' % (self.rtree_table, self.cache_table))
+            self.save()
+        return True
+        
+    def check_fts(self):
+        """
+        Set up the full-text index over the columns in FTS_COLUMNS.
         
+        The index holds the uncompressed text (see set_compression), so it is kept in sync by triggers which call uncompress_text. This function only exists on the connections of this class, so these triggers are TEMP triggers of the connection which writes; a trigger in the database file would keep every other program (such as older versions or the sqlite3 shell) from changing the geocaches. Changes by other programs are counted by permanent triggers which only use plain SQL, and the index is rebuilt if it missed any.
+        FTS5 is preferred; its index is contentless, so the text is not stored twice and the compressed columns are never read by FTS5 itself. FTS4 is used with older SQLite libraries; it can not delete from contentless indexes, so it uses the geocache table as external content and the indexed columns are not compressed (see _get_compressed_columns). If the index is created for the first time, it is built from the existing geocaches.
+        Returns the FTS module in use ('fts5' or 'fts4'), or None if the SQLite library supports neither.
+        
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (self.fts_table,))
+        row = c.fetchone()
+        c.close()
+        if row != None and 'fts5' in row[0].lower() and "content='%s'" % self.cache_table in row[0]:
+            # Earlier FTS5 indexes used the geocache table as external content, which may be compressed
+            logger.info("Replacing the full-text index of table %s by a contentless one" % self.cache_table)
+            self.conn.execute('DROP TABLE %s' % self.fts_table)
+            row = None
+        if row != None:
+            modules = ['fts5' if 'fts5' in row[0].lower() else 'fts4']
+        else:
+            modules = ['fts5', 'fts4']
+        values = {
+            'table': self.cache_table,
+            'fts': self.fts_table,
+            'state': '%s_state' % self.fts_table,
+            'columns': ', '.join('`%s`' % x for x in self.FTS_COLUMNS),
+            'new': ', '.join('uncompress_text(new.`%s`)' % x for x in self.FTS_COLUMNS),
+            'old': ', '.join('uncompress_text(old.`%s`)' % x for x in self.FTS_COLUMNS),
+            'content': ', '.join('uncompress_text(`%s`)' % x for x in self.FTS_COLUMNS),
+        }
+        # Earlier versions kept the triggers which call uncompress_text in the database file
+        self.conn.executescript(
+            'DROP TRIGGER IF EXISTS main.%(fts)s_insert;' \
+            'DROP TRIGGER IF EXISTS main.%(fts)s_delete;' \
+            'DROP TRIGGER IF EXISTS main.%(fts)s_update_before;' \
+            'DROP TRIGGER IF EXISTS main.%(fts)s_update;' % values)
+        for module in modules:
+            if module == 'fts5':
+                script = \
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS %(fts)s USING fts5(%(columns)s, content='');" \
+                    'CREATE TEMP TRIGGER IF NOT EXISTS %(fts)s_insert AFTER INSERT ON main.%(table)s BEGIN ' \
+                        'INSERT INTO %(fts)s (rowid, %(columns)s) VALUES (new.rowid, %(new)s); ' \
+                        'UPDATE %(state)s SET indexed = indexed + 1; END;' \
+                    'CREATE TEMP TRIGGER IF NOT EXISTS %(fts)s_delete AFTER DELETE ON main.%(table)s BEGIN ' \
+                        "INSERT INTO %(fts)s (%(fts)s, rowid, %(columns)s) VALUES ('delete', old.rowid, %(old)s); " \
+                        'UPDATE %(state)s SET indexed = indexed + 1; END;' \
+                    'CREATE TEMP TRIGGER IF NOT EXISTS %(fts)s_update AFTER UPDATE OF %(columns)s ON main.%(table)s BEGIN ' \
+                        "INSERT INTO %(fts)s (%(fts)s, rowid, %(columns)s) VALUES ('delete', old.rowid, %(old)s); " \
+                        'INSERT INTO %(fts)s (rowid, %(columns)s) VALUES (new.rowid, %(new)s); ' \
+                        'UPDATE %(state)s SET indexed = indexed + 1; END;'
+            else:
+                # FTS4 reads the old values from the content table, so they have to be removed before they change
+                script = \
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS %(fts)s USING fts4(%(columns)s, content='%(table)s', tokenize=unicode61);" \
+                    'CREATE TEMP TRIGGER IF NOT EXISTS %(fts)s_insert AFTER INSERT ON main.%(table)s BEGIN ' \
+                        'INSERT INTO %(fts)s (docid, %(columns)s) VALUES (new.rowid, %(new)s); ' \
+                        'UPDATE %(state)s SET indexed = indexed + 1; END;' \
+                    'CREATE TEMP TRIGGER IF NOT EXISTS %(fts)s_delete BEFORE DELETE ON main.%(table)s BEGIN ' \
+                        'DELETE FROM %(fts)s WHERE docid = old.rowid; ' \
+                        'UPDATE %(state)s SET indexed = indexed + 1; END;' \
+                    'CREATE TEMP TRIGGER IF NOT EXISTS %(fts)s_update_before BEFORE UPDATE OF %(columns)s ON main.%(table)s BEGIN ' \
+                        'DELETE FROM %(fts)s WHERE docid = old.rowid; END;' \
+                    'CREATE TEMP TRIGGER IF NOT EXISTS %(fts)s_update AFTER UPDATE OF %(columns)s ON main.%(table)s BEGIN ' \
+                        'INSERT INTO %(fts)s (docid, %(columns)s) VALUES (new.rowid, %(new)s); ' \
+                        'UPDATE %(state)s SET indexed = indexed + 1; END;'
+            try:
+                self.conn.executescript(script % values)
+            except OperationalError, e:
+                logger.info("No %s support in SQLite: %s" % (module, e))
+                continue
+            self.conn.executescript(
+                'CREATE TABLE IF NOT EXISTS %(state)s (changes INTEGER, indexed INTEGER);' \
+                'CREATE TRIGGER IF NOT EXISTS %(fts)s_count_insert AFTER INSERT ON %(table)s BEGIN ' \
+                    'UPDATE %(state)s SET changes = changes + 1; END;' \
+                'CREATE TRIGGER IF NOT EXISTS %(fts)s_count_delete AFTER DELETE ON %(table)s BEGIN ' \
+                    'UPDATE %(state)s SET changes = changes + 1; END;' \
+                'CREATE TRIGGER IF NOT EXISTS %(fts)s_count_update AFTER UPDATE OF %(columns)s ON %(table)s BEGIN ' \
+                    'UPDATE %(state)s SET changes = changes + 1; END;' % values)
+            state = self.conn.execute('SELECT changes, indexed FROM %(state)s' % values).fetchone()
+            if state == None:
+                # Databases of earlier versions did not count the changes
+                self.conn.execute('INSERT INTO %(state)s VALUES (0, 0)' % values)
+            if row == None:
+                logger.info("Building full-text index for table %s" % self.cache_table)
+                values['rowid'] = 'rowid' if module == 'fts5' else 'docid'
+                self.conn.execute('INSERT INTO %(fts)s (%(rowid)s, %(columns)s) SELECT rowid, %(content)s FROM %(table)s' % values)
+            elif state == None or state[0] != state[1]:
+                logger.info("Rebuilding full-text index for table %s, it was changed by another program" % self.cache_table)
+                if module == 'fts5':
+                    self.conn.execute("INSERT INTO %(fts)s (%(fts)s) VALUES ('delete-all')" % values)
+                    self.conn.execute('INSERT INTO %(fts)s (rowid, %(columns)s) SELECT rowid, %(content)s FROM %(table)s' % values)
+                else:
+                    self.conn.execute("INSERT INTO %(fts)s (%(fts)s) VALUES ('rebuild')" % values)
+            self.conn.execute('UPDATE %(state)s SET indexed = changes' % values)
+            self.save()
+            return module
+        logger.info("No full-text search support in SQLite, searching without index")
+        return None
+
     def get_table_info(self):
         """
         Get information about the fields in the geocache table.
@@ -126,8 +562,9 @@ class PointProvider():
         replace -- If False, update the existing geocache, but only the fields listed in self.ctype.NON_USER_ATTRS. This is useful when existing user data, such as notes, should not be overwritten. If True, replace existing geocaches, deleting user data (unless user data was manually retained).
         
         """
+        self._invalidate([p.name], [p])
         if replace:
-            self.conn.execute("INSERT OR REPLACE INTO %s (`%s`) VALUES (%s)" % (self.cache_table, '`, `'.join(self.ctype.SQLROW.keys()), ', '.join(':%s' % k for k in self.ctype.SQLROW.keys())), p.serialize())
+            self.conn.execute(self.insert_string.replace('INSERT', 'INSERT OR REPLACE', 1), p.serialize(self.compressed))
             return None
         else:
             c = self.conn.cursor()
@@ -138,11 +575,47 @@ class PointProvider():
             
              
             if existing:
-                self.conn.execute("UPDATE %s SET %s WHERE name=:name" % (self.cache_table, self.to_replace_string), p.__dict__)
+                self.conn.execute("UPDATE %s SET %s WHERE name=:name" % (self.cache_table, self.to_replace_string), p.serialize(self.compressed))
                 return False
             else:
-                self.conn.execute("INSERT INTO %s (`%s`) VALUES (%s)" % (self.cache_table, '`, `'.join(self.ctype.SQLROW.keys()), ', '.join(':%s' % k for k in self.ctype.SQLROW.keys())), p.serialize())
+                self.conn.execute(self.insert_string, p.serialize(self.compressed))
                 return True
+
+    def add_points(self, points, replace=False):
+        """
+        Add many geocaches to the database at once.
+        
+        The geocaches are written to a temporary staging table using a single prepared statement and then merged into the geocache table by a few set-based statements. As with add_point, the changes are not committed.
+        points -- Iterable of geocaches
+        replace -- See add_point.
+        
+        Returns a tuple (new, updated) of lists containing the names of the geocaches which were inserted and of those which already existed, respectively.
+        
+        """
+        columns = '`%s`' % '`, `'.join(self.ctype.SQLROW.keys())
+        values = {'table': self.cache_table, 'import': self.import_table, 'columns': columns}
+        self.conn.execute('DELETE FROM %(import)s' % values)
+        self.conn.executemany(self.insert_string.replace('INSERT INTO %s' % self.cache_table, 'INSERT OR REPLACE INTO %s' % self.import_table, 1), (p.serialize(self.compressed) for p in points))
+
+        c = self.conn.execute('SELECT name, name IN (SELECT name FROM %(table)s) AS existing FROM %(import)s' % values)
+        new, updated = [], []
+        for row in c:
+            (updated if row['existing'] else new).append(row['name'])
+        c.close()
+
+        if not self.query_cache.is_empty():
+            c = self.conn.execute('SELECT lat, lon FROM %(import)s UNION ALL SELECT lat, lon FROM %(table)s WHERE name IN (SELECT name FROM %(import)s)' % values)
+            self.query_cache.invalidate([geo.mercator(lat, lon) for lat, lon in c if lat != None and lon != None])
+            c.close()
+
+        if replace:
+            self.conn.execute('INSERT OR REPLACE INTO %(table)s (%(columns)s) SELECT %(columns)s FROM %(import)s' % values)
+        else:
+            values['update'] = ', '.join('`%(c)s` = (SELECT `%(c)s` FROM %(import)s WHERE %(import)s.name = %(table)s.name)' % dict(values, c=x) for x in self.ctype.NON_USER_ATTRS)
+            self.conn.execute('UPDATE %(table)s SET %(update)s WHERE name IN (SELECT name FROM %(import)s)' % values)
+            self.conn.execute('INSERT OR IGNORE INTO %(table)s (%(columns)s) SELECT %(columns)s FROM %(import)s' % values)
+        self.conn.execute('DELETE FROM %(import)s' % values)
+        return new, updated
                 
                 
     def get_all(self):
@@ -167,19 +640,40 @@ class PointProvider():
         c = self.conn.execute(query)
         return self._pack_result(c)
                 
-    def get_points(self, c1, c2, max_points = None):
+    def _location_filter(self, c1, c2):
+        """
+        Return the source table(s), a condition and its arguments which restrict a query to the boundaries given by the corners c1 and c2.
+        
+        If the R*Tree index is available, the geocache table is joined to it, so that SQLite searches in both dimensions at once. As the R*Tree stores 32 bit floats, the exact comparison is still applied to the rows found.
+        
+        """
+        args = (min(c1.lat, c2.lat), max(c1.lat, c2.lat), min(c1.lon, c2.lon), max(c1.lon, c2.lon))
+        condition = '(lat BETWEEN ? AND ?) AND (lon BETWEEN ? AND ?)'
+        if not self.use_rtree:
+            return self.cache_table, condition, args
+        # CROSS JOIN makes sure that SQLite starts with the R*Tree
+        source = '%(rtree)s CROSS JOIN %(table)s ON %(table)s.rowid = %(rtree)s.id' % {'table': self.cache_table, 'rtree': self.rtree_table}
+        condition = '(maxlat >= ? AND minlat <= ? AND maxlon >= ? AND minlon <= ?) AND %s' % condition
+        return source, condition, args + args
+                
+    def get_points(self, c1, c2, max_points = None, stub = False):
         """
         Return points in the given boundaries.
         
         Returns all points within the boundaries given by the two corners c1 and c2. If max_points is given, return max_points or less.
+        stub -- Return stubs instead of full geocaches (see _pack_result)
         
         """
-        query = 'SELECT * FROM %s WHERE (lat BETWEEN ? AND ?) AND (lon BETWEEN ? AND ?)' % self.cache_table
-        args = (min(c1.lat, c2.lat), max(c1.lat, c2.lat), min(c1.lon, c2.lon), max(c1.lon, c2.lon))
+        if stub and self.stubtype != None:
+            points = self._get_points_cached(c1, c2, Filter(), max_points)
+            if points != None:
+                return points
+        source, condition, args = self._location_filter(c1, c2)
+        query = 'SELECT %s FROM %s WHERE %s' % (self._columns(stub), source, condition)
         if max_points != None:
             query = "%s LIMIT %d" % (query, max_points)
         c = self.conn.execute(query, args)
-        return self._pack_result(c)
+        return self._pack_result(c, stub)
             
     def get_new_fieldnotes_count(self):
         """
@@ -225,48 +719,68 @@ class PointProvider():
         """ 
         Get the geocache closest to center.
         
-        The distance calculation is performed in python. First, all geocaches between c1 and c2 are retrieved from the database. Afterwards, the distance to center is calculated in python and the closest cache is selected. 
+        Only geocaches between c1 and c2 are considered, see get_points_within.
         center -- Center coordinate
         c1 -- Corner 
         c2 -- Corner
         found -- Retrieve only found/not found geocaches (None = all, True = only found, False = only not found)
         
         """
-        filterstring = copy(self.filterstring)
-        filterargs = copy(self.filterargs)
-                
-        filterstring.append('((lat BETWEEN ? AND ?) AND (lon BETWEEN ? AND ?))')
-        filterargs.append(min(c1.lat, c2.lat))
-        filterargs.append(max(c1.lat, c2.lat))
-        filterargs.append(min(c1.lon, c2.lon))
-        filterargs.append(max(c1.lon, c2.lon))
+        # The circle around center must contain the whole box
+        radius = max(center.distance_to(c) for c in (c1, c2, geo.Coordinate(c1.lat, c2.lon), geo.Coordinate(c2.lat, c1.lon)))
+        points = self.get_points_within(center, radius, found, 1, location=(c1, c2))
+        if len(points) == 0:
+            return None
+        return points[0]
 
-        if found == True:
-            filterstring.append('(found = 1)')
-        elif found == False:
-            filterstring.append('(found = 0)')
-    
+    def get_points_within(self, center, radius, found=None, max_results=None, order_by_distance=True, stub=False, location=None):
+        """
+        Get the geocaches within radius (in meters) around center according to the current filter.
         
-        # we don't have 'power' or other advanced mathematic operators
-        # in sqlite, so doing distance calculation in python
-        query = 'SELECT * FROM %s WHERE %s' % (self.cache_table, " AND ".join(filterstring))
-                
-        c = self.conn.execute(query, tuple(filterargs))
+        SQLite selects the geocaches in the surrounding box first, only their positions are read. The exact distances are then calculated at once (see geo.distances_from) and only the geocaches which are returned are loaded.
+        found -- Include found geocaches (None/True/False)
+        max_results -- Maximum number of results (None = self.MAX_RESULTS)
+        order_by_distance -- Return the nearest geocaches first. If max_results is reached, the nearest geocaches are returned.
+        stub -- Return stubs instead of full geocaches (see _pack_result)
+        location -- Additionally restrict the results to these boundaries
+        
+        """
+        if max_results == None:
+            max_results = self.MAX_RESULTS
 
-        mindist = () # we use this as positive infinity
-        mindistrow = None
-        for row in c:
-            # we have points very close to each other
-            # for the sake of performance, using simpler
-            # distance calc here
-            dist = sqrt((row['lat'] - center.lat) ** 2 + (row['lon'] - center.lon) ** 2)
-            if dist < mindist:
-                mindistrow = row
-                mindist = dist
-        if mindistrow == None:
-            return None
-        coord = self.ctype(mindistrow['lat'], mindistrow['lon'], '', mindistrow)
-        return coord
+        # Box around the circle; a degree of latitude is about 111 km
+        dlat = degrees(radius / geo.Coordinate.RADIUS_EARTH)
+        minlat, maxlat = max(-90.0, center.lat - dlat), min(90.0, center.lat + dlat)
+        if max(abs(minlat), abs(maxlat)) >= 90.0:
+            minlon, maxlon = -180.0, 180.0
+        else:
+            dlon = dlat / cos(radians(max(abs(minlat), abs(maxlat))))
+            minlon, maxlon = max(-180.0, center.lon - dlon), min(180.0, center.lon + dlon)
+        if location != None:
+            c1, c2 = location
+            minlat, maxlat = max(minlat, min(c1.lat, c2.lat)), min(maxlat, max(c1.lat, c2.lat))
+            minlon, maxlon = max(minlon, min(c1.lon, c2.lon)), min(maxlon, max(c1.lon, c2.lon))
+            if minlat > maxlat or minlon > maxlon:
+                return []
+
+        f = self._get_filter(found)
+        source, condition, args = self._location_filter(geo.Coordinate(minlat, minlon), geo.Coordinate(maxlat, maxlon))
+        query = self._get_statement(('within', f.condition), lambda: 'SELECT %s.name, lat, lon FROM %s WHERE %s AND %s' % (self.cache_table, source, condition, f.condition))
+        rows = self.conn.execute(query, args + f.args).fetchall()
+        distances = geo.distances_from(center, [row[1] for row in rows], [row[2] for row in rows])
+        found_rows = [(distance, row[0]) for distance, row in zip(distances, rows) if distance <= radius]
+        if order_by_distance:
+            found_rows.sort()
+        names = [name for distance, name in found_rows[:max_results]]
+
+        # Load the geocaches in chunks to stay below SQLite's limit of variables
+        points = {}
+        for i in xrange(0, len(names), self.CHUNK_SIZE):
+            chunk = names[i:i + self.CHUNK_SIZE]
+            query = 'SELECT %s FROM %s WHERE name IN (%s)' % (self._columns(stub), self.cache_table, ', '.join('?' for x in chunk))
+            for point in self._pack_result(self.conn.execute(query, chunk), stub):
+                points[point.name] = point
+        return [points[name] for name in names]
                 
     def set_filter(self, found=None, has_details=None, owner_search='', name_search='', size=None, terrain=None, diff=None, ctype=None, adapt_filter=False, marked=None):
         """
@@ -275,131 +789,281 @@ class PointProvider():
         A value of None for any attribute means that no filtering is applied.
         adapt_filter -- Copy the filter which was in effect until now and change it. If False, start over with clean filter settings.
         
+        Returns the new Filter, which can be applied again using use_filter.
+        
         """
-        filter = copy(locals())
-        del filter['self']
-        self.filter = filter
-
-        if adapt_filter:
-            filterstring = copy(self.filterstring)
-            filterargs = copy(self.filterargs)
-        else:
-            filterstring = []
-            filterargs = []
-                
-        if found == True:
-            filterstring.append('(found = 1)')
-        elif found == False:
-            filterstring.append('(found = 0)')
+        self.current_filter = Filter(found=found, has_details=has_details, owner_search=owner_search, name_search=name_search, size=size, terrain=terrain, diff=diff, ctype=ctype, marked=marked, base=self.current_filter if adapt_filter else None)
+        return self.current_filter
 
-        if marked == True:
-            filterstring.append('(marked = 1)')
-        elif marked == False:
-            filterstring.append('(marked = 0)')
-                
-        if has_details == True:
-            filterstring.append("(desc != '' or shortdesc != '')")
-        elif has_details == False:
-            filterstring.append("NOT (desc != '' or shortdesc != '')")
-                        
-        if owner_search != None and len(owner_search) > 2:
-            filterstring.append("(owner LIKE '%%%s%%')" % owner_search)
-                        
-        if name_search != None and len(name_search) > 2:
-            filterstring.append("((name LIKE '%%%s%%') OR (title LIKE '%%%s%%'))" % (name_search, name_search))
-                        
-        if size != None:
-            filterstring.append('(size IN (%s))' % (", ".join(str(b) for b in size)))
-
-        if terrain != None:
-            if type(terrain) == tuple:
-                filterstring.append('(terrain >= ?) AND (terrain <= ?)')
-                filterargs.append(terrain[0] * 10)
-                filterargs.append(terrain[1] * 10)
-            elif type(terrain) == list:
-                filterstring.append('(terrain IN (%s))' % (", ".join('?' for b in terrain)))
-                for b in terrain:
-                    filterargs.append(b * 10)
+    def use_filter(self, filter):
+        """
+        Apply a Filter which was created before.
+        
+        """
+        self.current_filter = filter
 
-                        
-        if diff != None:
-            if type(diff) == tuple:
-                filterstring.append('(difficulty >= ?) AND (difficulty <= ?)')
-                filterargs.append(diff[0] * 10)
-                filterargs.append(diff[1] * 10)
-            elif type(diff) == list:
-                filterstring.append('(difficulty IN (%s))' % (", ".join('?' for b in diff)))
-                for b in diff:
-                    filterargs.append(b * 10)
-                        
-        if ctype != None:
-            if len(ctype) > 0:
-                filterstring.append('(type IN (%s))' % (", ".join('?' for b in ctype)))
-                for b in ctype:
-                    filterargs.append(b)
-                                        
-        if len(filterstring) == 0:
-            filterstring.append('1')
-                
-        self.filterstring = filterstring
-        self.filterargs = filterargs
+    def get_filter(self):
+        """
+        Return the Filter which is currently applied.
+        
+        """
+        return self.current_filter
                 
     def push_filter(self):
         """
         Push the current filter settings to a stack of filter settings.
         
         """
-        self.filterstack.append((self.filterstring, self.filterargs))
+        self.filterstack.append(self.current_filter)
                 
     def pop_filter(self):
         """ 
         Pop the topmost filter settings off the filter settings stack and apply it.
         
         """
-        self.filterstring, self.filterargs = self.filterstack.pop()
+        self.current_filter = self.filterstack.pop()
+
+    def _get_filter(self, found):
+        """
+        Return the current filter, restricted to found/not found geocaches if found is not None.
+        
+        """
+        if found == None:
+            return self.current_filter
+        return self.current_filter.adapt(found=found)
+
+    def _get_statement(self, key, build):
+        """
+        Return the SQL statement for key, which is built by calling build the first time.
+        
+        As the filters are compiled to SQL with parameters, a statement only depends on the shape of the filter. Reusing the same statement text also lets the sqlite3 module reuse the prepared statement.
+        
+        """
+        try:
+            return self.statements[key]
+        except KeyError:
+            statement = self.statements[key] = build()
+            return statement
                 
-    def get_points_filter(self, location=None, found=None, max_results=None):
+    def get_points_filter(self, location=None, found=None, max_results=None, stub=False):
         """
         Get geocaches according to the current filter.
         
         location -- Boundaries for the geographic location
         found -- Include found geocaches (None/True/False)
         max_results -- Maximum number of results (None = all)
+        stub -- Return stubs instead of full geocaches (see _pack_result)
         """
-        filterstring = copy(self.filterstring)
-        filterargs = copy(self.filterargs)
+        f = self._get_filter(found)
 
         if max_results == None:
             max_results = self.MAX_RESULTS
+
+        if location != None and stub and self.stubtype != None:
+            points = self._get_points_cached(location[0], location[1], f, max_results)
+            if points != None:
+                return points
                 
+        source, condition, args = self.cache_table, '1', ()
+        if location != None:
+            source, condition, args = self._location_filter(*location)
+
+        query = self._get_statement(('filter', f.condition, location != None, stub), lambda: 'SELECT %s FROM %s WHERE %s AND %s LIMIT ?' % (self._columns(stub), source, condition, f.condition))
+        c = self.conn.execute(query, args + f.args + (max_results, ))
+        return self._pack_result(c, stub)
+
+    def _get_points_cached(self, c1, c2, filter, max_results):
+        """
+        Return stubs of the geocaches between c1 and c2 using the query cache.
+        
+        The area is divided into map tiles. Tiles which are cached (also as part of a bigger tile) are taken from the cache, only the remaining tiles are read from the database by one query. Returns None if there are too many geocaches in the area to be cached.
+        filter -- The Filter which is applied in addition to the location; the cached results are stored per filter
+        max_results -- Maximum number of results (None = all)
+        
+        """
+        start = time()
+        minlat, maxlat = min(c1.lat, c2.lat), max(c1.lat, c2.lat)
+        minlon, maxlon = min(c1.lon, c2.lon), max(c1.lon, c2.lon)
+        x1, y1 = geo.mercator(maxlat, minlon)
+        x2, y2 = geo.mercator(minlat, maxlon)
+        size = max(x2 - x1, y2 - y1, 1e-12)
+        zoom = max(0, int(floor(log(1.0 / size, 2))) + self.QUERY_CACHE_ZOOM_OFFSET)
+        n = 2 ** zoom
+        def get_tile(p):
+            x, y = p.get_mercator()
+            return (int(x * n), int(y * n))
+
+        tiles = [(x, y) for x in xrange(int(x1 * n), min(n - 1, int(x2 * n)) + 1) for y in xrange(int(y1 * n), min(n - 1, int(y2 * n)) + 1)]
+
+        points = []
+        missing = []
+        for x, y in tiles:
+            cached = self.query_cache.get((zoom, x, y), filter)
+            if cached != None:
+                points.extend(cached)
+                continue
+            # Tiles of the two zoom levels above contain this tile (when zooming in)
+            for d in (1, 2):
+                cached = self.query_cache.get((zoom - d, x >> d, y >> d), filter)
+                if cached != None:
+                    points.extend(p for p in cached if get_tile(p) == (x, y))
+                    break
+            else:
+                missing.append((x, y))
+
+        if len(missing) > 0:
+            generation = self.query_cache.generation
+            # The box around the missing tiles, with a small margin for rounding errors
+            nw = geo.mercator_inverse(float(min(t[0] for t in missing)) / n, float(min(t[1] for t in missing)) / n)
+            se = geo.mercator_inverse(float(max(t[0] for t in missing) + 1) / n, float(max(t[1] for t in missing) + 1) / n)
+            source, condition, args = self._location_filter(geo.Coordinate(se[0] - 1e-7, nw[1] - 1e-7), geo.Coordinate(nw[0] + 1e-7, se[1] + 1e-7))
+            query = self._get_statement(('filter', filter.condition, True, True), lambda: 'SELECT %s FROM %s WHERE %s AND %s LIMIT ?' % (self._columns(True), source, condition, filter.condition))
+            found = self._pack_result(self.conn.execute(query, args + filter.args + (self.QUERY_CACHE_MAX_FILL + 1, )), True)
+            if len(found) > self.QUERY_CACHE_MAX_FILL:
+                return None
+            by_tile = dict((t, []) for t in missing)
+            for p in found:
+                key = get_tile(p)
+                if key in by_tile:
+                    by_tile[key].append(p)
+            for key, tile_points in by_tile.items():
+                self.query_cache.put((zoom, ) + key, filter, tile_points, generation)
+                points.extend(tile_points)
+
+        points = [p for p in points if minlat <= p.lat <= maxlat and minlon <= p.lon <= maxlon]
+        if max_results != None:
+            points = points[:max_results]
+        self.query_cache.record(len(tiles) - len(missing), len(missing), time() - start)
+        return points
+
+    def _invalidate(self, names = (), coordinates = ()):
+        """
+        Remove the cached query results for the positions of the geocaches with the given names (as stored in the database) and the given coordinates.
+        
+        """
+        if self.query_cache.is_empty():
+            return
+        positions = [c.get_mercator() for c in coordinates if c.lat != None and c.lon != None]
+        names = list(names)
+        for i in xrange(0, len(names), self.CHUNK_SIZE):
+            chunk = names[i:i + self.CHUNK_SIZE]
+            c = self.conn.execute('SELECT lat, lon FROM %s WHERE name IN (%s)' % (self.cache_table, ', '.join('?' for x in chunk)), chunk)
+            positions.extend(geo.mercator(lat, lon) for lat, lon in c if lat != None and lon != None)
+            c.close()
+        self.query_cache.invalidate(positions)
+
+    def get_query_cache_statistics(self):
+        """
+        Return the number of cached tiles which were used (hits) and read from the database (misses), the share of hits (hit_rate), the number of queries and their mean duration in ms (mean_time) as well as the number of tiles and geocaches in the cache.
+        
+        """
+        return self.query_cache.get_statistics()
+
+    def get_points_search(self, text, location=None, found=None, max_results=None, stub=False):
+        """
+        Search the title, owner, descriptions, hints and logs of the geocaches according to the current filter.
+        
+        All words in text have to be found; they also match longer words starting with them (e.g. "bridge" matches "bridges"). The best matches are returned first if the full-text index uses FTS5. Without a full-text index, the columns are searched one by one, which is much slower.
+        location -- Boundaries for the geographic location
+        found -- Include found geocaches (None/True/False)
+        max_results -- Maximum number of results (None = self.MAX_RESULTS, -1 = all)
+        stub -- Return stubs instead of full geocaches (see _pack_result)
+        
+        """
+        if isinstance(text, str):
+            text = text.decode('utf-8', 'replace')
+        words = re.findall(r'\w+', text, re.UNICODE)
+        if len(words) == 0:
+            return []
+        if max_results == None:
+            max_results = self.MAX_RESULTS
+
+        f = self._get_filter(found)
+        filterstring = [f.condition]
+        filterargs = list(f.args)
         if location != None:
             c1, c2 = location
             filterstring.append('(lat BETWEEN ? AND ?) AND (lon BETWEEN ? AND ?)')
-            filterargs.append(min(c1.lat, c2.lat))
-            filterargs.append(max(c1.lat, c2.lat))
-            filterargs.append(min(c1.lon, c2.lon))
-            filterargs.append(max(c1.lon, c2.lon))
-
+            filterargs.extend((min(c1.lat, c2.lat), max(c1.lat, c2.lat), min(c1.lon, c2.lon), max(c1.lon, c2.lon)))
 
-        if found == True:
-            filterstring.append('(found = 1)')
-        elif found == False:
-            filterstring.append('(found = 0)')
+        if self.fts != None:
+            # Only word characters are passed on, so the query can't have a syntax error
+            if self.fts == 'fts5':
+                match = ' '.join('"%s"*' % x for x in words)
+                matches = 'SELECT rowid AS fts_rowid, rank AS fts_rank FROM %s WHERE %s MATCH ?' % (self.fts_table, self.fts_table)
+            else:
+                match = ' '.join('%s*' % x for x in words)
+                matches = 'SELECT docid AS fts_rowid, 0 AS fts_rank FROM %s WHERE %s MATCH ?' % (self.fts_table, self.fts_table)
+            query = 'SELECT %s FROM (%s) CROSS JOIN %s ON %s.rowid = fts_rowid WHERE %s ORDER BY fts_rank LIMIT ?' % (self._columns(stub), matches, self.cache_table, self.cache_table, " AND ".join(filterstring))
+            args = [match] + filterargs + [max_results]
+        else:
+            for word in words:
+                filterstring.append('(%s)' % ' OR '.join(('uncompress_text(`%s`) LIKE ?' if x in self.compressed else '`%s` LIKE ?') % x for x in self.FTS_COLUMNS))
+                filterargs.extend(['%%%s%%' % word] * len(self.FTS_COLUMNS))
+            query = 'SELECT %s FROM %s WHERE %s LIMIT ?' % (self._columns(stub), self.cache_table, " AND ".join(filterstring))
+            args = filterargs + [max_results]
+        c = self.conn.execute(query, tuple(args))
+        return self._pack_result(c, stub)
 
+    def get_clusters(self, location, cell_lat, cell_lon, found=None):
+        """
+        Group the geocaches within location according to the current filter into a grid and return one cluster per grid cell.
+        
+        The counting is done by SQLite, so no geocache is loaded. Returns a list of clustertype objects.
         
-        query = 'SELECT * FROM %s WHERE %s LIMIT %s' % (self.cache_table, " AND ".join(filterstring), max_results)
+        location -- Boundaries for the geographic location
+        cell_lat, cell_lon -- Size of the grid cells in degrees
+        found -- Include found geocaches (None/True/False)
+        """
+        f = self._get_filter(found)
+        c1, c2 = location
+        source, condition, args = self._location_filter(c1, c2)
 
-        c = self.conn.execute(query, tuple(filterargs))
-        return self._pack_result(c)
+        # Cells are counted from the south west corner of the location
+        query = self._get_statement(('clusters', f.condition), lambda: 'SELECT CAST((lat - ?) / ? AS INTEGER) AS cell_y, CAST((lon - ?) / ? AS INTEGER) AS cell_x, type, COUNT(*), SUM(lat), SUM(lon), SUM(found) ' \
+            'FROM %s WHERE %s AND %s GROUP BY cell_y, cell_x, type' % (source, condition, f.condition))
+        cell_args = (min(c1.lat, c2.lat), cell_lat, min(c1.lon, c2.lon), cell_lon)
 
-    def _pack_result(self, cursor):
+        cells = {}
+        for cell_y, cell_x, ctype, count, sum_lat, sum_lon, sum_found in self.conn.execute(query, cell_args + args + f.args):
+            cell = cells.setdefault((cell_y, cell_x), [0, 0.0, 0.0, 0, None, 0])
+            cell[0] += count
+            cell[1] += sum_lat
+            cell[2] += sum_lon
+            cell[3] += sum_found
+            if count > cell[5]:
+                cell[4], cell[5] = ctype, count
+        return [self.clustertype(sum_lat / count, sum_lon / count, count, ctype, float(sum_found) / count) for count, sum_lat, sum_lon, sum_found, ctype, type_count in cells.values()]
+
+    def _columns(self, stub):
+        """
+        Return the list of columns to select for full geocaches or stubs.
+        
+        """
+        if stub and self.stubtype != None:
+            return self.stub_columns
+        return '%s.*' % self.cache_table
+
+    def _pack_result(self, cursor, stub = False):
         """
         Transform all results rows into Geocache objects
         
+        stub -- The rows were selected using _columns(True). Create stubs which read the remaining fields on demand. This saves a lot of time and memory when only the basic information about geocaches is needed, e.g., for drawing the map.
+        
         """
-        points = [self.ctype(None, None, None, row) for row in cursor]
+        if stub and self.stubtype != None:
+            points = [self.stubtype(row, self._get_stub_details) for row in cursor]
+        else:
+            points = [self.ctype(None, None, None, row) for row in cursor]
         cursor.close()
         return points
+
+    def _get_stub_details(self, gcname):
+        """
+        Return the fields of a geocache which are not contained in a stub.
+        
+        """
+        return self.conn.execute(self.stub_details_query, (gcname,)).fetchone()
                 
     def update_field(self, coordinate, field, newvalue, save = True):
         """
@@ -411,11 +1075,32 @@ class PointProvider():
         save -- Commit changes (set to False to speed up multiple changes)
         
         """
+        self._invalidate([coordinate.name], [coordinate])
+        if field in self.compressed:
+            newvalue = self.ctype.compress_text(newvalue)
         query = 'UPDATE %s SET %s = ? WHERE name = ?' % (self.cache_table, field)
         self.conn.execute(query, (newvalue, coordinate.name))
         if save:
             self.save()
 
+    def get_states(self, names):
+        """
+        Return the found status and the update time of the geocaches with the given names which are in the database.
+        
+        This is much faster than reading the geocaches one by one, e.g. to decide which geocaches of a search result need to be downloaded.
+        Returns a dictionary which maps the names to (found, updated) tuples, see ctype.get_updated for the meaning of updated.
+        
+        """
+        names = list(names)
+        states = {}
+        for i in xrange(0, len(names), self.CHUNK_SIZE):
+            chunk = names[i:i + self.CHUNK_SIZE]
+            c = self.conn.execute('SELECT name, found, updated FROM %s WHERE name IN (%s)' % (self.cache_table, ', '.join('?' for x in chunk)), chunk)
+            for name, found, updated in c:
+                states[name] = (bool(found), updated or 0)
+            c.close()
+        return states
+
     def get_by_name(self, gcname):
         """
         Return a geocache by its name (where name is the ID)
@@ -440,6 +1125,7 @@ class PointProvider():
         
         """
         names = [x.name for x in l if x.name != '']
+        self._invalidate(names, l)
         query = 'DELETE FROM %s WHERE name IN (%s)' % (self.cache_table, (','.join('?' for x in names)))
         
         self.conn.execute(query, tuple(names))
@@ -453,3 +1139,211 @@ class PointProvider():
         
         """
         self.conn.execute('VACUUM')
+
+    def check_fts_integrity(self):
+        """
+        Check that the full-text index is consistent, raise a DatabaseError if it is not.
+        
+        For FTS4, the index is compared with the text in the geocache table as well.
+        
+        """
+        if self.fts == 'fts5':
+            self.conn.execute("INSERT INTO %(fts)s (%(fts)s, rank) VALUES ('integrity-check', 1)" % {'fts': self.fts_table})
+        elif self.fts == 'fts4':
+            self.conn.execute("INSERT INTO %(fts)s (%(fts)s) VALUES ('integrity-check')" % {'fts': self.fts_table})
+
+    def _get_compressed_columns(self, compress):
+        """
+        Return the columns which are stored compressed.
+        
+        FTS4 uses the geocache table as external content and reads the old values of indexed columns from it, which does not work for compressed text. Thus, these columns are not compressed if FTS4 is in use.
+        
+        """
+        if not compress:
+            return ()
+        return tuple(x for x in getattr(self.ctype, 'COMPRESSED_ATTRS', ()) if self.fts != 'fts4' or x not in self.FTS_COLUMNS)
+
+    def set_compression(self, compress, progress_callback=None):
+        """
+        Store the large text columns (see ctype.COMPRESSED_ATTRS) compressed or uncompressed from now on, convert the existing geocaches and shrink the database file.
+        
+        progress_callback -- Called with the number of geocaches done and the number of all geocaches
+        Returns the number of geocaches which were converted.
+        
+        """
+        self.compressed = self._get_compressed_columns(compress)
+        columns = getattr(self.ctype, 'COMPRESSED_ATTRS', ())
+        rowids = [row[0] for row in self.conn.execute('SELECT rowid FROM %s' % self.cache_table)]
+        query = 'UPDATE %s SET %s WHERE rowid = ?' % (self.cache_table, ', '.join('`%s` = ?' % x for x in columns))
+        converted = 0
+        for i in xrange(0, len(rowids), self.CHUNK_SIZE):
+            chunk = rowids[i:i + self.CHUNK_SIZE]
+            c = self.conn.execute('SELECT rowid, %s FROM %s WHERE rowid IN (%s)' % (', '.join('`%s`' % x for x in columns), self.cache_table, ', '.join('?' for x in chunk)), chunk)
+            updates = []
+            for row in c:
+                old = list(row)[1:]
+                new = [self.ctype.decompress_text(value) for value in old]
+                new = [self.ctype.compress_text(value) if x in self.compressed else value for x, value in zip(columns, new)]
+                # Only the representation changes, not the text
+                if any(isinstance(a, buffer) != isinstance(b, buffer) for a, b in zip(old, new)):
+                    updates.append(new + [row[0]])
+            c.close()
+            self.conn.executemany(query, updates)
+            # Committed after each chunk, so that the conversion can be interrupted
+            self.conn.commit()
+            converted += len(updates)
+            if progress_callback != None:
+                progress_callback(i + len(chunk), len(rowids))
+        if self.fts != None:
+            # The updates of all rows leave the full-text index fragmented
+            self.conn.execute("INSERT INTO %(fts)s (%(fts)s) VALUES ('optimize')" % {'fts': self.fts_table})
+            self.conn.commit()
+        self.conn.execute('VACUUM')
+        # With WAL, the write-ahead log would keep the size of the whole database
+        self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+        return converted
+
+
+class ThreadedPointProvider(PointProvider, object):
+    """
+    A PointProvider which can be used from several threads at once.
+    
+    The database is switched to write-ahead logging (WAL), so that reading does not block writing and vice versa. All changes are made by a writer thread which owns the only writing connection; the calling thread waits until its change is committed. Every thread which reads gets its own read-only connection. Thus, download threads can read and store geocaches while the main loop redraws the map.
+    
+    The filter settings (see set_filter) are shared by all threads.
+    
+    """
+    def __init__(self, filename, *args, **kwargs):
+        """
+        See PointProvider.__init__ for the arguments.
+        
+        """
+        self.filename = filename
+        self.local = local()
+        self.write_queue = Queue()
+        self.writer = Thread(target=self.__write_loop, name='database writer')
+        self.writer.daemon = True
+        self.writer.start()
+        self.__call_in_writer(self.__init_writer, filename, *args, **kwargs)
+
+    def __get_conn(self):
+        """
+        Return the connection of the current thread, a new read-only connection for threads which did not use the database yet.
+        
+        """
+        try:
+            return self.local.conn
+        except AttributeError:
+            conn = self._connect(self.filename)
+            conn.executescript(
+                'PRAGMA temp_store = MEMORY;' \
+                'PRAGMA cache_size = -2048;' \
+                'PRAGMA query_only = ON;')
+            self.local.conn = conn
+            return conn
+
+    def __set_conn(self, conn):
+        self.local.conn = conn
+
+    conn = property(__get_conn, __set_conn)
+
+    def __init_writer(self, filename, *args, **kwargs):
+        PointProvider.__init__(self, filename, *args, **kwargs)
+        self.conn.commit()
+        mode = self.conn.execute('PRAGMA journal_mode = WAL').fetchone()[0]
+        if mode.lower() != 'wal':
+            logger.warning("SQLite does not support WAL, reading is blocked while writing.")
+        # With WAL, the database can not be corrupted by a crash with this setting
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+
+    def __write_loop(self):
+        while True:
+            job = self.write_queue.get()
+            if job == None:
+                break
+            function, args, kwargs, result = job
+            try:
+                result['value'] = function(*args, **kwargs)
+            except:
+                result['error'] = sys.exc_info()
+            result['done'].set()
+        try:
+            self.conn.close()
+        except AttributeError:
+            pass
+
+    def __call_in_writer(self, function, *args, **kwargs):
+        """
+        Run function in the writer thread, wait for it and return its result.
+        
+        """
+        if current_thread() is self.writer:
+            return function(*args, **kwargs)
+        if not self.writer.isAlive():
+            raise Exception("The database was closed.")
+        result = {'done': Event()}
+        self.write_queue.put((function, args, kwargs, result))
+        result['done'].wait()
+        if 'error' in result:
+            error = result['error']
+            raise error[0], error[1], error[2]
+        return result['value']
+
+    def __write(self, function, *args, **kwargs):
+        """
+        Run function (called in the writer thread) and commit the changes, so that the other threads can read them.
+        
+        """
+        self.query_cache.begin_write()
+        try:
+            try:
+                result = function(self, *args, **kwargs)
+                self.conn.commit()
+                return result
+            except:
+                self.conn.rollback()
+                raise
+        finally:
+            self.query_cache.end_write()
+
+    def add_point(self, *args, **kwargs):
+        return self.__call_in_writer(self.__write, PointProvider.add_point, *args, **kwargs)
+
+    def add_points(self, *args, **kwargs):
+        return self.__call_in_writer(self.__write, PointProvider.add_points, *args, **kwargs)
+
+    def update_field(self, *args, **kwargs):
+        return self.__call_in_writer(self.__write, PointProvider.update_field, *args, **kwargs)
+
+    def remove_geocaches(self, *args, **kwargs):
+        return self.__call_in_writer(self.__write, PointProvider.remove_geocaches, *args, **kwargs)
+
+    def optimize(self):
+        return self.__call_in_writer(PointProvider.optimize, self)
+
+    def set_compression(self, *args, **kwargs):
+        return self.__call_in_writer(PointProvider.set_compression, self, *args, **kwargs)
+
+    def check_fts_integrity(self):
+        # The check is written like a change, so it needs the writing connection
+        return self.__call_in_writer(PointProvider.check_fts_integrity, self)
+
+    def save(self):
+        """
+        All changes are committed right away, so there is nothing left to do.
+        
+        """
+        pass
+
+    def close(self):
+        """
+        Stop the writer thread and close its connection. The database can not be changed afterwards.
+        
+        """
+        if self.writer.isAlive() and current_thread() is not self.writer:
+            self.write_queue.put(None)
+            self.writer.join()
+
+    def __del__(self):
+        # The writer thread commits every change
+        pass
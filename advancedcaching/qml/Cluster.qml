@@ -0,0 +1,30 @@
+import QtQuick 1.0
+import "uiconstants.js" as UI
+
+Rectangle {
+    property variant cluster
+    property variant targetPoint
+    // The area grows with the number of geocaches
+    width: Math.min(56, 2 * (6 + 3 * Math.log(cluster.count)))
+    height: width
+    x: targetPoint[0] - width/2
+    y: targetPoint[1] - height/2
+    radius: width/2
+    color: UI.getCacheColorBackground(cluster)
+    opacity: 0.8
+    z: 900
+    // The share of found geocaches is shown as a grey inner circle
+    Rectangle {
+        anchors.centerIn: parent
+        width: parent.width * Math.sqrt(cluster.foundRatio)
+        height: width
+        radius: width/2
+        color: "#c0c0c0"
+    }
+    Text {
+        anchors.centerIn: parent
+        text: cluster.count
+        color: "black"
+        font.pixelSize: 18
+    }
+}
@@ -9,6 +9,8 @@ Rectangle {
     property int maxZoomLevel: 17;
     property int minZoomLevel: 2;
     property int minZoomLevelShowGeocaches: 9;
+    // Size of the grid cells (in pixels) in which geocaches are clustered
+    property int clusterCellSize: 64;
     property int tileSize: 256;
     property int cornerTileX: 32;
     property int cornerTileY: 21;
@@ -335,6 +337,17 @@ Rectangle {
             }
         }
 
+        Item {
+            id: clusterDisplayContainer
+            Repeater {
+                id: clusterDisplay
+                delegate: Cluster {
+                    cluster: model.cluster
+                    targetPoint: getMappointFromCoord(model.cluster.lat, model.cluster.lon)
+                }
+            }
+        }
+
         Item {
             id: waypointDisplayContainer
             Repeater {
@@ -420,14 +433,22 @@ Rectangle {
 
     function updateGeocaches () {
         console.debug("Update geocaches called")
+        var from = getCoordFromScreenpoint(0,0)
+        var to = getCoordFromScreenpoint(pinchmap.width,pinchmap.height)
         if (zoomLevel < minZoomLevelShowGeocaches) {
             tooManyPoints = true
             //geocacheDisplay.model = emptyList
         } else {
-            var from = getCoordFromScreenpoint(0,0)
-            var to = getCoordFromScreenpoint(pinchmap.width,pinchmap.height)
             tooManyPoints = controller.getGeocaches(geocacheDisplay, from[0], from[1], to[0], to[1]);
         }
+        if (tooManyPoints) {
+            // Show clusters instead of single geocaches
+            var cellLat = Math.abs(from[0] - to[0]) * clusterCellSize / pinchmap.height
+            var cellLon = Math.abs(to[1] - from[1]) * clusterCellSize / pinchmap.width
+            controller.getClusters(clusterDisplay, from[0], from[1], to[0], to[1], cellLat, cellLon);
+        } else {
+            clusterDisplay.model = []
+        }
     }
 
     PinchArea {
@@ -123,7 +123,7 @@ class Controller(QtCore.QObject):
             logger.debug("Declined getGeocaches request")
             return False
         
-        points = self.core.pointprovider.get_points(geo.Coordinate(lat_start, lon_start), geo.Coordinate(lat_end, lon_end), self.MAX_POINTS + 1)
+        points = self.core.pointprovider.get_points(geo.Coordinate(lat_start, lon_start), geo.Coordinate(lat_end, lon_end), self.MAX_POINTS + 1, stub = True)
         
         if len(points) > self.MAX_POINTS:
             self._geocache_list = GeocacheListModel(self.core, [])
@@ -134,6 +134,17 @@ class Controller(QtCore.QObject):
         self.view.rootObject().setGeocacheList(map, self._geocache_list)
         return toomany
 
+    @QtCore.Slot(QtCore.QObject, float, float, float, float, float, float)
+    def getClusters(self, map, lat_start, lon_start, lat_end, lon_end, cell_lat, cell_lon):
+        if self.view.rootObject() == None or lat_start == -lat_end:
+            logger.debug("Declined getClusters request")
+            return
+        # Found geocaches are hidden in QML, so they must not be counted in the clusters either
+        found = False if self.core.settings['options_hide_found'] else None
+        clusters = self.core.pointprovider.get_clusters((geo.Coordinate(lat_start, lon_start), geo.Coordinate(lat_end, lon_end)), cell_lat, cell_lon, found)
+        self._cluster_list = ClusterListModel(clusters)
+        self.view.rootObject().setGeocacheList(map, self._cluster_list)
+
     @QtCore.Slot(float, float, float, float)
     def updateGeocaches(self, lat_start, lon_start, lat_end, lon_end):
         self.core.download_overview([geo.Coordinate(lat_start, lon_start), geo.Coordinate(lat_end, lon_end)], skip_callback = self.core.default_download_skip_callback)
@@ -1224,10 +1235,14 @@ class GeocacheListModel(QtCore.QAbstractListModel):
     def sort(self, by, gpsWrapper):
         logger.debug("Sort called.")
         if by == self.SORT_BY_PROXIMITY:
-            def key(f):
-                if gpsWrapper.gps_last_good_fix._valid():
-                    return f._geocache.distance_to(geo.Coordinate(gpsWrapper.gps_last_good_fix._lat(), gpsWrapper.gps_last_good_fix._lon()))
-                return None
+            if gpsWrapper.gps_last_good_fix._valid():
+                # The distances to all geocaches are calculated at once
+                position = geo.Coordinate(gpsWrapper.gps_last_good_fix._lat(), gpsWrapper.gps_last_good_fix._lon())
+                distances = geo.distances_from(position, [f._geocache.lat for f in self._geocaches], [f._geocache.lon for f in self._geocaches])
+                distance = dict(zip([id(f) for f in self._geocaches], distances))
+                key = lambda f: distance[id(f)]
+            else:
+                key = lambda f: None
         elif by == self.SORT_BY_NAME:
             key = lambda f: f._title()
         elif by == self.SORT_BY_TYPE:
@@ -1250,6 +1265,48 @@ class GeocacheListModel(QtCore.QAbstractListModel):
     def downloadDetails(self):
         self.core.download_cache_details_list([x._geocache for x in self._geocaches]);
 
+class ClusterWrapper(QtCore.QObject):
+    def __init__(self, cluster):
+        QtCore.QObject.__init__(self)
+        self._cluster = cluster
+
+    def _lat(self):
+        return self._cluster.lat
+
+    def _lon(self):
+        return self._cluster.lon
+
+    def _count(self):
+        return self._cluster.count
+
+    def _type(self):
+        return self._cluster.type
+
+    def _found_ratio(self):
+        return self._cluster.found_ratio
+
+    changed = QtCore.Signal()
+
+    lat = QtCore.Property(float, _lat, notify=changed)
+    lon = QtCore.Property(float, _lon, notify=changed)
+    count = QtCore.Property(int, _count, notify=changed)
+    type = QtCore.Property(str, _type, notify=changed)
+    foundRatio = QtCore.Property(float, _found_ratio, notify=changed)
+
+class ClusterListModel(QtCore.QAbstractListModel):
+    COLUMNS = ('cluster',)
+
+    def __init__(self, clusters = []):
+        QtCore.QAbstractListModel.__init__(self)
+        self._clusters = [ClusterWrapper(x) for x in clusters]
+        self.setRoleNames(dict(enumerate(ClusterListModel.COLUMNS)))
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return len(self._clusters)
+
+    def data(self, index, role):
+        return self._clusters[index.row()]
+
 class LogsListModel(QtCore.QAbstractListModel):
     COLUMNS = ('log',)
 
@@ -131,7 +131,7 @@ class SimpleGui(Gui):
 
         self.settings = {}
 
-        Map.set_config(self.core.settings['map_providers'], self.core.settings['download_map_path'], self.noimage_cantload, self.noimage_loading)
+        Map.set_config(self.core.settings['map_providers'], self.core.settings['download_map_path'], self.noimage_cantload, self.noimage_loading, self.core.downloader, self.core.settings['map_tile_cache_size'], self.core.settings['map_revalidate_after'], self.core.settings['map_revalidate_interval'])
         #OsdLayer.set_layout(pango.FontDescription("Nokia Sans Maps 13"), gtk.gdk.color_parse('black'))
 
                 
@@ -175,7 +175,10 @@ class SimpleGui(Gui):
             exit()
 
     def _get_geocaches_callback(self, visible_area, maxresults):
-        return self.core.pointprovider.get_points_filter(visible_area, False if self.settings['options_hide_found'] else None, maxresults)
+        return self.core.pointprovider.get_points_filter(visible_area, False if self.settings['options_hide_found'] else None, maxresults, stub = True)
+
+    def _get_clusters_callback(self, visible_area, cell_lat, cell_lon):
+        return self.core.pointprovider.get_clusters(visible_area, cell_lat, cell_lon, False if self.settings['options_hide_found'] else None)
  
 
     def _prepare_images(self, dataroot):
@@ -347,7 +350,7 @@ class SimpleGui(Gui):
             zoom = 6
 
         self.map = Map(center=coord, zoom=zoom)
-        self.geocache_layer = GeocacheLayer(self._get_geocaches_callback, self._show_cache_select)
+        self.geocache_layer = GeocacheLayer(self._get_geocaches_callback, self._show_cache_select, self._get_clusters_callback)
         self.marks_layer = MarksLayer()
         self.map.add_layer(self.geocache_layer)
         self.map.add_layer(self.marks_layer)